@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+""" consolidate_patches
+Benchmark of contrib.qg_consolidate_patches on generated patch reports.
+
+For each size N a reproducible (seeded) report is built: N hosts, a
+PATCHES_BY_HOST section with N/4 patches on 40 hosts each, and a
+VULNS_FIXED_BY_PATCH section with 1 to 3 vulnerabilities per patch and host.
+vulns holds 2.5 tickets per host.  The time per CSV row should stay about
+flat as N grows (linear time); the previous nested loop implementation grew
+with N.
+
+  python benchmarks/consolidate_patches.py              # N = 2000 .. 32000
+  python benchmarks/consolidate_patches.py 1000 10000   # chosen sizes
+"""
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+from qualysconnect.contrib import qg_consolidate_patches
+from qualysconnect.contrib import QG_PATCHES_BY_HOST, QG_VULNS_FIXED_BY_PATCH
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+SIZES = (2000, 4000, 8000, 16000, 32000)
+QIDS = 50
+REPEAT = 3
+
+def generate(nhosts, seed=1):
+    """ Return (vulns, csv report, csv rows) for nhosts hosts. """
+    rnd = random.Random(seed)
+    ips = ['10.%d.%d.%d'%(n // 65536, (n // 256) % 256, n % 256)
+           for n in xrange(nhosts)]
+
+    vulns = {}
+    for ticket in xrange(nhosts * 5 // 2):
+        qid = str(rnd.randint(1, QIDS))
+        vulns.setdefault(qid, {'hosts': []})['hosts'].append(
+            {'ip': rnd.choice(ips), 'vuln_id': str(ticket)})
+
+    patches = []
+    fixes = []
+    for patch in xrange(max(nhosts // 4, 1)):
+        patch_qid = str(900000 + patch)
+        for ip in rnd.sample(ips, min(40, nhosts)):
+            count = rnd.randint(1, 3)
+            patches.append('"%s","%s","host","NB","Windows","%d"'%
+                           (patch_qid, ip, count))
+            for n in xrange(count):
+                fixes.append('"%s","%s","%d","5","Confirmed","Title","0",'
+                             '"01/01/2014"'%(patch_qid, ip,
+                                             rnd.randint(1, QIDS)))
+
+    report = '\n'.join(['"Patch Report"', '',
+                        '"Patches by Host"', ','.join(QG_PATCHES_BY_HOST)]
+                       + patches +
+                       ['', '"Host Vulnerabilities Fixed by Patch"',
+                        ','.join(QG_VULNS_FIXED_BY_PATCH)]
+                       + fixes + [''])
+    return (vulns, report, len(patches) + len(fixes))
+
+def copy_vulns(vulns):
+    return dict([(qid, {'hosts': list(vuln['hosts'])})
+                 for (qid, vuln) in vulns.items()])
+
+def main(sizes):
+    print "%8s %10s %10s %10s %12s %8s"%("hosts", "csv rows", "tickets",
+                                          "seconds", "usec/row", "ratio")
+    base = None
+    for nhosts in sizes:
+        (vulns, report, rows) = generate(nhosts)
+        tickets = sum([len(vuln['hosts']) for vuln in vulns.values()])
+        best = None
+        for n in xrange(REPEAT):
+            work = copy_vulns(vulns)
+            start = time.time()
+            qg_consolidate_patches(work, report)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        per_row = best / (rows + tickets) * 1e6
+        if base is None:
+            base = per_row
+        print "%8d %10d %10d %10.3f %12.2f %8.2f"%(nhosts, rows, tickets, best,
+                                                  per_row, per_row / base)
+
+if __name__ == '__main__':
+    sizes = [int(arg) for arg in sys.argv[1:]] or SIZES
+    main(sizes)
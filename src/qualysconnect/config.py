@@ -82,4 +82,24 @@ class QualysConnectConfig:
 
     def get_hostname(self):
         ''' Returns username from the hostname. '''
-        return self._cfgparse.get("info", "hostname")
\ No newline at end of file
+        return self._cfgparse.get("info", "hostname")
+
+    def get_session_cache(self):
+        ''' Returns True if the configfile asks for the QualysGuard session
+        to be cached between runs ('session_cache = yes'). '''
+        if not self._cfgparse.has_option("info", "session_cache"):
+            return False
+        return self._cfgparse.getboolean("info", "session_cache")
+
+    def get_response_cache(self):
+        ''' Returns 'memory' or 'disk' if the configfile asks for read-only
+        API responses to be cached ('response_cache = memory|disk'), None
+        otherwise. '''
+        if not self._cfgparse.has_option("info", "response_cache"):
+            return None
+        kind = self._cfgparse.get("info", "response_cache").strip().lower()
+        if kind in ('memory', 'disk'):
+            return kind
+        if kind not in ('', 'no', 'false', 'off', '0'):
+            logging.warning("Unknown response_cache '%s', not caching."%(kind,))
+        return None
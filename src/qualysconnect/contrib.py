@@ -3,49 +3,318 @@
 
 __license__ = "BSD-new"
 
+import os
+import re
+import csv
+import string
+import hashlib
+import logging
+import threading
 import unicodedata
-from collections import defaultdict
+import lxml.html
+from lxml import etree, objectify
+from cStringIO import StringIO
+from collections import defaultdict, OrderedDict, MutableMapping
 
-def qg_html_to_ascii(qg_html_text):
-    """Convert and return QualysGuard's quasi HTML text to ASCII text."""
-    text = qg_html_text
-    # Handle tagged line breaks (<p>, <br>)
-    text = re.sub(r'(?i)<br>[ ]*', '\n', text)
-    text = re.sub(r'(?i)<p>[ ]*', '\n', text)
+import qualysconnect.settings as qcs
+
+from qualysconnect.qg.parsepool import QGParsePool
+
+# Line breaks QualysGuard marks up as <br> or <p>.
+_QG_BREAK_RE = re.compile(r'(?i)<(?:br|p)>[ ]*')
+# Whitespace (including blank lines) at the start of a line.
+_QG_LEADING_SPACE_RE = re.compile(r'^\s+', re.MULTILINE)
+# Line breaks at the end of the text.
+_QG_TRAILING_BREAKS_RE = re.compile('[\n]+$')
+# Characters that need the HTML parser (tags, entities, carriage returns).
+_QG_MARKUP_RE = re.compile('[<&\r]')
+
+# Most recently converted texts, keyed by content hash.  SOLUTION, THREAT and
+# IMPACT texts recur across QIDs and reports.
+QG_HTML_MEMO_SIZE = 4096
+_qg_html_memo = OrderedDict()
+_qg_html_memo_lock = threading.Lock()
+
+def _qg_html_key(qg_html_text):
+    if isinstance(qg_html_text, unicode):
+        qg_html_text = qg_html_text.encode('utf-8')
+    return hashlib.sha1(qg_html_text).digest()
+
+def _qg_collect_text(element, out):
+    """Append the text content of element to out, writing anchors as
+    "link_text (link: link_url )".
+    """
+    if element.text:
+        out.append(element.text)
+    for child in element:
+        if isinstance(child.tag, basestring):
+            if child.tag == 'a' and child.get('href') is not None:
+                _qg_collect_link(child, out)
+            else:
+                _qg_collect_text(child, out)
+        # Comments and processing instructions only contribute their tail.
+        if child.tail:
+            out.append(child.tail)
+
+def _qg_collect_link(anchor, out):
+    link_text = anchor.text_content()
+    stripped = link_text.strip()
+    link_url = anchor.get('href').strip()
+    if not stripped:
+        out.append(link_text)
+        return
+    start = link_text.find(stripped)
+    out.append(link_text[:start])
+    if stripped.encode('ascii', 'ignore') != link_url:
+        # Link text is different, most likely a description.
+        out.append('%s (link: %s )' % (stripped, link_url))
+    else:
+        # Link text is the same as the href.  No need to duplicate link.
+        out.append(link_url)
+    out.append(link_text[start + len(stripped):])
+
+def _qg_convert_html(qg_html_text):
+    text = _QG_BREAK_RE.sub('\n', qg_html_text)
     # Remove consecutive line breaks
-    text = re.sub(r"^\s+", "", text, flags = re.MULTILINE)
+    text = _QG_LEADING_SPACE_RE.sub('', text)
     # Remove empty lines at the end.
-    text = re.sub('[\n]+$', '$', text)
-    # Store anchor tags href attribute
-    links = list(lxml.html.iterlinks(text))
-    # Remove anchor tags
-    html_element = lxml.html.fromstring(text)
-    # Convert anchor tags to "link_text (link: link_url )".
-    logging.debug('Converting anchor tags...')
-    text = html_element.text_content().encode('ascii', 'ignore')
-    # Convert each link.
-    for l in links:
-        # Find and replace each link.
-        link_text = l[0].text_content().encode('ascii', 'ignore').strip()
-        link_url = l[2].strip()
-        # Replacing link_text
-        if link_text != link_url:
-            # Link text is different, most likely a description.
-            text = string.replace(text, link_text, '%s (link: %s )' % (link_text, link_url))
-        else:
-            # Link text is the same as the href.  No need to duplicate link.
-            text = string.replace(text, link_text, '%s' % (link_url))
-    logging.debug('Done.')
+    text = _QG_TRAILING_BREAKS_RE.sub('$', text)
+    if not text.strip():
+        return ''
+    if not _QG_MARKUP_RE.search(text):
+        # Plain text, nothing for the HTML parser to do.
+        if isinstance(text, unicode):
+            return text.encode('ascii', 'ignore')
+        return text.decode('utf-8', 'ignore').encode('ascii', 'ignore')
+    # Parse once, collecting text and converting anchor tags in one walk.
+    out = []
+    _qg_collect_text(lxml.html.fromstring(text), out)
+    return u''.join(out).encode('ascii', 'ignore')
+
+def qg_html_to_ascii(qg_html_text):
+    """Convert and return QualysGuard's quasi HTML text to ASCII text.
+
+    Conversions are memoized by content, so text recurring across QIDs and
+    reports is only converted once.
+    """
+    key = _qg_html_key(qg_html_text)
+    _qg_html_memo_lock.acquire()
+    try:
+        text = _qg_html_memo.pop(key, None)
+        if text is not None:
+            _qg_html_memo[key] = text
+            return text
+    finally:
+        _qg_html_memo_lock.release()
+    text = _qg_convert_html(qg_html_text)
+    _qg_html_memo_lock.acquire()
+    try:
+        _qg_html_memo[key] = text
+        while len(_qg_html_memo) > QG_HTML_MEMO_SIZE:
+            _qg_html_memo.popitem(last = False)
+    finally:
+        _qg_html_memo_lock.release()
     return text
 
-def qg_parse_informational_qids(xml_report):
+def qg_html_to_ascii_batch(qg_html_texts):
+    """Convert many QualysGuard quasi HTML texts (e.g. a whole glossary) and
+    return the ASCII texts in the same order.  Each distinct text is
+    converted once.
+    """
+    converted = {}
+    result = []
+    for qg_html_text in qg_html_texts:
+        key = _qg_html_key(qg_html_text)
+        if key not in converted:
+            converted[key] = qg_html_to_ascii(qg_html_text)
+        result.append(converted[key])
+    return result
+
+def qg_html_to_ascii_memo_clear():
+    """Forget all memoized qg_html_to_ascii conversions."""
+    _qg_html_memo_lock.acquire()
+    try:
+        _qg_html_memo.clear()
+    finally:
+        _qg_html_memo_lock.release()
+
+def _qg_ascii(text):
+    """Return text (unicode or str, possibly None) as stripped ASCII."""
+    if not text:
+        return ''
+    if isinstance(text, str):
+        try:
+            # Plain ASCII needs no normalization.
+            text.decode('ascii')
+            return text.strip()
+        except UnicodeDecodeError:
+            text = text.decode('utf-8', 'replace')
+    return unicodedata.normalize('NFKD', unicode(text)).encode('ascii', 'ignore').strip()
+
+def _qg_child_ascii(element, tag):
+    """Return the ASCII text of element's child tag, '' if there is none."""
+    return _qg_ascii(element.findtext(tag))
+
+class InfoHost(object):
+    """A host affected by an informational QID.  Stored in __slots__ to keep
+    large reports small; behaves like a dictionary with the fixed keys 'ip',
+    'dns', 'netbios', 'vuln_id' and 'result' (registered as a
+    collections.MutableMapping).  Assigning other keys raises KeyError and
+    keys cannot be deleted.  The json module only serializes real
+    dictionaries: use dict(host), or json.dumps(..., default=dict).
+    """
+    __slots__ = ('ip', 'dns', 'netbios', 'vuln_id', 'result')
+
+    def __init__(self, ip, dns, netbios, vuln_id, result):
+        self.ip = ip
+        self.dns = dns
+        self.netbios = netbios
+        self.vuln_id = vuln_id
+        self.result = result
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        raise TypeError("InfoHost keys cannot be deleted")
+
+    def __contains__(self, key):
+        return key in self.__slots__
+
+    def __iter__(self):
+        return iter(self.__slots__)
+
+    def __len__(self):
+        return len(self.__slots__)
+
+    def __eq__(self, other):
+        if isinstance(other, (InfoHost, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def has_key(self, key):
+        return key in self.__slots__
+
+    def keys(self):
+        return list(self.__slots__)
+
+    def values(self):
+        return [getattr(self, key) for key in self.__slots__]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.__slots__]
+
+    def iterkeys(self):
+        return iter(self.__slots__)
+
+    def itervalues(self):
+        return iter(self.values())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def update(self, *args, **kwargs):
+        for (key, value) in dict(*args, **kwargs).items():
+            self[key] = value
+
+    def copy(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+# Not a subclass: Python 2's ABCs have no __slots__ and would add a __dict__.
+MutableMapping.register(InfoHost)
+
+def _qg_info_host(element):
+    """Return (ip, dns, netbios, [(qid, result), ...]) of a report HOST
+       element.  Runs in a parse worker, so only returns plain values.
+    """
+    return (_qg_child_ascii(element, 'IP'),
+            _qg_child_ascii(element, 'DNS'),
+            _qg_child_ascii(element, 'NETBIOS'),
+            [(_qg_child_ascii(vuln, 'QID'), _qg_child_ascii(vuln, 'RESULT'))
+             for vuln in element.iterfind('VULN_INFO_LIST/VULN_INFO')])
+
+def _qg_info_add_host(info_vulns, host):
+    """Add a host, as returned by _qg_info_host, to info_vulns."""
+    (ip, dns, netbios, vulns) = host
+    # IPs and hostnames recur once per QID; keep one copy of each.
+    ip = intern(ip)
+    dns = intern(dns)
+    netbios = intern(netbios)
+    # Extract vulnerabilities host is affected by.
+    for (qid, result) in vulns:
+        qid = intern(qid)
+        # Informational QIDs do not have vuln_id numbers.  This is a flag to write the CSV file.
+        vuln_info = info_vulns[qid]
+        if 'hosts' not in vuln_info:
+            logging.debug('New QID found: %s' % (qid))
+            vuln_info['hosts'] = []
+        vuln_info['hosts'].append(InfoHost(ip, dns, netbios, '', result))
+
+def _qg_parse_informational_report(xml_report):
+    """Parse a report (file-like object) in this process; see
+       qg_parse_informational_qids.
+    """
+    # Use defaultdict in case a new QID is encountered.    
+    info_vulns = defaultdict(dict)
+    # TODO:  Check against c_args.max to prevent creating CSV content for QIDs that we won't use.
+    for event, element in etree.iterparse(xml_report, events = ('end',), tag = ('HOST', 'VULN_DETAILS'), huge_tree = True):
+        if element.tag == 'HOST':
+            if element.getparent() is None or element.getparent().tag != 'HOST_LIST':
+                continue
+            _qg_info_add_host(info_vulns, _qg_info_host(element))
+        else:
+            # Add all vulnerabilty information.
+            qid = intern(_qg_child_ascii(element, 'QID'))
+            vuln_info = info_vulns[qid]
+            vuln_info['title'] = _qg_child_ascii(element, 'TITLE')
+            vuln_info['severity'] = intern(_qg_child_ascii(element, 'SEVERITY'))
+            vuln_info['solution'] = qg_html_to_ascii(_qg_child_ascii(element, 'SOLUTION'))
+            vuln_info['threat'] = qg_html_to_ascii(_qg_child_ascii(element, 'THREAT'))
+            vuln_info['impact'] = qg_html_to_ascii(_qg_child_ascii(element, 'IMPACT'))
+        # Drop the processed element and its already processed siblings.
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return info_vulns
+
+def qg_parse_informational_qids(xml_report, workers = None):
     """Return vulnerabilities of severity 1 and 2 levels due to a restriction of
        QualysGuard's inability to report them in the internal ticketing system.
+
+       xml_report may be the report as a string or a file-like object.  The
+       report is parsed incrementally, so memory use grows with the number of
+       affected hosts rather than with the size of the report.  With workers
+       above 1 its hosts are parsed in parallel by qg.parsepool.QGParsePool.
+       workers defaults to settings.parse_workers: 1 (parse in this process)
+       unless changed, None for one process per CPU.
     """
 #    asset_group's vulnerability data map:
 #    {'qid_number': {
 #                    # CSV info
-#                    'hosts': [{'ip': '10.28.0.1', 'dns': 'hostname', 'netbios': 'blah', 'vuln_id': 'remediation_ticket_number'}, {'ip': '10.28.0.3', 'dns': 'hostname2', 'netbios': '', 'vuln_id': 'remediation_ticket_number'}, ...],
+#                    'hosts': [InfoHost(ip='10.28.0.1', dns='hostname', netbios='blah', vuln_id='', result='...'), ...],
 #                    'solution': '',
 #                    'impact': '',
 #                    'threat': '', 
@@ -53,57 +322,22 @@ def qg_parse_informational_qids(xml_report):
 #                   }
 #     'qid_number2': ...
 #     }
-    # Add all vulnerabilities to list of dictionaries.
-    # Use defaultdict in case a new QID is encountered.    
-    info_vulns = defaultdict(dict)
-    # Parse vulnerabilities in xml string.
-    tree = objectify.fromstring(xml_report)
-    # Write IP, DNS, & Result into each QID CSV file.
+    if not hasattr(xml_report, 'read'):
+        xml_report = StringIO(xml_report)
     logging.debug('Parsing report...')
-    # TODO:  Check against c_args.max to prevent creating CSV content for QIDs that we won't use.
-    for host in tree.HOST_LIST.HOST:
-        # Extract possible extra hostname information.
-        try:
-            netbios = unicodedata.normalize('NFKD', unicode(host.NETBIOS)).encode('ascii', 'ignore').strip()
-        except AttributeError:
-            netbios = ''
-        try:
-            dns = unicodedata.normalize('NFKD', unicode(host.DNS)).encode('ascii', 'ignore').strip()
-        except AttributeError:
-            dns = ''
-        ip = unicodedata.normalize('NFKD', unicode(host.IP)).encode('ascii', 'ignore').strip()
-        # Extract vulnerabilities host is affected by.
-        for vuln in host.VULN_INFO_LIST.VULN_INFO:
-            try:
-                result = unicodedata.normalize('NFKD', unicode(vuln.RESULT)).encode('ascii', 'ignore').strip()
-            except AttributeError:
-                result = ''
-            qid = unicodedata.normalize('NFKD', unicode(vuln.QID)).encode('ascii', 'ignore').strip()
-            # Attempt to add host to QID's list of affected hosts.
-            try:
-                info_vulns[qid]['hosts'].append({'ip': '%s' % (ip),
-                                                 'dns': '%s' % (dns),
-                                                 'netbios': '%s' % (netbios),
-                                                 'vuln_id': '', # Informational QIDs do not have vuln_id numbers.  This is a flag to write the CSV file.
-                                                 'result': '%s' % (result), })
-            except KeyError:
-                # New QID.
-                logging.debug('New QID found: %s' % (qid))
-                info_vulns[qid]['hosts'] = []
-                info_vulns[qid]['hosts'].append({'ip': '%s' % (ip),
-                                                 'dns': '%s' % (dns),
-                                                 'netbios': '%s' % (netbios),
-                                                 'vuln_id': '', # Informational QIDs do not have vuln_id numbers.  This is a flag to write the CSV file. 
-                                                 'result': '%s' % (result), })
-    # All vulnerabilities added.
-    # Add all vulnerabilty information.
-    for vuln_details in tree.GLOSSARY.VULN_DETAILS_LIST.VULN_DETAILS:
-        qid = unicodedata.normalize('NFKD', unicode(vuln_details.QID)).encode('ascii', 'ignore').strip()
-        info_vulns[qid]['title'] = unicodedata.normalize('NFKD', unicode(vuln_details.TITLE)).encode('ascii', 'ignore').strip()
-        info_vulns[qid]['severity'] = unicodedata.normalize('NFKD', unicode(vuln_details.SEVERITY)).encode('ascii', 'ignore').strip()
-        info_vulns[qid]['solution'] = qg_html_to_ascii(unicodedata.normalize('NFKD', unicode(vuln_details.SOLUTION)).encode('ascii', 'ignore').strip())
-        info_vulns[qid]['threat'] = qg_html_to_ascii(unicodedata.normalize('NFKD', unicode(vuln_details.THREAT)).encode('ascii', 'ignore').strip())
-        info_vulns[qid]['impact'] = qg_html_to_ascii(unicodedata.normalize('NFKD', unicode(vuln_details.IMPACT)).encode('ascii', 'ignore').strip())
+    if workers is None:
+        workers = qcs.parse_workers
+    pool = QGParsePool(workers)
+    if pool.workers() == 1:
+        return _qg_parse_informational_report(xml_report)
+    # Hosts come back in report order, as if parsed in this process; fold
+    #  each in as it arrives.
+    host_vulns = defaultdict(dict)
+    info_vulns = pool.parse(xml_report, _qg_info_host,
+                            lambda host: _qg_info_add_host(host_vulns, host),
+                            _qg_parse_informational_report)
+    for qid, vuln_info in host_vulns.iteritems():
+        info_vulns[qid]['hosts'] = vuln_info['hosts']
     # Ready to report informational vulnerabilities.
     return info_vulns
 
@@ -136,80 +370,98 @@ def qg_ticket_list(asset_group, severity, qids = None):
     logging.debug(csv_output)
     logging.debug('Improving remediation efficiency by removing unneeded, redundant patches.')
     print 'Improving remediation efficiency by removing unneeded, redundant patches.'
-    # Find the line for Patches by Host data.
-    logging.debug('Header found at %s.' % (csv_output.find('Patch QID, IP, DNS, NetBIOS, OS, Vulnerability Count')))
-
-    starting_pos = csv_output.find('Patch QID, IP, DNS, NetBIOS, OS, Vulnerability Count') + 52
-    logging.debug('starting_pos = %s' % str(starting_pos))
-    # Data resides between line ending in 'Vulnerability Count' and a blank line.
-    patches_by_host = csv_output[starting_pos:csv_output[starting_pos:].find('Host Vulnerabilities Fixed by Patch') + starting_pos - 3]
-    logging.debug('patches_by_host =')
-    logging.debug(patches_by_host)
-    # Read in string patches_by_host csv to a dictionary.
-    f = patches_by_host.split(os.linesep)
-    reader = csv.DictReader(f, ['Patch QID', 'IP', 'DNS', 'NetBIOS', 'OS', 'Vulnerability Count'], delimiter = ',')
-    # Mark Patch QIDs that fix multiple vulnerabilities with associated IP addresses.
-    redundant_qids = defaultdict(list)
-    for row in reader:
-        if int(row['Vulnerability Count']) > 1:
-            # Add to list of redundant QIDs.
-            redundant_qids[row['Patch QID']].append(row['IP'])
-            logging.debug('%s, %s, %s, %s' % (row['Patch QID'], row['IP'], int(row['Vulnerability Count']), redundant_qids[row['Patch QID']]))
-    # Log for debugging.
-    logging.debug('len(redundant_qids) = %s, redundant_qids =' % (len(redundant_qids)))
-    for patch_qid in redundant_qids.keys():
-        logging.debug('%s, %s' % (str(patch_qid), str(redundant_qids[patch_qid])))
-    # Extract redundant QIDs with associated IP addresses.
-    # Find the line for Patches by Host data.
-    starting_pos = csv_output.find('Patch QID, IP, QID, Severity, Type, Title, Instance, Last Detected') + 66
-    # Data resides between line ending in 'Vulnerability Count' and end of string.
-    host_vulnerabilities_fixed_by_patch = csv_output[starting_pos:]
-    # Read in string host_vulnerabilities_fixed_by_patch csv to a dictionary.
-    f = host_vulnerabilities_fixed_by_patch.split(os.linesep)
-    reader = csv.DictReader(f, ['Patch QID', 'IP', 'QID', 'Severity', 'Type', 'Title', 'Instance', 'Last Detected'], delimiter = ',')
-    # Remove IP addresses associated with redundant QIDs.
-    qids_to_remove = defaultdict(list)
-    for row in reader:
-        # If the row's IP address's Patch QID was found to have multiple vulnerabilities... 
-        if len(redundant_qids[row['Patch QID']]) > 0 and redundant_qids[row['Patch QID']].count(row['IP']) > 0:
-            # Add the QID column to the list of dictionaries {QID: [IP address, IP address, ...], QID2: [IP address], ...}
-            qids_to_remove[row['QID']].append(row['IP'])
-    # Log for debugging.
-    logging.debug('len(qids_to_remove) = %s, qids_to_remove =' % (len(qids_to_remove)))
-    for a_qid in qids_to_remove.keys():
-        logging.debug('%s, %s' % (str(a_qid), str(qids_to_remove[a_qid])))
-    #
-    # Diff vulns against qids_to_remove and against open incidents.
-    #
     vulns_length = len(vulns)
+    # Diff vulns against redundant patches and against open incidents.
+    vulns = qg_consolidate_patches(vulns, csv_output, reaction_open_issue)
+    # Diff completed
+    if not vulns_length == len(vulns):
+        print 'A count of %s vulnerabilities have been consolidated to %s vulnerabilities, a reduction of %s%%.' % (int(vulns_length), int(len(vulns)), int(round((int(vulns_length) - int(len(vulns))) / float(vulns_length) * 100)))
+    # Return vulns to report.
+    logging.debug('vulns =')
+    logging.debug(vulns)
+    return vulns
+
+# Column headers of the patch report sections qg_consolidate_patches uses.
+QG_PATCHES_BY_HOST = ('Patch QID', 'IP', 'DNS', 'NetBIOS', 'OS', 'Vulnerability Count')
+QG_VULNS_FIXED_BY_PATCH = ('Patch QID', 'IP', 'QID', 'Severity', 'Type', 'Title', 'Instance', 'Last Detected')
+
+def qg_csv_sections(csv_output, sections):
+    """Generate (section, row) for the rows of the CSV report's sections.
+
+       sections is a list of column header tuples (e.g. QG_PATCHES_BY_HOST);
+       a line holding one of them starts that section and each row is yielded
+       as a dictionary keyed by its columns.  A section ends at a blank line,
+       a single column (title) line or the next section's header.  csv_output
+       is a string or an iterable of lines, read one line at a time.
+    """
+    if isinstance(csv_output, basestring):
+        csv_output = StringIO(csv_output)
+    headers = dict((tuple(header), header) for header in sections)
+    current = None
+    for row in csv.reader(csv_output):
+        fields = tuple([field.strip() for field in row])
+        if fields in headers:
+            current = headers[fields]
+            logging.debug('Section %s found.' % (', '.join(current)))
+            continue
+        if current is None:
+            continue
+        if len(fields) <= 1:
+            # Blank or title line, end of the section.
+            current = None
+            continue
+        yield current, dict(zip(current, fields))
+
+def qg_consolidate_patches(vulns, csv_output, is_open_issue = None):
+    """Remove hosts from vulns whose QID is fixed by a patch that fixes
+       several vulnerabilities on the host, per the patch report csv_output.
+       Hosts with an open issue (is_open_issue(vuln_id) is True) are removed
+       too, as are QIDs left without hosts.  Returns vulns.
+
+       Runs in time linear in the size of the report and of vulns (see
+       benchmarks/consolidate_patches.py).  The report's sections may come in
+       either order; Host Vulnerabilities Fixed by Patch rows that precede
+       Patches by Host are kept until it has been read.
+    """
+    # Index Patch QID -> IPs on which the patch fixes multiple vulnerabilities
+    #  and QID -> IPs whose vulnerability such a patch fixes.
+    redundant_qids = defaultdict(set)
+    qids_to_remove = defaultdict(set)
+    # (Patch QID, IP, QID) of fixed vulnerabilities read before any patch.
+    early_fixes = []
+    patches_seen = False
+    for section, row in qg_csv_sections(csv_output, (QG_PATCHES_BY_HOST, QG_VULNS_FIXED_BY_PATCH)):
+        if section is QG_PATCHES_BY_HOST:
+            patches_seen = True
+            try:
+                count = int(row['Vulnerability Count'])
+            except (TypeError, ValueError):
+                continue
+            if count > 1:
+                # Add to list of redundant QIDs.
+                redundant_qids[row['Patch QID']].add(row['IP'])
+        elif not patches_seen:
+            early_fixes.append((row['Patch QID'], row['IP'], row['QID']))
+        elif row['IP'] in redundant_qids.get(row['Patch QID'], ()):
+            qids_to_remove[row['QID']].add(row['IP'])
+    for patch_qid, ip, qid in early_fixes:
+        if ip in redundant_qids.get(patch_qid, ()):
+            qids_to_remove[qid].add(ip)
+    # Log for debugging.
+    logging.debug('len(redundant_qids) = %s, len(qids_to_remove) = %s' % (len(redundant_qids), len(qids_to_remove)))
     # Iterate over list of keys rather than original dictionary as some keys may be deleted changing the size of the dictionary.
     for a_qid in vulns.keys():
-        # Debug log original qid's hosts.
-        logging.debug('Before diffing vulns[%s] =' % (a_qid))
-        logging.debug(vulns[a_qid]['hosts'])
-        # Pop each host.
-        # The [:] returns a "slice" of x, which happens to contain all its elements, and is thus effectively a copy of x.
-        for host in vulns[a_qid]['hosts'][:]:
+        remove_ips = qids_to_remove.get(a_qid, ())
+        hosts = []
+        for host in vulns[a_qid]['hosts']:
             # If the QID for the host is a dupe or if a there is an open Reaction incident.
-            if qids_to_remove[a_qid].count(host['ip']) > 0 or reaction_open_issue(host['vuln_id']):
-                # Remove the host from the QID's list of target hosts.
+            if host['ip'] in remove_ips or (is_open_issue and is_open_issue(host['vuln_id'])):
                 logging.debug('Removing remediation ticket %s.' % (host['vuln_id']))
-                vulns[a_qid]['hosts'].remove(host)
             else:
-                # Do not remove this vuln
-                logging.debug('Will report remediation %s.' % (host['vuln_id']))
-        # Debug log diff'd qid's hosts.
-        logging.debug('After diffing vulns[%s]=' % (a_qid))
-        logging.debug(vulns[a_qid]['hosts'])
+                hosts.append(host)
+        vulns[a_qid]['hosts'] = hosts
         # If there are no more hosts left to patch for the qid.
-        if len(vulns[a_qid]['hosts']) == 0:
-            # Remove the QID.
+        if not hosts:
             logging.debug('Deleting vulns[%s].' % (a_qid))
             del vulns[a_qid]
-    # Diff completed
-    if not vulns_length == len(vulns):
-        print 'A count of %s vulnerabilities have been consolidated to %s vulnerabilities, a reduction of %s%%.' % (int(vulns_length), int(len(vulns)), int(round((int(vulns_length) - int(len(vulns))) / float(vulns_length) * 100)))
-    # Return vulns to report.
-    logging.debug('vulns =')
-    logging.debug(vulns)
-    return vulns
\ No newline at end of file
+    return vulns
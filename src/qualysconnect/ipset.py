@@ -0,0 +1,322 @@
+""" Module providing IPSet, a compact set of IPv4/IPv6 addresses stored as
+sorted, non-overlapping integer intervals.
+
+IPv4 interval bounds are kept in array('I') buffers (4 bytes per bound),
+IPv6 bounds in sorted lists of longs.  Parsing goes straight from text to
+integers with socket.inet_pton, so large address lists are validated, merged
+and compared without building an object per address.
+
+  >>> s = IPSet.parse("10.0.0.0/24,10.0.0.128-10.0.1.5,10.0.0.7")
+  >>> s.to_ip_string()
+  '10.0.0.0-10.0.1.5'
+  >>> s.count()
+  262L
+"""
+import socket
+import struct
+
+from array import array
+from bisect import bisect_right
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+# array typecode holding an unsigned 32 bit integer in the least space.
+_V4_TYPECODE = [t for t in ('I', 'L') if array(t).itemsize >= 4][0]
+
+_V4_MAX = (1 << 32) - 1
+_V6_MAX = (1 << 128) - 1
+_BITS = {4: 32, 6: 128}
+
+_v4_struct = struct.Struct('!I')
+_v6_struct = struct.Struct('!QQ')
+
+def parse_address(text):
+    """ Return (version, integer) for an IPv4 or IPv6 address string.
+    Raises ValueError if text is not a valid address.
+    """
+    try:
+        if ':' in text:
+            (hi, lo) = _v6_struct.unpack(socket.inet_pton(socket.AF_INET6, text))
+            return (6, (hi << 64) | lo)
+        return (4, _v4_struct.unpack(socket.inet_pton(socket.AF_INET, text))[0])
+    except (socket.error, TypeError):
+        raise ValueError("'%s' is not a valid IP address"%(text,))
+
+def format_address(version, value):
+    """ Return the string form of integer address value. """
+    if version == 4:
+        return socket.inet_ntop(socket.AF_INET, _v4_struct.pack(value))
+    return socket.inet_ntop(socket.AF_INET6,
+                            _v6_struct.pack(value >> 64, value & 0xFFFFFFFFFFFFFFFF))
+
+def _range_token(version, start, end):
+    """ Return the Qualys 'ips' token of the addresses start to end. """
+    if start == end:
+        return format_address(version, start)
+    return "%s-%s"%(format_address(version, start),
+                     format_address(version, end))
+
+def _prefix_length(version, mask_text):
+    """ Return the prefix length for a '/len', '/netmask' or '/hostmask'
+    CIDR suffix.
+    """
+    bits = _BITS[version]
+    if mask_text.isdigit():
+        prefix = int(mask_text)
+        if prefix <= bits:
+            return prefix
+        raise ValueError("invalid prefix length /%s"%(mask_text,))
+    (mask_version, mask) = parse_address(mask_text)
+    if mask_version != version:
+        raise ValueError("invalid netmask /%s"%(mask_text,))
+    full = (1 << bits) - 1
+    for candidate in (mask, full ^ mask):   # netmask, then hostmask
+        inverted = full ^ candidate
+        if inverted & (inverted + 1) == 0:
+            return bits - len(bin(inverted)) + 2 if inverted else bits
+    raise ValueError("invalid netmask /%s"%(mask_text,))
+
+def parse_token(token):
+    """ Return (version, start, end) for one entry of a Qualys 'ips' string:
+    an address, an address range (start-end, start < end) or a CIDR block
+    (address/len, address/netmask).  Raises ValueError if it is invalid.
+    """
+    token = token.strip()
+    if '/' in token:
+        (address, mask) = token.split('/', 1)
+        (version, value) = parse_address(address)
+        host_bits = _BITS[version] - _prefix_length(version, mask)
+        start = (value >> host_bits) << host_bits
+        return (version, start, start + (1 << host_bits) - 1)
+    if '-' in token:
+        (first, last) = token.split('-', 1)
+        (version, start) = parse_address(first.strip())
+        (end_version, end) = parse_address(last.strip())
+        if version != end_version or start >= end:
+            raise ValueError("'%s' is not a valid IP range"%(token,))
+        return (version, start, end)
+    (version, value) = parse_address(token)
+    return (version, value, value)
+
+class IPSet:
+    """ Immutable set of IPv4 and IPv6 addresses.
+
+    Keyword Arguments:
+    ==================
+    intervals -- [optional] iterable of (version, start, end) tuples with
+                 integer bounds.  They may overlap and be in any order.
+    """
+    def __init__(self, intervals=()):
+        self._starts = {4: array(_V4_TYPECODE), 6: []}
+        self._ends = {4: array(_V4_TYPECODE), 6: []}
+
+        by_version = {4: [], 6: []}
+        for (version, start, end) in intervals:
+            by_version[version].append((start, end))
+        for version, spans in by_version.items():
+            self._store(version, spans)
+
+    def _store(self, version, spans):
+        """ Sort, coalesce overlapping/adjacent spans and keep them. """
+        spans.sort()
+        starts = self._starts[version]
+        ends = self._ends[version]
+        for (start, end) in spans:
+            if ends and start <= ends[-1] + 1:
+                if end > ends[-1]:
+                    ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+
+    @classmethod
+    def _from_sorted(cls, spans_by_version):
+        """ Build a set from already sorted, disjoint, non-adjacent spans. """
+        ipset = cls()
+        for version, spans in spans_by_version.items():
+            starts = ipset._starts[version]
+            ends = ipset._ends[version]
+            for (start, end) in spans:
+                starts.append(start)
+                ends.append(end)
+        return ipset
+
+    @classmethod
+    def parse(cls, ipstring, strict=True):
+        """ Return an IPSet for a comma separated list of addresses, ranges
+        and CIDR blocks (the Qualys 'ips' format).
+
+        Keyword Arguments:
+        ==================
+        ipstring -- comma separated string (or an iterable of entries).
+        strict -- [optional] raise ValueError for an invalid entry, otherwise
+                  invalid entries are skipped.
+        """
+        if isinstance(ipstring, basestring):
+            ipstring = ipstring.split(',')
+        intervals = []
+        for token in ipstring:
+            if not token.strip():
+                continue
+            try:
+                intervals.append(parse_token(token))
+            except ValueError:
+                if strict:
+                    raise ValueError("IP argument cannot be parsed, '%s' is not "
+                                     "a valid IP Range or IP Address"%(token,))
+        return cls(intervals)
+
+    def intervals(self, version=None):
+        """ Iterate over the set's (version, start, end) intervals in
+        address order (IPv4 before IPv6).
+        """
+        for v in (4, 6):
+            if version is not None and v != version:
+                continue
+            for (start, end) in zip(self._starts[v], self._ends[v]):
+                yield (v, start, end)
+
+    def __len__(self):
+        """ Number of disjoint intervals (see count() for addresses). """
+        return len(self._starts[4]) + len(self._starts[6])
+
+    def __nonzero__(self):
+        return len(self) > 0
+
+    def __eq__(self, other):
+        return (isinstance(other, IPSet) and
+                list(self.intervals()) == list(other.intervals()))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def count(self, version=None):
+        """ Return the number of addresses in the set. """
+        return sum([end - start + 1 for (v, start, end)
+                    in self.intervals(version)], 0L)
+
+    def __contains__(self, address):
+        """ True if address (string or (version, integer)) is in the set. """
+        if isinstance(address, basestring):
+            address = parse_address(address)
+        (version, value) = address
+        starts = self._starts[version]
+        n = bisect_right(starts, value) - 1
+        return n >= 0 and value <= self._ends[version][n]
+
+    def union(self, other):
+        """ Return a set with the addresses of both sets. """
+        return IPSet(list(self.intervals()) + list(other.intervals()))
+
+    __or__ = union
+
+    def intersection(self, other):
+        """ Return a set with the addresses present in both sets. """
+        result = {4: [], 6: []}
+        for version in (4, 6):
+            a = zip(self._starts[version], self._ends[version])
+            b = zip(other._starts[version], other._ends[version])
+            (i, j) = (0, 0)
+            while i < len(a) and j < len(b):
+                start = max(a[i][0], b[j][0])
+                end = min(a[i][1], b[j][1])
+                if start <= end:
+                    result[version].append((start, end))
+                if a[i][1] < b[j][1]:
+                    i += 1
+                else:
+                    j += 1
+        return IPSet._from_sorted(result)
+
+    __and__ = intersection
+
+    def difference(self, other):
+        """ Return a set with the addresses of this set not in other. """
+        result = {4: [], 6: []}
+        for version in (4, 6):
+            b = zip(other._starts[version], other._ends[version])
+            j = 0
+            for (start, end) in zip(self._starts[version], self._ends[version]):
+                # skip subtrahend intervals entirely below this interval.
+                while j < len(b) and b[j][1] < start:
+                    j += 1
+                k = j
+                while start <= end and k < len(b) and b[k][0] <= end:
+                    if b[k][0] > start:
+                        result[version].append((start, b[k][0] - 1))
+                    start = max(start, b[k][1] + 1)
+                    k += 1
+                if start <= end:
+                    result[version].append((start, end))
+        return IPSet._from_sorted(result)
+
+    __sub__ = difference
+
+    def to_ip_string(self):
+        """ Return the set as a string valid for the Qualys API 'ips' key. """
+        ips = []
+        for (version, start, end) in self.intervals():
+            if start == end:
+                ips.append(format_address(version, start))
+            else:
+                ips.append("%s-%s"%(format_address(version, start),
+                                    format_address(version, end)))
+        return ",".join(ips)
+
+    def split(self, max_bytes=None, max_hosts=None):
+        """ Return the set as a list of Qualys 'ips' strings, in address
+        order, each at most max_bytes long and covering at most max_hosts
+        addresses.  Ranges are divided between strings only when max_hosts
+        requires it, so the number of strings is as small as the budgets
+        allow.
+
+        Keyword Arguments:
+        ==================
+        max_bytes -- [optional] length limit of each string.
+        max_hosts -- [optional] address count limit of each string.
+        """
+        chunks = []
+        current = []
+        size = 0
+        hosts = 0
+        for (version, start, end) in self.intervals():
+            while start <= end:
+                last = end
+                if max_hosts:
+                    last = min(end, start + (max_hosts - hosts) - 1)
+                token = _range_token(version, start, last)
+                needed = len(token) + (current and 1 or 0)
+                if max_bytes and size + needed > max_bytes:
+                    if not current:
+                        # too long even alone: halve the range until its
+                        #  token fits, down to a single address.
+                        while len(token) > max_bytes and start < last:
+                            last = start + (last - start) // 2
+                            token = _range_token(version, start, last)
+                        if len(token) > max_bytes:
+                            raise ValueError("'%s' does not fit in %d bytes"%
+                                             (token, max_bytes))
+                        chunks.append(token)
+                        start = last + 1
+                        continue
+                    chunks.append(",".join(current))
+                    (current, size, hosts) = ([], 0, 0)
+                    continue
+                current.append(token)
+                size += needed
+                hosts += last - start + 1
+                start = last + 1
+                if max_hosts and hosts >= max_hosts:
+                    chunks.append(",".join(current))
+                    (current, size, hosts) = ([], 0, 0)
+        if current:
+            chunks.append(",".join(current))
+        return chunks
+
+    def __str__(self):
+        return self.to_ip_string()
+
+    def __repr__(self):
+        return "IPSet(%r)"%(self.to_ip_string(),)
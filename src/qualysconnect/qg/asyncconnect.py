@@ -0,0 +1,261 @@
+""" Module providing AsyncQGAPISession, a non-blocking variant of QGAPISession
+for applications that run their own event loop.
+
+QualysConnect targets Python 2.x, which has no asyncio.  Instead every call
+returns a QGFuture immediately and the blocking urllib2 work (and, when asked
+for, the XML processing) runs on a bounded pool of worker threads.  An event
+loop thread never blocks; it can poll done() or register add_done_callback()
+(callbacks run on the worker thread, so hand results back with the loop's
+thread safe scheduling call, e.g. call_soon_threadsafe).
+
+This is not an event loop multiplexing sockets: how much runs at once is
+bounded by the worker threads (settings.async_workers), each running one
+blocking call or reading one chunk of a stream at a time, and by the rate
+limiter's concurrency limit (settings.concurrency_limit) on calls in progress
+at QualysGuard.  Further calls wait in the queue.  Open streams hold neither
+while their consumer is not reading.
+"""
+import logging
+import threading
+
+from collections import deque
+
+import qualysconnect.settings as qcs
+
+from qualysconnect.qg.connect import QGAPISession
+# QGFuture and QGWorkerPool lived here before moving to qualysconnect.workers.
+from qualysconnect.workers import QGFuture, QGWorkerPool
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+class QGAsyncStream:
+    """ Asynchronous reader over a streamed QualysGuard response; read()
+    returns a QGFuture for the next chunk ('' at the end of the response).
+
+    Chunks are read off the socket by worker pool tasks, one chunk per task,
+    into a buffer of at most 'buffered' chunks.  Once it is full reading
+    pauses until the consumer catches up, so an open stream only occupies a
+    worker thread while a chunk is actually being read.  close() stops
+    reading and closes the response.
+
+    Keyword Arguments:
+    ==================
+    workers -- QGWorkerPool running the reads.
+    opener -- function returning the (file-like) response, called on a
+              worker.
+    chunk_size -- [optional] bytes per chunk (settings.stream_chunk_size).
+    buffered -- [optional] chunks read ahead (settings.async_stream_buffer).
+    """
+    def __init__(self, workers, opener, chunk_size=None, buffered=None):
+        if chunk_size is None:
+            chunk_size = qcs.stream_chunk_size
+        if buffered is None:
+            buffered = qcs.async_stream_buffer
+        self._workers = workers
+        self._opener = opener
+        self._chunk_size = chunk_size
+        self._buffered = buffered
+        self._cond = threading.Condition()
+        self._response = None
+        self._chunks = deque()
+        self._readers = deque()
+        self._pumping = False
+        self._finished = False
+        self._error = None
+        self._closed = False
+        self._cond.acquire()
+        try:
+            self._schedule()
+        finally:
+            self._cond.release()
+
+    def read(self):
+        """ Return a QGFuture resolving to the next chunk of the response. """
+        future = QGFuture()
+        self._cond.acquire()
+        try:
+            if self._closed:
+                future.set_result('')
+            elif self._chunks:
+                future.set_result(self._chunks.popleft())
+                self._schedule()
+            elif self._error is not None:
+                future.set_exception(self._error)
+            elif self._finished:
+                future.set_result('')
+            else:
+                self._readers.append(future)
+                self._schedule()
+        finally:
+            self._cond.release()
+        return future
+
+    def close(self):
+        """ Stop reading the response, close it and discard buffered data.
+        Pending and later read()s resolve to ''.
+        """
+        self._cond.acquire()
+        try:
+            if self._closed:
+                return
+            self._closed = True
+            self._chunks.clear()
+            readers, self._readers = self._readers, deque()
+            response = self._response
+        finally:
+            self._cond.release()
+        for reader in readers:
+            reader.set_result('')
+        if response is not None:
+            response.close()
+
+    def _schedule(self):
+        """ Queue the next read unless one is running, the buffer is full or
+        the stream is over.  Caller holds the lock.
+        """
+        if (self._pumping or self._finished or self._closed
+            or len(self._chunks) >= self._buffered):
+            return
+        self._pumping = True
+        self._workers.submit(self._pump)
+
+    def _pump(self):
+        """ Worker side: read one chunk into the buffer or a waiting reader.
+        Only one _pump runs at a time.
+        """
+        try:
+            if self._response is None:
+                response = self._opener()
+                self._cond.acquire()
+                try:
+                    self._response = response
+                    closed = self._closed
+                finally:
+                    self._cond.release()
+                if closed:
+                    response.close()
+                    return
+            chunk = self._response.read(self._chunk_size)
+        except Exception, e:
+            self._end(e)
+            return
+
+        reader = None
+        self._cond.acquire()
+        try:
+            if self._closed:
+                return
+            self._pumping = False
+            if chunk:
+                if self._readers:
+                    reader = self._readers.popleft()
+                else:
+                    self._chunks.append(chunk)
+                self._schedule()
+        finally:
+            self._cond.release()
+        if not chunk:
+            self._end(None)
+        elif reader is not None:
+            reader.set_result(chunk)
+
+    def _end(self, error):
+        self._cond.acquire()
+        try:
+            if self._closed:
+                return
+            self._finished = True
+            self._pumping = False
+            self._error = error
+            readers, self._readers = self._readers, deque()
+            response = self._response
+        finally:
+            self._cond.release()
+        if response is not None:
+            response.close()
+        for reader in readers:
+            if error is not None:
+                reader.set_exception(error)
+            else:
+                reader.set_result('')
+
+class AsyncQGAPISession:
+    """ Non-blocking QualysGuard API v2 session.  Offers the connect/request/
+    disconnect surface of QGAPISession but every call returns a QGFuture.
+
+    Keyword Arguments:
+    ==================
+    pUser, pPassword, pHost -- as for QGAPISession.
+    pWorkers -- [optional] number of worker threads (settings.async_workers).
+    pPool, pLimiter -- [optional] shared QGConnectionPool / QGRateLimiter.
+    pResponseCache -- [optional] QGResponseCache for read-only requests.
+
+    Calls beyond the subscription's concurrency limit are queued by the
+    session's rate limiter rather than rejected by QualysGuard.
+    """
+    def __init__(self, pUser, pPassword, pHost=None, pWorkers=None,
+                 pPool=None, pLimiter=None, pResponseCache=None):
+        self._session = QGAPISession(pUser, pPassword, pHost, pPool, pLimiter,
+                                     pResponseCache=pResponseCache)
+        self._workers = QGWorkerPool(pWorkers)
+
+    def session(self):
+        """ Return the underlying (blocking) QGAPISession. """
+        return self._session
+
+    def connect(self):
+        """ Begin QualysGuard API Session, returns a QGFuture. """
+        return self._workers.submit(self._session.connect)
+
+    def disconnect(self):
+        """ End QualysGuard API Session, returns a QGFuture. """
+        return self._workers.submit(self._session.disconnect)
+
+    def request(self, apiReq, data=None, processor=None):
+        """ Return a QGFuture for the response from QualysGuard API.
+
+        Keyword Arguments:
+        ==================
+        apiReq -- request string from QualysGuard URL base onward.
+        data -- [optional] if provided, use HTTP POST and submit data provided.
+        processor -- [optional] XML processor (e.g. QGXP_lxml_objectify or
+                     QGXP_iter_host_detections) applied to the response stream
+                     on the worker thread; the future then holds its result.
+                     Generators are consumed into a list.
+        """
+        if processor is None:
+            return self._workers.submit(self._session.request, apiReq, data)
+        return self._workers.submit(self._process, apiReq, data, processor)
+
+    def request_stream(self, apiReq, data=None, chunk_size=None):
+        """ Return a QGAsyncStream reading the response from QualysGuard API
+        as it arrives.
+
+        Keyword Arguments:
+        ==================
+        apiReq -- request string from QualysGuard URL base onward.
+        data -- [optional] if provided, use HTTP POST and submit data provided.
+        chunk_size -- [optional] bytes per chunk (settings.stream_chunk_size).
+        """
+        return QGAsyncStream(self._workers,
+                             lambda: self._session.request_stream(apiReq, data),
+                             chunk_size)
+
+    def close(self, wait=True):
+        """ Stop the worker threads and close pooled connections. """
+        self._workers.shutdown(wait)
+        self._session.close()
+
+    def _process(self, apiReq, data, processor):
+        stream = self._session.request_stream(apiReq, data)
+        try:
+            result = processor(stream)
+            if hasattr(result, 'next'):
+                result = list(result)
+            return result
+        finally:
+            stream.close()
@@ -0,0 +1,198 @@
+""" Module providing QGDetectionColumns, a columnar store of QualysGuard host
+detection (asset/host/vm/detection/) records.
+
+  columns = QGDetectionColumns()
+  for page in qgs.iter_pages(DETECTION_REQUEST, "severities=4-5"):
+      columns.add_response(page)
+  (hosts, detections) = columns.to_numpy()
+  urgent = detections['qid'][detections['severity'] == 5]
+
+Records are streamed from xmlproc.QGXP_iter_host_detections straight into
+typed array buffers, one per field, instead of being kept as dictionaries.
+Hosts and detections are separate tables; each detection refers to its host
+by row number ('host').  Repetitive strings (STATUS, TYPE, OS, ...) are
+dictionary encoded: the column holds a small integer code and
+dictionaries()[name] maps codes back to strings.  Timestamps are seconds
+since the epoch, 0 where QualysGuard gave none.
+
+The buffers use the standard array module; to_numpy() copies them into NumPy
+arrays (optional).
+"""
+import logging
+
+from array import array
+
+from qualysconnect.ipset import parse_address
+from qualysconnect.qg.xmlproc import QGXP_iter_host_detections, QGXP_qgdt_to_epoch
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is only needed for QGDetectionColumns.to_numpy().
+    numpy = None
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+# array typecodes for unsigned 32 bit values and epoch seconds.
+_U32 = [t for t in ('I', 'L') if array(t).itemsize >= 4][0]
+_TIME = [t for t in ('l', 'd') if array(t).itemsize >= 8][0]
+
+# distinct timestamps remembered while filling the columns.
+_EPOCH_MEMO_SIZE = 65536
+
+# (column, typecode, record field, kind) of the host and detection tables.
+#  kind is 'int', 'time' or 'dict' (dictionary encoded string).
+HOST_COLUMNS = (
+    ('id', _U32, 'ID', 'int'),
+    ('ip_version', 'B', None, None),
+    ('ip', _U32, None, None),
+    ('last_scan', _TIME, 'LAST_SCAN_DATETIME', 'time'),
+    ('tracking_method', 'H', 'TRACKING_METHOD', 'dict'),
+    ('os', 'H', 'OS', 'dict'),
+)
+DETECTION_COLUMNS = (
+    ('host', _U32, None, None),
+    ('qid', _U32, 'QID', 'int'),
+    ('severity', 'B', 'SEVERITY', 'int'),
+    ('type', 'H', 'TYPE', 'dict'),
+    ('status', 'H', 'STATUS', 'dict'),
+    ('port', 'H', 'PORT', 'int'),
+    ('protocol', 'H', 'PROTOCOL', 'dict'),
+    ('times_found', _U32, 'TIMES_FOUND', 'int'),
+    ('first_found', _TIME, 'FIRST_FOUND_DATETIME', 'time'),
+    ('last_found', _TIME, 'LAST_FOUND_DATETIME', 'time'),
+    ('last_test', _TIME, 'LAST_TEST_DATETIME', 'time'),
+)
+
+def _numpy_copy(buf):
+    """ Return a NumPy array holding a copy of the array buffer buf; a view
+    would dangle once appending reallocates buf.
+    """
+    if not buf:
+        # older NumPy refuses empty buffers.
+        return numpy.zeros(0, dtype=buf.typecode)
+    return numpy.frombuffer(buf, dtype=buf.typecode).copy()
+
+class QGDetectionColumns:
+    """ Columnar host detection data, filled with add_response() or
+    add_record().  len() is the number of detections.
+    """
+    def __init__(self):
+        self.hosts = dict([(name, array(typecode))
+                           for (name, typecode, field, kind) in HOST_COLUMNS])
+        self.detections = dict([(name, array(typecode))
+                                for (name, typecode, field, kind)
+                                in DETECTION_COLUMNS])
+        # IPv6 hosts have ip 0; their address is kept here by host row.
+        self.ip6 = {}
+        # dictionary encoding: column -> list of strings, string -> code.
+        #  Code 0 is a missing value.
+        self._values = {}
+        self._codes = {}
+        for (name, typecode, field, kind) in HOST_COLUMNS + DETECTION_COLUMNS:
+            if kind == 'dict':
+                self._values[name] = [None]
+                self._codes[name] = {None: 0}
+        self._epochs = {}
+
+    def __len__(self):
+        return len(self.detections['qid'])
+
+    def host_count(self):
+        return len(self.hosts['ip'])
+
+    def add_response(self, qgXML):
+        """ Add every host of a detection response (string or file-like
+        object) and return the number of hosts added.
+        """
+        added = 0
+        for record in QGXP_iter_host_detections(qgXML):
+            self.add_record(record)
+            added += 1
+        return added
+
+    def add_record(self, record):
+        """ Add a host record as produced by QGXP_iter_host_detections. """
+        row = len(self.hosts['ip'])
+        (version, value) = parse_address(record['IP'])
+        self.hosts['ip_version'].append(version)
+        if version == 4:
+            self.hosts['ip'].append(value)
+        else:
+            self.hosts['ip'].append(0)
+            self.ip6[row] = value
+        self._append(self.hosts, HOST_COLUMNS, record)
+
+        for detect in record.get('DETECTIONS', ()):
+            self.detections['host'].append(row)
+            self._append(self.detections, DETECTION_COLUMNS, detect)
+
+    def dictionaries(self):
+        """ Return column -> list of strings, indexed by code, for the
+        dictionary encoded columns.
+        """
+        return dict([(column, list(values))
+                     for (column, values) in self._values.items()])
+
+    def decode(self, column, code):
+        """ Return the string a dictionary encoded column's code stands for
+        (None for a missing value).
+        """
+        return self._values[column][code]
+
+    def nbytes(self):
+        """ Return the size of the column buffers in bytes. """
+        return sum([len(a) * a.itemsize for table in (self.hosts, self.detections)
+                    for a in table.values()])
+
+    def to_numpy(self):
+        """ Return (hosts, detections), dictionaries of column -> NumPy array
+        holding a copy of the buffers, so records added later neither show up
+        in nor invalidate them.  detections also gets 'ip' and 'ip_version'
+        columns, the host's address per detection.
+        """
+        if numpy is None:
+            raise ImportError("QGDetectionColumns.to_numpy() requires numpy")
+        hosts = dict([(name, _numpy_copy(buf))
+                      for (name, buf) in self.hosts.items()])
+        detections = dict([(name, _numpy_copy(buf))
+                           for (name, buf) in self.detections.items()])
+        detections['ip'] = hosts['ip'][detections['host']]
+        detections['ip_version'] = hosts['ip_version'][detections['host']]
+        return (hosts, detections)
+
+    def _append(self, table, columns, record):
+        for (name, typecode, field, kind) in columns:
+            if field is None:
+                continue
+            text = record.get(field)
+            if kind == 'int':
+                value = text and int(text) or 0
+            elif kind == 'time':
+                value = self._epoch(text)
+            else:
+                value = self._code(name, text)
+            table[name].append(value)
+
+    def _epoch(self, qgdt):
+        if not qgdt:
+            return 0
+        epoch = self._epochs.get(qgdt)
+        if epoch is None:
+            if len(self._epochs) >= _EPOCH_MEMO_SIZE:
+                self._epochs.clear()
+            epoch = self._epochs[qgdt] = QGXP_qgdt_to_epoch((qgdt,))[0]
+        return epoch
+
+    def _code(self, column, text):
+        codes = self._codes[column]
+        code = codes.get(text)
+        if code is None:
+            values = self._values[column]
+            code = codes[text] = len(values)
+            values.append(text)
+        return code
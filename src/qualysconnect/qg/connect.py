@@ -6,25 +6,188 @@ import urllib2
 import cookielib
 import logging
 import base64
+import urlparse
+import threading
+
+import qualysconnect.settings as qcs
 
 from urllib2 import HTTPPasswordMgrWithDefaultRealm, HTTPBasicAuthHandler
 from urllib2 import HTTPCookieProcessor
 
 from qualysconnect import __version__ as VERSION
+from qualysconnect.qg.pool import QGConnectionPool, QGKeepAliveHandler
+from qualysconnect.qg.ratelimit import QGRateLimiter
+from qualysconnect.qg.retry import QGRetryPolicy
+from qualysconnect.qg.xmlproc import QGXP_truncation_url
 
 __author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
 __copyright__ = "Copyright 2011-2013, University of Waterloo"
 __license__ = "BSD-new"
 
+class _QGPrefetch(threading.Thread):
+    """ Background thread that calls func(*args) and keeps the outcome until
+    result() is called.
+    """
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._func = func
+        self._args = args
+        self._result = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self._func(*self._args)
+        except Exception, e:
+            self._error = e
+
+    def result(self):
+        """ Wait for the call to finish and return (or raise) its outcome. """
+        self.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+class _QGLimitedResponse:
+    """ File-like wrapper of a urllib2 response that holds its rate limiter
+    concurrency slot until the body has been read to the end or the
+    response is closed.  Only used where the body is read at once (see
+    QGConnector._open_request).
+    """
+    def __init__(self, response, limiter):
+        self._response = response
+        self._limiter = limiter
+        self._lock = threading.Lock()
+        self._released = False
+        self.code = response.code
+        self.msg = response.msg
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self._response.read()
+            self._release()
+        else:
+            data = self._response.read(amt)
+            if not data and amt:
+                self._release()
+        return data
+
+    def readline(self, size=-1):
+        line = self._response.readline(size)
+        if not line:
+            self._release()
+        return line
+
+    def readlines(self, sizehint=0):
+        lines = self._response.readlines(sizehint)
+        self._release()
+        return lines
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+    def info(self):
+        return self._response.info()
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self._response.geturl()
+
+    def fileno(self):
+        return self._response.fileno()
+
+    def close(self):
+        try:
+            self._response.close()
+        finally:
+            self._release()
+
+    def __del__(self):
+        # a response dropped without being closed must not keep its slot.
+        self._release()
+
+    def _release(self):
+        self._lock.acquire()
+        try:
+            if self._released:
+                return
+            self._released = True
+        finally:
+            self._lock.release()
+        self._limiter.release(self._response.info())
+
+class _QGTailStream:
+    """ File-like wrapper that remembers the first head_bytes read, where a
+    v2 response has its DATETIME, and the last tail_bytes, where a v2 list
+    response keeps its truncation WARNING.
+    """
+    def __init__(self, stream, head_bytes=4096, tail_bytes=64 * 1024):
+        self._stream = stream
+        self._head_bytes = head_bytes
+        self._tail_bytes = tail_bytes
+        self._head = ''
+        self._tail = ''
+
+    def read(self, amt=None):
+        if amt is None:
+            data = self._stream.read()
+        else:
+            data = self._stream.read(amt)
+        if data:
+            if len(self._head) < self._head_bytes:
+                self._head = (self._head + data)[:self._head_bytes]
+            self._tail = (self._tail + data)[-self._tail_bytes:]
+        return data
+
+    def head(self):
+        return self._head
+
+    def tail(self):
+        return self._tail
+
+    def close(self):
+        self._stream.close()
+
 class QGConnector:
     """ Base class that provides common connection functionality for
     QualysConnect QualysGuard API.
+
+    Requests are sent over persistent (keep-alive) connections drawn from a
+    QGConnectionPool and scheduled by a QGRateLimiter that honours the rate
+    and concurrency limits QualysGuard returns.  Transient failures of
+    idempotent requests are retried according to a QGRetryPolicy.  Pass
+    pPool, pLimiter and pRetry to share them between connectors.  Given a
+    QGResponseCache (pResponseCache), request() answers cacheable read-only
+    requests from it.
     """
-    def __init__(self, pAPIVer, pHost="qualysapi.qualys.com"):
+    def __init__(self, pAPIVer, pHost="qualysapi.qualys.com", pPool=None,
+                 pLimiter=None, pRetry=None, pResponseCache=None):
         self._APIVersion = pAPIVer
         self._APIHost = pHost
         self._opener = None  # None reference stub for common 'request' handle
         self.logger = logging.getLogger(__name__)
+
+        if pPool is None:
+            pPool = QGConnectionPool()
+        self._pool = pPool
+        if pLimiter is None:
+            pLimiter = QGRateLimiter()
+        self._limiter = pLimiter
+        if pRetry is None:
+            pRetry = QGRetryPolicy()
+        self._retry = pRetry
+        self._responses = pResponseCache
         
         # Based on the provided API Version number and hostname,
         # calculate the API URI that we should use to request from QualysGuard.
@@ -39,11 +202,18 @@ class QGConnector:
         self.logger.info("Connecting to URI (%s) with APIv(%d)"%
                      (self._APIURI,self._APIVersion))
 
-    def _generate_request(self,apiReq,data=None):
+    def _generate_request(self,apiReq,data=None,extra_headers=None):
         """ Returns a urllib2.Request object for this connector's API URI and
         API Version combination.
         """
         headers = {"X-Requested-With":"uWaterloo QualysConnect (python) v%s"%(VERSION,)}
+        if (data is None and self._APIVersion == 2 and
+            len(self.apiURI()) + len(apiReq) > qcs.max_url_length):
+            # long parameter lists (e.g. ips=) go in a POST body instead.
+            (apiReq, sep, data) = apiReq.partition('?')
+            self.logger.debug("Request too long for URL, sending as POST.")
+        if extra_headers:
+            headers.update(extra_headers)
         if self._APIVersion == 2 and self.__class__.__name__ == 'QGAPIConnect':
             #Basic Auth connector to QualysGuard API v2
             headers["Authorization"] = "Basic %s" % self._base64string
@@ -70,6 +240,46 @@ class QGConnector:
         believes it is interacting with.
         """
         return self._APIVersion
+
+    def pool_stats(self):
+        """ Return hit/miss/eviction counters of this connector's connection
+        pool.
+        """
+        return self._pool.stats()
+
+    def rate_limit_stats(self):
+        """ Return the current rate limit budget and wait time counters of
+        this connector's scheduler.
+        """
+        return self._limiter.stats()
+
+    def retry_stats(self):
+        """ Return retry and backoff counters of this connector. """
+        return self._retry.stats()
+
+    def retry_policy(self):
+        """ Return the QGRetryPolicy deciding which failed requests are
+        retried.
+        """
+        return self._retry
+
+    def response_cache_stats(self):
+        """ Return hit/miss/bytes saved counters of this connector's response
+        cache, or None if it has none.
+        """
+        if self._responses is None:
+            return None
+        return self._responses.stats()
+
+    def close(self):
+        """ Close all idle pooled connections held by this connector. """
+        self._pool.close()
+
+    def _keepalive_handler(self):
+        """ Return a urllib2 handler that sends requests through this
+        connector's connection pool.
+        """
+        return QGKeepAliveHandler(self._pool)
     
     def build_request(self,apiReq,data=None):
         """ Build and return the HTTP opener to the QualysGuard API w/ the
@@ -80,10 +290,57 @@ class QGConnector:
         apiReq -- request string from QualysGuard URL base onward.
         data -- [optional] if provided, use HTTP POST and submit data provided.
         """
-        qualysRequest = self._generate_request(apiReq,data)
+        return self._retry.call(apiReq, data, self._open_request, apiReq, data)
+
+    def open_request(self, apiReq, data=None, headers=None):
+        """ Open the request once, without retrying, and return the response
+        as a file-like object.  Callers must close() it (or read it to the
+        end) to release the connection.
+
+        Keyword Arguments:
+        ==================
+        apiReq -- request string from QualysGuard URL base onward.
+        data -- [optional] if provided, use HTTP POST and submit data provided.
+        headers -- [optional] dictionary of extra HTTP headers (e.g. Range).
+        """
+        return self._open_request(apiReq, data, headers)
+
+    def _open_request(self, apiReq, data, headers=None, hold=False):
+        """ Open the request once, waiting on the rate limiter as needed.
+
+        The concurrency slot is returned once the response headers arrive,
+        so streams left open by the caller cannot starve its next request.
+        With hold set, the response keeps its slot until it is read to the
+        end or closed; only for callers that read the body straight away.
+        """
+        qualysRequest = self._generate_request(apiReq,data,headers)
         self.logger.debug("QGC-build_request| %s, %s"%(str(apiReq), str(data)))
-        request_opener = self._opener.open(qualysRequest)
-        return request_opener
+
+        attempt = 0
+        while True:
+            self._limiter.acquire()
+            try:
+                request_opener = self._opener.open(qualysRequest,
+                                                   timeout=qcs.request_timeout)
+            except urllib2.HTTPError, e:
+                throttled = (e.code == 409)
+                self._limiter.release(e.info(), throttled)
+                if throttled:
+                    e.close()
+                    if attempt < qcs.ratelimit_retries:
+                        attempt += 1
+                        self.logger.info("Throttled by QualysGuard, retry %d "
+                                         "of %d"%(attempt,
+                                                  qcs.ratelimit_retries))
+                        continue
+                raise
+            except:
+                self._limiter.release()
+                raise
+            if hold:
+                return _QGLimitedResponse(request_opener, self._limiter)
+            self._limiter.release(request_opener.info())
+            return request_opener
     
     def request(self, apiReq, data=None):
         """ Return the response from QualysGuard API for the provided request.
@@ -93,8 +350,179 @@ class QGConnector:
         apiReq -- request string from QualysGuard URL base onward.
         data -- [optional] if provided, use HTTP POST and submit data provided.
         """
-        request = self.build_request(apiReq, data)
-        return request.read()
+        if self._responses is not None:
+            ttl = self._responses.ttl(apiReq, data)
+            if ttl:
+                return self._cached_request(apiReq, data, ttl)
+        return self._retry.call(apiReq, data, self._read_request, apiReq, data)
+
+    def _read_request(self, apiReq, data):
+        """ Open the request once and read the complete response. """
+        request = self._open_request(apiReq, data, hold=True)
+        try:
+            return request.read()
+        finally:
+            request.close()
+
+    def _read_response(self, apiReq, data, headers):
+        """ Open the request once, return the complete response and its
+        headers.
+        """
+        request = self._open_request(apiReq, data, headers, hold=True)
+        try:
+            return (request.read(), request.info())
+        finally:
+            request.close()
+
+    def _cached_request(self, apiReq, data, ttl):
+        """ request() through the response cache: answer from a fresh entry,
+        revalidate a stale one or fetch and store the response.
+        """
+        key = self._responses.key(self.apiURI(), apiReq, data)
+        entry = self._responses.get(key)
+        if entry is not None and entry.fresh():
+            self._responses.count(True, entry)
+            return entry.body
+
+        headers = None
+        if entry is not None:
+            headers = entry.validators()
+        try:
+            (body, info) = self._retry.call(apiReq, data, self._read_response,
+                                            apiReq, data, headers)
+        except urllib2.HTTPError, e:
+            if e.code != 304 or not headers:
+                raise
+            e.close()
+            self.logger.debug("QGC-request| %s not modified"%(apiReq,))
+            self._responses.put(key, entry.body, ttl, e.info(), entry)
+            self._responses.count(True, entry, revalidated=True)
+            return entry.body
+
+        self._responses.put(key, body, ttl, info)
+        self._responses.count(False)
+        return body
+
+    def request_stream(self, apiReq, data=None, headers=None):
+        """ Return a file-like object reading the response from QualysGuard
+        API for the provided request straight off the socket.  Callers must
+        close() it (or read it to the end) to release the connection.
+
+        Keyword Arguments:
+        ==================
+        apiReq -- request string from QualysGuard URL base onward.
+        data -- [optional] if provided, use HTTP POST and submit data provided.
+        headers -- [optional] dictionary of extra HTTP headers (e.g. Range).
+        """
+        return self._retry.call(apiReq, data, self._open_request,
+                                apiReq, data, headers)
+
+    def iter_pages(self, apiReq, data=None, prefetch=True):
+        """ Generator yielding each page of a v2 list response (e.g.
+        asset/host/?action=list, asset/host/vm/detection/?action=list,
+        scan/?action=list).  Truncated responses are followed automatically
+        through the URL QualysGuard returns in the response WARNING.
+
+        When prefetch is True, page N+1 is requested in the background while
+        the caller processes page N.
+
+        Keyword Arguments:
+        ==================
+        apiReq -- request string from QualysGuard URL base onward.
+        data -- [optional] if provided, use HTTP POST and submit data provided
+                for the first page.
+        prefetch -- [optional] fetch the next page while yielding the current.
+        """
+        (page, nextReq) = self._fetch_page(apiReq, data)
+        pages = 1
+        while True:
+            pending = None
+            if nextReq and prefetch:
+                pending = _QGPrefetch(self._fetch_page, nextReq, None)
+
+            yield page
+
+            if not nextReq:
+                self.logger.debug("QGC-iter_pages| %d page(s) for %s"%
+                                  (pages, apiReq))
+                return
+            if pending:
+                (page, nextReq) = pending.result()
+            else:
+                (page, nextReq) = self._fetch_page(nextReq, None)
+            pages += 1
+
+    def iter_page_streams(self, apiReq, data=None):
+        """ Generator yielding each page of a v2 list response as a file-like
+        object read straight off the socket (see request_stream), following
+        truncation like iter_pages.  Read each page as it is yielded; what
+        is left unread is skipped when the next page is requested.  A page's
+        head() returns the first bytes read from it (e.g. for
+        xmlproc.QGXP_response_datetime).
+
+        Keyword Arguments:
+        ==================
+        apiReq -- request string from QualysGuard URL base onward.
+        data -- [optional] if provided, use HTTP POST and submit data provided
+                for the first page.
+        """
+        pages = 0
+        while apiReq:
+            stream = _QGTailStream(self.request_stream(apiReq, data))
+            try:
+                yield stream
+                while stream.read(qcs.stream_chunk_size):
+                    pass
+            finally:
+                stream.close()
+            pages += 1
+            apiReq = self._next_page_request(QGXP_truncation_url(stream.tail()))
+            data = None
+        self.logger.debug("QGC-iter_page_streams| %d page(s)"%(pages,))
+
+    def _fetch_page(self, apiReq, data):
+        """ Return a tuple of (response, next page request or None). """
+        page = self.request(apiReq, data)
+        return (page, self._next_page_request(QGXP_truncation_url(page)))
+
+    def _next_page_request(self, url):
+        """ Convert an absolute truncation URL returned by QualysGuard into a
+        request string relative to this connector's API URI.
+        """
+        if not url:
+            return None
+        base = urlparse.urlsplit(self.apiURI()).path
+        (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        if not path.startswith(base):
+            raise Exception("Truncation URL (%s) is outside of API URI (%s)"
+                            %(url, self.apiURI()))
+        apiReq = path[len(base):]
+        if query:
+            apiReq = "%s?%s"%(apiReq, query)
+        self.logger.info("Response truncated, following to (%s)"%(apiReq,))
+        return apiReq
+
+    def iter_request(self, apiReq, data=None, chunk_size=None):
+        """ Generator yielding the response from QualysGuard API for the
+        provided request in chunks of at most chunk_size bytes.
+
+        Keyword Arguments:
+        ==================
+        apiReq -- request string from QualysGuard URL base onward.
+        data -- [optional] if provided, use HTTP POST and submit data provided.
+        chunk_size -- [optional] bytes per chunk (settings.stream_chunk_size).
+        """
+        if chunk_size is None:
+            chunk_size = qcs.stream_chunk_size
+        stream = self.request_stream(apiReq, data)
+        try:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            stream.close()
 
 class QGAPIConnect(QGConnector):
     """ Qualys Connection class which allows requests to the QualysGuard API
@@ -105,19 +533,23 @@ class QGAPIConnect(QGConnector):
     - Remote certificate verification is not supported.
     - This only currently functions with API v1 (not sure why).
     """
-    def __init__(self, pUser, pPassword, pHost=None, pApiVer=1):
+    def __init__(self, pUser, pPassword, pHost=None, pApiVer=1, pPool=None,
+                 pLimiter=None, pRetry=None, pResponseCache=None):
 
         # If provided a hostname, call base class with it.  Otherwise, use
         #  'default' hostname defined in QGConnector constructor.
         if not pHost:
-            QGConnector.__init__(self, pApiVer) 
+            QGConnector.__init__(self, pApiVer, pPool=pPool, pLimiter=pLimiter,
+                                 pRetry=pRetry, pResponseCache=pResponseCache)
         else:
-            QGConnector.__init__(self, pApiVer, pHost)
+            QGConnector.__init__(self, pApiVer, pHost, pPool, pLimiter, pRetry,
+                                 pResponseCache)
 
         # Setup password manager and HTTPBasicAuthHandler
         self._passman = HTTPPasswordMgrWithDefaultRealm()
         self._passman.add_password(None, self.apiURI(), pUser, pPassword)
-        self._opener = urllib2.build_opener(HTTPBasicAuthHandler(self._passman))
+        self._opener = urllib2.build_opener(HTTPBasicAuthHandler(self._passman),
+                                            self._keepalive_handler())
 
         # Store base64 encoded username & password for API v2.
         self._base64string = base64.encodestring('%s:%s' % (pUser,pPassword)).replace('\n', '')
@@ -126,32 +558,85 @@ class QGAPISession(QGConnector):
     """ Qualys Connection class which allows requests to the QualysGuard API
     using Session Authentication.
 
+    If given a QGSessionCache (pSessionCache), connect() reuses a session
+    cookie left by an earlier process and disconnect() keeps the session
+    open for the next one.  Requests rejected because the session expired
+    log in again transparently.
+
     Notes:
     ======
     - Remote certificate verification is not supported.
     """
-    def __init__(self, pUser, pPassword, pHost=None):
+    def __init__(self, pUser, pPassword, pHost=None, pPool=None,
+                 pLimiter=None, pSessionCache=None, pRetry=None,
+                 pResponseCache=None):
 
         # If provided a hostname, call base class with it.  Otherwise, use
         #  'default' hostname defined in QGConnector constructor.
         if not pHost:
-            QGConnector.__init__(self, 2) 
+            QGConnector.__init__(self, 2, pPool=pPool, pLimiter=pLimiter,
+                                 pRetry=pRetry, pResponseCache=pResponseCache)
         else:
-            QGConnector.__init__(self, 2, pHost)
+            QGConnector.__init__(self, 2, pHost, pPool, pLimiter, pRetry,
+                                 pResponseCache)
 
         # Configure cookie handling and install capable 
         self._user = pUser;
         self._password = pPassword;
         self._cj = cookielib.CookieJar()
-        self._opener = urllib2.build_opener(HTTPCookieProcessor(self._cj))
+        self._cache = pSessionCache
+        self._connected = False
+        self._opener = urllib2.build_opener(HTTPCookieProcessor(self._cj),
+                                            self._keepalive_handler())
         #NOT-REQUIRED?# urllib2.install_opener(self._opener)
 
     def connect(self):
-        """ Begin QualysGuard API Session (get session cookie). """
-        return self.request("session/",
-                            "action=login&username=%s&password=%s"
-                               %(self._user,self._password))
+        """ Begin QualysGuard API Session (get session cookie).  Returns the
+        login response, or None if a cached session was reused.
+        """
+        self._connected = True
+        if self._cache and self._cache.load(self._cj):
+            self.logger.info("Reusing cached session from %s"%
+                             (self._cache.get_filename(),))
+            return None
+        return self._login()
 
     def disconnect(self):
-        """ End QualysGuard API Session (invalidate session cookie). """
+        """ End QualysGuard API Session (invalidate session cookie).  With a
+        session cache the session is kept open and saved for reuse instead.
+        """
+        self._connected = False
+        if self._cache:
+            self._cache.save(self._cj)
+            return None
+        return self.logout()
+
+    def logout(self):
+        """ Invalidate the session cookie (and any cached copy of it). """
+        self._connected = False
+        if self._cache:
+            self._cache.clear()
         return self.request("session/","action=logout")
+
+    def _open_request(self, apiReq, data, headers=None, hold=False):
+        """ Open the request once, logging in again if the session has
+        expired.
+        """
+        try:
+            return QGConnector._open_request(self, apiReq, data, headers, hold)
+        except urllib2.HTTPError, e:
+            if e.code != 401 or not self._connected or apiReq.startswith("session/"):
+                raise
+            e.close()
+        self.logger.info("Session expired, logging in again.")
+        self._cj.clear()
+        self._login()
+        return QGConnector._open_request(self, apiReq, data, headers, hold)
+
+    def _login(self):
+        ret = self.request("session/",
+                           "action=login&username=%s&password=%s"
+                              %(self._user,self._password))
+        if self._cache:
+            self._cache.save(self._cj)
+        return ret
@@ -0,0 +1,149 @@
+""" Module providing a parallel, IP range sharded fetch of QualysGuard host
+detection (asset/host/vm/detection/) records.
+"""
+import time
+import Queue
+import logging
+import threading
+
+import qualysconnect.settings as qcs
+
+from qualysconnect.util import shard_ip_string, split_ip_string
+from qualysconnect.ipset import parse_address
+from qualysconnect.qg.xmlproc import QGXP_iter_host_detections
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+DETECTION_REQUEST = "asset/host/vm/detection/?action=list"
+
+def _address_key(record):
+    return parse_address(record['IP'])
+
+class QGShardedDetectionFetch:
+    """ Fetch host detections for a large set of IPs by splitting it into
+    shards of balanced address count and requesting the shards concurrently
+    over a single QGConnector (normally a QGAPISession).
+
+    Keyword Arguments:
+    ==================
+    connector -- connected QGConnector used for every request.
+    concurrency -- [optional] maximum number of shard requests in flight.
+                   Keep at or below the subscription's concurrency limit
+                   (settings.concurrency_limit).
+    shards -- [optional] number of shards to split the IPs into (default is
+              the concurrency).
+    params -- [optional] extra detection API parameters
+              (e.g. "status=New,Active&severities=4-5").
+    """
+    def __init__(self, connector, concurrency=None, shards=None, params=None):
+        if concurrency is None:
+            concurrency = qcs.concurrency_limit
+        if concurrency < 1:
+            raise ValueError("concurrency must be at least 1")
+        self._connector = connector
+        self._concurrency = concurrency
+        self._shards = shards or concurrency
+        self._params = params
+
+    def fetch(self, ips):
+        """ Generator yielding host detection records (as produced by
+        QGXP_iter_host_detections) for ips, in address order.
+
+        Shards (contiguous address ranges) are fetched concurrently.
+        QualysGuard does not return a shard's hosts in address order, so the
+        shard being yielded is read in full and sorted first; later shards
+        buffer at most settings.detection_shard_buffer records each until
+        their turn.  More shards (see shards) mean smaller sorts.
+
+        Keyword Arguments:
+        ==================
+        ips -- ips string as returned by util.decode_ip_string.
+        """
+        # shards larger than the per request budgets are split further.
+        shards = [chunk for shard in shard_ip_string(ips, self._shards)
+                  for chunk in split_ip_string(shard)]
+        if not shards:
+            return
+
+        tasks = Queue.Queue()
+        for (n, shard) in enumerate(shards):
+            tasks.put((n, shard))
+        # per shard: (True, record) items, then (True, None) or (False, error)
+        buffers = [Queue.Queue(qcs.detection_shard_buffer) for shard in shards]
+        stop = threading.Event()
+
+        def put(buf, item):
+            # give up once the consumer has stopped reading.
+            while not stop.is_set():
+                try:
+                    buf.put(item, timeout=0.5)
+                    return True
+                except Queue.Full:
+                    pass
+            return False
+
+        def worker():
+            while not stop.is_set():
+                try:
+                    (n, shard) = tasks.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    for record in self._fetch_shard(n, shard):
+                        if not put(buffers[n], (True, record)):
+                            return
+                    outcome = (True, None)
+                except Exception, e:
+                    outcome = (False, e)
+                if not put(buffers[n], outcome):
+                    return
+
+        workers = [threading.Thread(target=worker)
+                   for w in range(min(self._concurrency, len(shards)))]
+        for w in workers:
+            w.daemon = True
+            w.start()
+
+        # shards are taken in order, so the one being read always has (or
+        #  had) a worker and later shards blocking on full buffers cannot
+        #  stall it.
+        try:
+            for n in range(len(shards)):
+                records = []
+                while True:
+                    (ok, record) = buffers[n].get()
+                    if not ok:
+                        raise record
+                    if record is None:
+                        break
+                    records.append(record)
+                buffers[n] = None
+                records.sort(key=_address_key)
+                for record in records:
+                    yield record
+                del records
+        finally:
+            stop.set()
+
+    def _fetch_shard(self, n, shard):
+        """ Generator yielding the host records of one shard, parsed as each
+        page streams in.
+        """
+        start = time.time()
+        data = "ips=%s"%(shard,)
+        if self._params:
+            data = "%s&%s"%(data, self._params)
+
+        hosts = 0
+        for stream in self._connector.iter_page_streams(DETECTION_REQUEST,
+                                                        data):
+            for record in QGXP_iter_host_detections(stream):
+                hosts += 1
+                yield record
+
+        logger.info("Shard %d: %d host(s) in %.1fs"%
+                    (n, hosts, time.time() - start))
@@ -0,0 +1,320 @@
+""" Module providing QGDetectionCache, a local SQLite store of QualysGuard host
+detection (asset/host/vm/detection/) records.
+
+  cache = QGDetectionCache()
+  cache.sync(qgs)                  # full pull when cold, incremental after
+  record = cache.host("10.0.0.1")  # answered locally
+
+sync() remembers when it last ran and afterwards only requests hosts whose
+vulnerability data QualysGuard processed since (vm_processed_after), replacing
+their rows and dropping those left without matching detections.  Records have
+the same shape as those from xmlproc.QGXP_iter_host_detections.
+
+Syncs with detection API params (e.g. "severities=5") hold filtered detection
+lists, so their records are kept apart from the unfiltered ones: pass the same
+params string to host(), hosts() and hosts_with_qid() to read them.
+"""
+import os
+import time
+import json
+import logging
+import struct
+import sqlite3
+
+import qualysconnect.settings as qcs
+
+from qualysconnect.ipset import IPSet, parse_address, parse_token
+from qualysconnect.qg.detection import DETECTION_REQUEST
+from qualysconnect.qg.xmlproc import QGXP_iter_host_detections, QGXP_iter_hostlist
+from qualysconnect.qg.xmlproc import QGXP_response_datetime, QGXP_qgdt_to_epoch
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+HOST_LIST_REQUEST = "asset/host/?action=list"
+
+# Bumped when the tables change; older caches are emptied on open.
+_SCHEMA_VERSION = 2
+
+# params is the detection filter of the sync that stored the row ('' for
+#  none); each filter keeps its own copy of a host.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    params TEXT NOT NULL,
+    ip_key BLOB NOT NULL,
+    ip TEXT NOT NULL,
+    last_scan_datetime TEXT,
+    record TEXT NOT NULL,
+    PRIMARY KEY (params, ip_key)
+);
+CREATE INDEX IF NOT EXISTS hosts_last_scan ON hosts (last_scan_datetime);
+CREATE TABLE IF NOT EXISTS detections (
+    params TEXT NOT NULL,
+    ip_key BLOB NOT NULL,
+    qid INTEGER NOT NULL,
+    record TEXT NOT NULL,
+    PRIMARY KEY (params, ip_key, qid)
+);
+CREATE INDEX IF NOT EXISTS detections_qid ON detections (params, qid);
+CREATE TABLE IF NOT EXISTS sync (
+    scope TEXT PRIMARY KEY,
+    processed_after TEXT NOT NULL
+);
+"""
+
+def _key(version, value):
+    """ Return a BLOB that sorts like the address (IPv4 before IPv6). """
+    if version == 4:
+        return buffer(struct.pack('!BI', 4, value))
+    return buffer(struct.pack('!BQQ', 6, value >> 64, value & 0xFFFFFFFFFFFFFFFF))
+
+def _ip_key(ip):
+    return _key(*parse_address(ip))
+
+class QGDetectionCache:
+    """ SQLite backed cache of host detection records.
+
+    Keyword Arguments:
+    ==================
+    filename -- [optional] database file, defaults to
+                ~/<settings.detection_cache_filename>.  ':memory:' keeps the
+                cache in memory.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(os.getenv("HOME"),
+                                    qcs.detection_cache_filename)
+        self._filename = filename
+        self._db = sqlite3.connect(filename)
+        (version,) = self._db.execute("PRAGMA user_version").fetchone()
+        if version != _SCHEMA_VERSION:
+            # the cache can always be pulled again, start it over.
+            for table in ('hosts', 'detections', 'sync'):
+                self._db.execute("DROP TABLE IF EXISTS %s"%(table,))
+            self._db.execute("PRAGMA user_version = %d"%(_SCHEMA_VERSION,))
+        self._db.executescript(_SCHEMA)
+        self._db.commit()
+
+    def get_filename(self):
+        return self._filename
+
+    def close(self):
+        self._db.close()
+
+    def last_sync(self, ips=None, params=None):
+        """ Return the vm_processed_after value the next sync of this scope
+        will use, or None if the scope was never synced (the cache is cold).
+        """
+        row = self._db.execute("SELECT processed_after FROM sync WHERE scope=?",
+                               (self._scope(ips, params),)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def sync(self, connector, ips=None, params=None, full=False):
+        """ Bring the cache up to date from QualysGuard and return the number
+        of host records stored.  The first sync of a scope (or one with full
+        set) pulls every host, later ones only hosts processed since the
+        previous sync started (less settings.detection_cache_sync_margin).
+
+        Hosts QualysGuard processed that no longer have a detection matching
+        the scope (e.g. all fixed) are not in the detection response; they
+        are dropped from the cache.  Syncs with different params store
+        separate records; read them back with the same params.
+
+        Keyword Arguments:
+        ==================
+        connector -- connected QGAPISession.
+        ips -- [optional] ips string limiting the hosts cached.
+        params -- [optional] extra detection API parameters
+                  (e.g. "status=New,Active&severities=3-5").
+        full -- [optional] ignore the previous sync and pull every host.
+        """
+        scope = self._scope(ips, params)
+        # QualysGuard's clock, from the first response; ours until then.
+        started = None
+        local_start = time.time()
+
+        parts = []
+        if ips:
+            parts.append("ips=%s"%(ips,))
+        if params:
+            parts.append(params)
+        since = None
+        if not full:
+            since = self.last_sync(ips, params)
+        if since:
+            parts.append("vm_processed_after=%s"%(since,))
+            logger.info("Incremental detection sync since %s"%(since,))
+        else:
+            logger.info("Full detection sync (cold cache).")
+
+        stored = set()
+        try:
+            for stream in connector.iter_page_streams(DETECTION_REQUEST,
+                                                      "&".join(parts) or None):
+                for record in QGXP_iter_host_detections(stream):
+                    self.store(record, params)
+                    stored.add(str(_ip_key(record['IP'])))
+                if started is None:
+                    started = QGXP_response_datetime(stream.head())
+            dropped = self._drop_unreturned(connector, ips, params, since,
+                                            stored)
+            self._db.execute("INSERT OR REPLACE INTO sync VALUES (?, ?)",
+                             (scope, self._processed_after(started,
+                                                           local_start)))
+            self._db.commit()
+        except:
+            self._db.rollback()
+            raise
+        logger.info("Stored %d host(s), dropped %d from %s"%
+                    (len(stored), dropped, self._filename))
+        return len(stored)
+
+    def _drop_unreturned(self, connector, ips, params, since, stored):
+        """ Delete the cached hosts (stored with params) the sync should have
+        returned but did not (their detections no longer match).  Returns how
+        many.
+        """
+        if since:
+            # hosts processed since the last sync, from the host list.
+            parts = ["vm_processed_after=%s"%(since,)]
+            if ips:
+                parts.append("ips=%s"%(ips,))
+            candidates = set()
+            for stream in connector.iter_page_streams(HOST_LIST_REQUEST,
+                                                      "&".join(parts)):
+                for token in QGXP_iter_hostlist(stream):
+                    (version, start, end) = parse_token(token)
+                    if start == end:
+                        candidates.add(str(_key(version, start)))
+        else:
+            # a full sync returns every host of the scope.
+            candidates = set([str(key) for (key,) in
+                              self._keys(ips, params,
+                                         "SELECT ip_key FROM hosts")])
+        params = params or ''
+        dropped = 0
+        for key in candidates - stored:
+            if self._db.execute("SELECT 1 FROM hosts WHERE params=? AND "
+                                "ip_key=?", (params, buffer(key))
+                                ).fetchone() is None:
+                continue
+            self._db.execute("DELETE FROM hosts WHERE params=? AND ip_key=?",
+                             (params, buffer(key)))
+            self._db.execute("DELETE FROM detections WHERE params=? AND "
+                             "ip_key=?", (params, buffer(key)))
+            dropped += 1
+        return dropped
+
+    def _processed_after(self, started, local_start):
+        """ Return the vm_processed_after of the next sync: when this one
+        started, by QualysGuard's clock if known, less a safety margin.
+        """
+        if started is not None:
+            try:
+                (start,) = QGXP_qgdt_to_epoch((started,))
+            except ValueError:
+                start = local_start
+        else:
+            start = local_start
+        return time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                             time.gmtime(start - qcs.detection_cache_sync_margin))
+
+    def store(self, record, params=None):
+        """ Replace the cached host record (and its detections) with record,
+        as produced by QGXP_iter_host_detections from a request with the
+        detection API params given.  Call commit() afterwards.
+        """
+        params = params or ''
+        key = _ip_key(record['IP'])
+        host = dict(record)
+        detections = host.pop('DETECTIONS', [])
+        self._db.execute("INSERT OR REPLACE INTO hosts VALUES (?, ?, ?, ?, ?)",
+                         (params, key, record['IP'],
+                          record.get('LAST_SCAN_DATETIME'), json.dumps(host)))
+        self._db.execute("DELETE FROM detections WHERE params=? AND ip_key=?",
+                         (params, key))
+        self._db.executemany("INSERT OR REPLACE INTO detections "
+                             "VALUES (?, ?, ?, ?)",
+                             [(params, key, int(detect['QID']),
+                               json.dumps(detect)) for detect in detections])
+
+    def commit(self):
+        self._db.commit()
+
+    def host(self, ip, params=None):
+        """ Return the cached record for ip (as stored by a sync with params),
+        or None if it is not cached.
+        """
+        key = _ip_key(ip)
+        row = self._db.execute("SELECT record FROM hosts WHERE params=? AND "
+                               "ip_key=?", (params or '', key)).fetchone()
+        if row is None:
+            return None
+        return self._record(params, key, row[0])
+
+    def hosts(self, ips=None, params=None):
+        """ Generator yielding the cached records (as stored by syncs with
+        params) in IP address order, for every host or only those in ips (an
+        ips string or IPSet).
+        """
+        for (key, record) in self._keys(ips, params,
+                                        "SELECT ip_key, record FROM hosts"):
+            yield self._record(params, key, record)
+
+    def hosts_with_qid(self, qid, params=None):
+        """ Return the IPs of cached hosts (as stored by syncs with params)
+        with a detection of qid.
+        """
+        return [row[0] for row in
+                self._db.execute("SELECT hosts.ip FROM detections JOIN hosts "
+                                 "USING (params, ip_key) WHERE params=? AND "
+                                 "qid=? ORDER BY ip_key",
+                                 (params or '', int(qid)))]
+
+    def stats(self):
+        """ Return a dictionary of cache size metrics. """
+        return {'hosts': self._db.execute("SELECT COUNT(*) FROM hosts").fetchone()[0],
+                'detections': self._db.execute("SELECT COUNT(*) FROM detections").fetchone()[0],
+                'synced_scopes': self._db.execute("SELECT COUNT(*) FROM sync").fetchone()[0]}
+
+    def clear(self):
+        """ Drop every cached record and sync time. """
+        for table in ('hosts', 'detections', 'sync'):
+            self._db.execute("DELETE FROM %s"%(table,))
+        self._db.commit()
+
+    def _record(self, params, key, host):
+        record = json.loads(host)
+        record['DETECTIONS'] = [json.loads(row[0]) for row in
+                                self._db.execute("SELECT record FROM detections "
+                                                 "WHERE params=? AND ip_key=? "
+                                                 "ORDER BY qid",
+                                                 (params or '', key))]
+        return record
+
+    def _keys(self, ips, params, select):
+        """ Return the rows of select (on hosts) stored with params for every
+        host or those in ips (an ips string or IPSet), in IP address order.
+        """
+        if ips is None:
+            ranges = [(buffer(chr(0)), buffer(chr(255)))]
+        else:
+            if not isinstance(ips, IPSet):
+                ips = IPSet.parse(ips)
+            ranges = [(_key(version, start), _key(version, end))
+                      for (version, start, end) in ips.intervals()]
+        rows = []
+        for (low, high) in ranges:
+            rows.extend(self._db.execute("%s WHERE params=? AND ip_key "
+                                         "BETWEEN ? AND ? ORDER BY ip_key"%
+                                         (select,),
+                                         (params or '', low, high)).fetchall())
+        return rows
+
+    def _scope(self, ips, params):
+        return "ips=%s&%s"%(ips or '', params or '')
@@ -0,0 +1,182 @@
+""" Module providing QGDownload, a resumable download of a QualysGuard API
+response (typically report/?action=fetch) straight to disk.
+
+The response is written in fixed size chunks to '<filename>.part' and a
+checkpoint describing the request is kept in '<filename>.qcchk'.  If the
+download is interrupted (in this process or a previous one) it resumes from
+the last byte on disk with an HTTP Range request, conditional (If-Range) on
+the response being unchanged.  Any answer other than 206 Partial Content means
+the partial file cannot be continued, and it is written again from the start.
+
+Servers ignore Range on anything but GET, so the request is always sent as a
+GET: data given for it is moved into the query string.
+"""
+import os
+import json
+import httplib
+import logging
+import urllib2
+
+import qualysconnect.settings as qcs
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+class QGDownload:
+    """ Resumable download of a QualysGuard API response to a file.
+
+    Keyword Arguments:
+    ==================
+    connector -- QGConnector used for the request.
+    apiReq -- request string from QualysGuard URL base onward.
+    data -- [optional] parameters of the request, sent in the query string.
+    chunk_size -- [optional] bytes read and written per chunk
+                  (settings.stream_chunk_size).
+    verify_size -- [optional] check the size of the finished file against the
+                   size QualysGuard announced.
+    """
+    def __init__(self, connector, apiReq, data=None, chunk_size=None,
+                 verify_size=False):
+        if chunk_size is None:
+            chunk_size = qcs.stream_chunk_size
+        self._connector = connector
+        self._apiReq = apiReq
+        self._data = data
+        self._url = apiReq
+        if data:
+            # a GET, so that Range is honoured.
+            self._url = "%s%s%s"%(apiReq, '&' if '?' in apiReq else '?', data)
+        self._chunk_size = chunk_size
+        self._verify_size = verify_size
+
+    def to_file(self, filename):
+        """ Download the response into filename, resuming an earlier partial
+        download of the same request if one exists.  Returns the size of the
+        finished file.  Transient failures are retried (and resumed) under
+        the connector's retry policy.
+        """
+        part = "%s.part"%(filename,)
+        checkpoint = "%s.qcchk"%(filename,)
+
+        state = self._load_checkpoint(checkpoint)
+        if state is None and os.path.exists(part):
+            os.unlink(part)
+
+        size = self._connector.retry_policy().call(self._url, None,
+                                                   self._attempt, part,
+                                                   checkpoint)
+        os.rename(part, filename)
+        os.unlink(checkpoint)
+        logger.info("Downloaded %d bytes to %s"%(size, filename))
+        return size
+
+    def _attempt(self, part, checkpoint):
+        """ Fetch (the rest of) the response into part, return its size. """
+        state = self._load_checkpoint(checkpoint) or {}
+        offset = 0
+        if os.path.exists(part):
+            offset = os.path.getsize(part)
+
+        headers = {}
+        if offset:
+            headers["Range"] = "bytes=%d-"%(offset,)
+            if state.get('validator'):
+                headers["If-Range"] = state['validator']
+            logger.info("Resuming %s at byte %d"%(self._apiReq, offset))
+
+        try:
+            response = self._connector.open_request(self._url, None, headers)
+        except urllib2.HTTPError, e:
+            if e.code == 416 and offset:
+                # nothing left to fetch, the previous attempt got it all.
+                e.close()
+                return self._verified(offset, state)
+            raise
+
+        try:
+            info = response.info()
+            mode = 'ab'
+            if response.code == 206:
+                total = self._range_total(info.get('Content-Range'))
+            else:
+                # Range not honoured or (If-Range) the response has changed;
+                #  the full response is coming, start the file over.
+                if offset:
+                    logger.info("Restarting %s from byte 0"%(self._apiReq,))
+                mode = 'wb'
+                total = self._int(info.get('Content-Length'))
+
+            state = {'request': self._apiReq,
+                     'data': self._data,
+                     'validator': info.get('ETag') or info.get('Last-Modified'),
+                     'total': total}
+            self._save_checkpoint(checkpoint, state)
+
+            expected = self._int(info.get('Content-Length'))
+            received = 0
+            out = open(part, mode)
+            try:
+                while True:
+                    chunk = response.read(self._chunk_size)
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    out.flush()
+                    received += len(chunk)
+            finally:
+                out.close()
+        finally:
+            response.close()
+
+        if expected is not None and received < expected:
+            # the connection dropped mid-body; a retry resumes from here.
+            raise httplib.IncompleteRead('', expected - received)
+
+        return self._verified(os.path.getsize(part), state)
+
+    def _verified(self, size, state):
+        if (self._verify_size and state.get('total') is not None
+            and size != state['total']):
+            raise Exception("Download of %s is %d bytes, expected %d"%
+                            (self._apiReq, size, state['total']))
+        return size
+
+    def _load_checkpoint(self, checkpoint):
+        """ Return the checkpoint for this request or None. """
+        try:
+            fp = open(checkpoint)
+        except IOError:
+            return None
+        try:
+            try:
+                state = json.load(fp)
+            except ValueError:
+                return None
+        finally:
+            fp.close()
+        if state.get('request') != self._apiReq or state.get('data') != self._data:
+            logger.info("Checkpoint %s is for another request."%(checkpoint,))
+            return None
+        return state
+
+    def _save_checkpoint(self, checkpoint, state):
+        fp = open(checkpoint, 'w')
+        try:
+            json.dump(state, fp)
+        finally:
+            fp.close()
+
+    def _range_total(self, content_range):
+        """ Return the total size from a 'bytes a-b/total' header value. """
+        if not content_range or '/' not in content_range:
+            return None
+        return self._int(content_range.rpartition('/')[2])
+
+    def _int(self, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return None
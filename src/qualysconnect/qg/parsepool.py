@@ -0,0 +1,269 @@
+""" Module providing QGParsePool, which parses large QualysGuard reports on
+several processes.
+
+  def host_ips(element):             # runs in a worker process
+      return element.findtext('IP')
+
+  ips = []
+  pool = QGParsePool(workers=8)
+  pool.parse(open("report.xml", 'rb'), host_ips, ips.append)
+  print pool.stats()
+
+The report is read as bytes and cut into chunks of whole HOST elements of its
+HOST_LIST (about chunk_bytes each).  Each chunk is parsed by a worker, which
+calls host_parser on every HOST element and sends the results back; they are
+handed to merge in document order, so the outcome does not depend on which
+worker finished first.  The rest of the report (with an empty HOST_LIST) can
+be given to document_parser, also on a worker.
+
+host_parser and document_parser must be module level functions (they are
+pickled by name) and return picklable values.  Boundaries inside CDATA
+sections are skipped; XML comments are not looked into.
+"""
+import os
+import time
+import logging
+import itertools
+import multiprocessing
+
+from cStringIO import StringIO
+
+from lxml import etree
+
+import qualysconnect.settings as qcs
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+_CDATA_OPEN = '<![CDATA['
+_CDATA_CLOSE = ']]>'
+
+def _find_tag(buf, tag, start=0):
+    """ Return the index of tag in buf outside CDATA sections, or -1 if it is
+    not (yet) in buf.  buf must not start inside a CDATA section.
+    """
+    while True:
+        pos = buf.find(tag, start)
+        if pos == -1:
+            return -1
+        opened = buf.rfind(_CDATA_OPEN, 0, pos)
+        if opened == -1 or buf.find(_CDATA_CLOSE, opened, pos) != -1:
+            return pos
+        closed = buf.find(_CDATA_CLOSE, pos)
+        if closed == -1:
+            return -1
+        start = closed + len(_CDATA_CLOSE)
+
+def _declaration(head):
+    """ Return the XML declaration heading a document, '' if it has none. """
+    if head.startswith('<?xml'):
+        return head[:head.find('?>') + 2]
+    return ''
+
+def _parse_hosts(job):
+    """ Worker: parse a chunk of HOST elements, return its statistics and
+    host_parser's results.
+    """
+    (host_parser, declaration, list_tag, host_tag, chunk) = job
+    start = time.time()
+    root = etree.fromstring('%s<%s>%s</%s>'%(declaration, list_tag, chunk,
+                                              list_tag),
+                            etree.XMLParser(huge_tree=True))
+    results = []
+    for element in root.iterchildren(host_tag):
+        results.append(host_parser(element))
+        element.clear()
+    return ('hosts', os.getpid(), len(chunk), time.time() - start, results)
+
+def _parse_document(job):
+    """ Worker: run document_parser on the report without its hosts. """
+    (document_parser, document) = job
+    start = time.time()
+    result = document_parser(StringIO(document))
+    return ('document', os.getpid(), len(document), time.time() - start,
+            result)
+
+class QGParsePool:
+    """ Parse the HOST elements of large reports on a pool of processes.
+
+    Keyword Arguments:
+    ==================
+    workers -- [optional] worker processes (settings.parse_workers, None for
+               one per CPU).
+    chunk_bytes -- [optional] approximate size of the piece of the report
+                   each worker parses at a time (settings.parse_chunk_bytes).
+    list_tag, host_tag -- [optional] elements the report is split on.
+    """
+    def __init__(self, workers=None, chunk_bytes=None,
+                 list_tag='HOST_LIST', host_tag='HOST'):
+        if workers is None:
+            workers = qcs.parse_workers or multiprocessing.cpu_count()
+        if chunk_bytes is None:
+            chunk_bytes = qcs.parse_chunk_bytes
+        self._workers = workers
+        self._chunk_bytes = chunk_bytes
+        self._list_open = '<%s>'%(list_tag,)
+        self._list_close = '</%s>'%(list_tag,)
+        self._host_close = '</%s>'%(host_tag,)
+        self._list_tag = list_tag
+        self._host_tag = host_tag
+        self._stats = {}
+        self._elapsed = 0.0
+
+    def parse(self, xml, host_parser, merge, document_parser=None):
+        """ Parse a report (string or file-like object), calling merge with
+        host_parser's result for each host in document order.  Returns
+        document_parser's result for the rest of the report (None without a
+        document_parser).
+
+        Reports with a single chunk of hosts are parsed in this process.
+        """
+        if not hasattr(xml, 'read'):
+            xml = StringIO(xml)
+        started = time.time()
+        self._stats = {}
+
+        jobs = self._jobs(xml, host_parser, document_parser)
+        first = next(jobs, None)
+        second = next(jobs, None)
+        if self._workers < 2 or second is None or len(second) == 2:
+            document = None
+            for job in (first, second):
+                if job is not None:
+                    document = self._collect(self._run(job), merge, document)
+            for job in jobs:
+                document = self._collect(self._run(job), merge, document)
+            self._elapsed = time.time() - started
+            return document
+
+        pool = multiprocessing.Pool(self._workers)
+        finished = False
+        try:
+            # submit in order, keeping a bounded number of chunks in flight.
+            pending = []
+            document = None
+            for job in itertools.chain((first, second), jobs):
+                pending.append(pool.apply_async(self._worker(job), (job,)))
+                while len(pending) > 2 * self._workers:
+                    document = self._collect(pending.pop(0).get(), merge,
+                                             document)
+            while pending:
+                document = self._collect(pending.pop(0).get(), merge, document)
+            finished = True
+        finally:
+            if finished:
+                pool.close()
+            else:
+                pool.terminate()
+            pool.join()
+        self._elapsed = time.time() - started
+        for (pid, stats) in sorted(self.stats()['workers'].items()):
+            logger.info("Parse worker %d: %d chunk(s), %d host(s), %.1f MB/s"%
+                        (pid, stats['chunks'], stats['hosts'],
+                         stats['bytes_per_second'] / 1048576.0))
+        return document
+
+    def workers(self):
+        """ Return the number of worker processes. """
+        return self._workers
+
+    def stats(self):
+        """ Return a dictionary of throughput metrics of the last parse():
+        overall and, under 'workers', per worker process id.
+        """
+        workers = {}
+        total = 0
+        for (pid, (chunks, hosts, nbytes, seconds)) in self._stats.items():
+            total += nbytes
+            rate = 0.0
+            if seconds:
+                rate = nbytes / seconds
+            workers[pid] = {'chunks': chunks,
+                            'hosts': hosts,
+                            'bytes': nbytes,
+                            'seconds': seconds,
+                            'bytes_per_second': rate}
+        rate = 0.0
+        if self._elapsed:
+            rate = total / self._elapsed
+        return {'bytes': total,
+                'elapsed': self._elapsed,
+                'bytes_per_second': rate,
+                'workers': workers}
+
+    def _worker(self, job):
+        if len(job) == 2:
+            return _parse_document
+        return _parse_hosts
+
+    def _run(self, job):
+        return self._worker(job)(job)
+
+    def _collect(self, outcome, merge, document):
+        """ Account for a finished job and merge its results; returns the
+        document result (the previous one if this was a host chunk).
+        """
+        (kind, pid, nbytes, seconds, result) = outcome
+        stats = self._stats.setdefault(pid, [0, 0, 0, 0.0])
+        stats[0] += 1
+        stats[2] += nbytes
+        stats[3] += seconds
+        if kind == 'hosts':
+            stats[1] += len(result)
+            for host in result:
+                merge(host)
+            return document
+        return result
+
+    def _jobs(self, fp, host_parser, document_parser):
+        """ Generator yielding the jobs of a report: host chunks, then the
+        document (if there is a document_parser).
+        """
+        block = self._chunk_bytes
+        buf = ''
+        eof = False
+        # up to and including the opening tag of the host list.
+        while True:
+            opened = _find_tag(buf, self._list_open)
+            if opened != -1 or eof:
+                break
+            data = fp.read(block)
+            eof = not data
+            buf += data
+        if opened == -1:
+            if document_parser is not None:
+                yield (document_parser, buf)
+            return
+        head = buf[:opened + len(self._list_open)]
+        buf = buf[len(head):]
+        declaration = _declaration(head)
+
+        while True:
+            closed = _find_tag(buf, self._list_close)
+            end = len(buf)
+            if closed != -1:
+                end = closed
+            # cut whole chunks off the hosts read so far.
+            while end > self._chunk_bytes:
+                cut = _find_tag(buf, self._host_close, self._chunk_bytes)
+                if cut == -1 or cut >= end:
+                    break
+                cut += len(self._host_close)
+                yield (host_parser, declaration, self._list_tag,
+                       self._host_tag, buf[:cut])
+                buf = buf[cut:]
+                end -= cut
+            if closed != -1 or eof:
+                break
+            data = fp.read(block)
+            eof = not data
+            buf += data
+
+        if end:
+            yield (host_parser, declaration, self._list_tag, self._host_tag,
+                   buf[:end])
+        if document_parser is not None:
+            yield (document_parser, head + buf[end:] + fp.read())
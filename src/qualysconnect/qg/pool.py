@@ -0,0 +1,270 @@
+""" Module that provides a persistent (HTTP/1.1 keep-alive) connection pool
+and a urllib2 handler that routes QualysGuard API requests through it.
+
+Every QGConnector installs a QGKeepAliveHandler in its opener, so repeated
+calls to the same QualysGuard host reuse an open TCP/SSL connection instead of
+paying for a new handshake on every request.
+"""
+import time
+import errno
+import socket
+import httplib
+import logging
+import threading
+import urllib2
+
+import qualysconnect.settings as qcs
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+class QGConnectionPool:
+    """ Thread safe pool of idle httplib connections keyed by (scheme, host).
+
+    Keyword Arguments:
+    ==================
+    maxsize -- maximum number of idle connections kept per host.
+    idle_timeout -- seconds an idle connection may sit in the pool before it
+                    is evicted (and closed).
+    """
+    def __init__(self, maxsize=None, idle_timeout=None):
+        if maxsize is None:
+            maxsize = qcs.pool_maxsize
+        if idle_timeout is None:
+            idle_timeout = qcs.pool_idle_timeout
+        self._maxsize = maxsize
+        self._idle_timeout = idle_timeout
+        self._idle = {}     # (scheme, host) -> [(connection, last_used), ...]
+        self._lock = threading.Lock()
+
+        # counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.discards = 0
+
+    def acquire(self, key, factory):
+        """ Return a tuple (connection, reused) for key.  An idle connection
+        is reused when one is available, otherwise factory() is called to
+        create a new one.
+        """
+        self._lock.acquire()
+        try:
+            self._evict_idle(time.time())
+            idle = self._idle.get(key)
+            if idle:
+                conn, last_used = idle.pop()
+                self.hits += 1
+                logger.debug("POOL> hit %s (idle %.1fs)"%
+                             (key, time.time()-last_used))
+                return (conn, True)
+            self.misses += 1
+        finally:
+            self._lock.release()
+
+        logger.debug("POOL> miss %s"%(key,))
+        return (factory(), False)
+
+    def release(self, key, conn):
+        """ Return conn to the pool for reuse by later requests to key.
+        Connections beyond the per host limit are closed.
+        """
+        self._lock.acquire()
+        try:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self._maxsize:
+                idle.append((conn, time.time()))
+                return
+            self.evictions += 1
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def discard(self, conn):
+        """ Close conn, it is not safe to be reused. """
+        self._lock.acquire()
+        try:
+            self.discards += 1
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def evict_idle(self):
+        """ Close all connections that have been idle longer than the pool's
+        idle_timeout.  Returns the number of connections evicted.
+        """
+        self._lock.acquire()
+        try:
+            return self._evict_idle(time.time())
+        finally:
+            self._lock.release()
+
+    def _evict_idle(self, now):
+        """ Evict idle connections, caller must hold self._lock. """
+        evicted = 0
+        for key, idle in self._idle.items():
+            keep = []
+            for (conn, last_used) in idle:
+                if now - last_used > self._idle_timeout:
+                    conn.close()
+                    evicted += 1
+                else:
+                    keep.append((conn, last_used))
+            self._idle[key] = keep
+        self.evictions += evicted
+        return evicted
+
+    def close(self):
+        """ Close every idle connection held by the pool. """
+        self._lock.acquire()
+        try:
+            for idle in self._idle.values():
+                for (conn, last_used) in idle:
+                    conn.close()
+            self._idle = {}
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """ Return a dictionary of pool counters. """
+        self._lock.acquire()
+        try:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'discards': self.discards,
+                    'idle': sum([len(i) for i in self._idle.values()])}
+        finally:
+            self._lock.release()
+
+class _QGPooledSocket:
+    """ recv() adapter around an httplib.HTTPResponse that hands the
+    underlying connection back to the pool once the body is fully read.
+    """
+    def __init__(self, pool, key, conn, response):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+
+    def recv(self, amt):
+        data = self._response.read(amt)
+        if not data or self._response.isclosed():
+            self._done()
+        return data
+
+    def close(self):
+        self._done()
+
+    def _done(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        if self._response.isclosed() and not self._response.will_close:
+            self._pool.release(self._key, conn)
+        else:
+            # body was abandoned part way or the server asked us to close.
+            self._response.close()
+            self._pool.discard(conn)
+
+# errors of a socket the other end has already closed.
+_STALE_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+def _stale(e):
+    """ Return True if e shows a reused connection was closed by the server
+    before any of the response arrived, so the request was not processed.
+    """
+    if isinstance(e, socket.timeout):
+        return False
+    if isinstance(e, httplib.BadStatusLine):
+        # raised with the status line received; empty when there was none.
+        return (e.line in ('', "''") or
+                e.line.startswith("No status line received"))
+    if isinstance(e, socket.error):
+        return e.errno in _STALE_ERRNOS
+    return False
+
+class QGKeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """ urllib2 handler that issues HTTP/1.1 requests over pooled
+    persistent connections.
+
+    Keyword Arguments:
+    ==================
+    pool -- QGConnectionPool to draw connections from.
+    context -- [optional] ssl.SSLContext passed to HTTPSConnection (e.g. to
+               trust a local test server).
+    """
+    def __init__(self, pool, context=None, debuglevel=0):
+        urllib2.AbstractHTTPHandler.__init__(self, debuglevel)
+        self._pool = pool
+        self._context = context
+
+    def http_open(self, req):
+        return self._keepalive_open(httplib.HTTPConnection, "http", req)
+
+    def https_open(self, req):
+        return self._keepalive_open(httplib.HTTPSConnection, "https", req)
+
+    def _connection_factory(self, http_class, host, req):
+        def factory():
+            if http_class is httplib.HTTPSConnection and self._context:
+                return http_class(host, timeout=req.timeout,
+                                  context=self._context)
+            return http_class(host, timeout=req.timeout)
+        return factory
+
+    def _keepalive_open(self, http_class, scheme, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        key = (scheme, host)
+        factory = self._connection_factory(http_class, host, req)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()
+                            if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        conn, reused = self._pool.acquire(key, factory)
+        try:
+            response = self._send(conn, req, headers)
+        except (socket.error, httplib.HTTPException), e:
+            self._pool.discard(conn)
+            if not (reused and _stale(e)):
+                raise urllib2.URLError(e)
+            # the server dropped the idle connection before reading the
+            #  request; sending it again cannot repeat it.  Anything else
+            #  (timeouts included) is left to qg.retry.
+            logger.debug("POOL> stale connection to %s (%s), reconnecting"%
+                         (host, e))
+            conn = factory()
+            try:
+                response = self._send(conn, req, headers)
+            except (socket.error, httplib.HTTPException), e:
+                self._pool.discard(conn)
+                raise urllib2.URLError(e)
+
+        fp = socket._fileobject(_QGPooledSocket(self._pool, key, conn,
+                                                response), close=True)
+        resp = urllib2.addinfourl(fp, response.msg, req.get_full_url())
+        resp.code = response.status
+        resp.msg = response.reason
+        return resp
+
+    def _send(self, conn, req, headers):
+        conn.set_debuglevel(self._debuglevel)
+        if conn.sock is not None:
+            # a reused connection keeps the timeout it was opened with.
+            timeout = req.timeout
+            if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+                timeout = socket.getdefaulttimeout()
+            conn.sock.settimeout(timeout)
+        conn.request(req.get_method(), req.get_selector(), req.data, headers)
+        try:
+            return conn.getresponse(buffering=True)
+        except TypeError: # buffering kw not supported
+            return conn.getresponse()
@@ -0,0 +1,186 @@
+""" Module providing a scheduler that keeps QualysGuard API calls within the
+rate and concurrency limits QualysGuard reports in its response headers.
+
+QualysGuard v2 responses carry:
+  X-RateLimit-Limit           calls allowed per window
+  X-RateLimit-Window-Sec      length of the window
+  X-RateLimit-Remaining       calls left in the current window
+  X-RateLimit-ToWait-Sec      seconds to wait before calling again
+  X-Concurrency-Limit-Limit   calls allowed to run at the same time
+
+Exceeding either limit returns HTTP 409.  QGRateLimiter treats the remaining
+call count as a token bucket that refills when the window ends, and only lets
+a call start while both a token and a concurrency slot are available.
+"""
+import time
+import logging
+import threading
+
+import qualysconnect.settings as qcs
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+def _int_header(headers, name):
+    """ Return header 'name' as an integer or None if absent/malformed. """
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+class QGRateLimiter:
+    """ Thread safe token bucket scheduler for QualysGuard API calls.
+
+    Keyword Arguments:
+    ==================
+    concurrency -- [optional] maximum calls in flight (at most the value
+                   QualysGuard reports, settings.concurrency_limit).
+    reserve -- [optional] number of calls to leave unused in each window so
+               that other clients of the subscription are not starved.  It
+               must be below the window's limit; acquire() raises otherwise.
+
+    Slots are held while a call is issued and, for calls whose body is read
+    at once, until it has been read; streamed responses give theirs back
+    when the headers arrive (see QGConnector._open_request).
+    """
+    def __init__(self, concurrency=None, reserve=None):
+        if concurrency is None:
+            concurrency = qcs.concurrency_limit
+        if reserve is None:
+            reserve = qcs.ratelimit_reserve
+        self._cond = threading.Condition()
+        self._max_concurrency = concurrency
+        self._concurrency = concurrency
+        self._reserve = reserve
+        self._running = 0
+
+        # Budget as last reported by QualysGuard.  None until known.
+        self._limit = None
+        self._window = None
+        self._tokens = None
+        self._refill_at = None
+
+        # counters exposed through stats()
+        self.calls = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.throttled = 0
+
+    def acquire(self):
+        """ Block until a call may be issued, then claim a concurrency slot
+        and a token for it.
+        """
+        self._cond.acquire()
+        try:
+            start = time.time()
+            waited = False
+            while True:
+                now = time.time()
+                if self._refill_at is not None and now >= self._refill_at:
+                    self._tokens = self._limit
+                    self._refill_at = None
+
+                if self._limit is not None and self._reserve >= self._limit:
+                    raise Exception("Rate limit reserve (%d) leaves none of "
+                                    "the %d calls per window to use"%
+                                    (self._reserve, self._limit))
+                has_slot = self._running < self._concurrency
+                has_token = self._tokens is None or self._tokens > self._reserve
+                if has_slot and has_token:
+                    break
+
+                timeout = None
+                if not has_token:
+                    if self._refill_at is None:
+                        self._refill_at = now + (self._window or
+                                                 qcs.ratelimit_backoff)
+                    timeout = max(self._refill_at - now, 0.01)
+                if not waited:
+                    logger.debug("RATE> waiting (running %d/%d, tokens %s)"%
+                                 (self._running, self._concurrency,
+                                  self._tokens))
+                waited = True
+                self._cond.wait(timeout)
+
+            self._running += 1
+            if self._tokens is not None:
+                self._tokens -= 1
+            self.calls += 1
+            if waited:
+                self.waits += 1
+                self.wait_time += time.time() - start
+        finally:
+            self._cond.release()
+
+    def release(self, headers=None, throttled=False):
+        """ Return the call's concurrency slot and update the budget from
+        the response headers.
+
+        Keyword Arguments:
+        ==================
+        headers -- [optional] response headers (mimetools.Message or dict).
+        throttled -- [optional] True if QualysGuard rejected the call (409).
+        """
+        self._cond.acquire()
+        try:
+            self._running -= 1
+            if headers is not None:
+                self._update(headers)
+            if throttled:
+                self.throttled += 1
+                if self._refill_at is None:
+                    self._tokens = 0
+                    self._refill_at = time.time() + qcs.ratelimit_backoff
+            self._cond.notify_all()
+        finally:
+            self._cond.release()
+
+    def _update(self, headers):
+        """ Apply X-RateLimit/X-Concurrency headers, caller holds the lock. """
+        now = time.time()
+        limit = _int_header(headers, 'X-RateLimit-Limit')
+        window = _int_header(headers, 'X-RateLimit-Window-Sec')
+        remaining = _int_header(headers, 'X-RateLimit-Remaining')
+        to_wait = _int_header(headers, 'X-RateLimit-ToWait-Sec')
+        concurrency = _int_header(headers, 'X-Concurrency-Limit-Limit')
+
+        if limit is not None:
+            self._limit = limit
+        if window is not None:
+            self._window = window
+        if remaining is not None:
+            # calls still in flight have not been counted by QualysGuard yet.
+            self._tokens = max(remaining - self._running, 0)
+        if to_wait:
+            self._tokens = 0
+            self._refill_at = now + to_wait
+        if concurrency:
+            self._concurrency = min(self._max_concurrency, concurrency)
+
+    def stats(self):
+        """ Return a dictionary describing the current budget and the time
+        spent waiting for it.
+        """
+        self._cond.acquire()
+        try:
+            wait = 0.0
+            if self._refill_at is not None:
+                wait = max(self._refill_at - time.time(), 0.0)
+            return {'calls': self.calls,
+                    'running': self._running,
+                    'concurrency': self._concurrency,
+                    'limit': self._limit,
+                    'window': self._window,
+                    'remaining': self._tokens,
+                    'wait_for_refill': wait,
+                    'waits': self.waits,
+                    'wait_time': self.wait_time,
+                    'throttled': self.throttled}
+        finally:
+            self._cond.release()
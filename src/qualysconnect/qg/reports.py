@@ -0,0 +1,262 @@
+""" Module providing QGReportPipeline, which launches many QualysGuard reports,
+polls them together and fetches each one as soon as it has finished.
+
+  pipeline = QGReportPipeline(qgs)
+  for group in asset_groups:
+      pipeline.add("template_id=1234&output_format=pdf&report_title=%s&"
+                   "asset_group_ids=%s"%(group.title, group.id),
+                   "%s.pdf"%(group.id,))
+  for job in pipeline.run():
+      print job.report_id, job.state, job.filename
+
+At most 'concurrency' reports are generating at once.  All running reports
+are polled with a single report/?action=list call; the poll interval grows
+while nothing changes and snaps back once a report finishes.  Finished
+reports are fetched on worker threads while the pipeline keeps polling.
+"""
+import time
+import logging
+import threading
+
+import qualysconnect.settings as qcs
+
+from qualysconnect.workers import QGWorkerPool
+from qualysconnect.qg.download import QGDownload
+from qualysconnect.qg.xmlproc import QGXP_lxml_objectify
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+class QGReportJob:
+    """ One report handled by a QGReportPipeline.
+
+    state is 'Queued', 'Running', 'Fetching', 'Finished' or 'Failed'.  Once
+    Finished, the report is in filename, or in result if no filename was
+    given.  Failed jobs carry the reason in error.
+    """
+    def __init__(self, params, filename=None):
+        self.params = params
+        self.filename = filename
+        self.report_id = None
+        self.state = 'Queued'
+        self.result = None
+        self.error = None
+        self.queued_at = time.time()
+        self.launched_at = None
+        self.finished_at = None
+        self._missing = 0
+
+class QGReportPipeline:
+    """ Launch, poll and fetch QualysGuard reports concurrently.
+
+    Keyword Arguments:
+    ==================
+    connector -- connected QGAPISession used for every call.
+    concurrency -- [optional] reports generating at once
+                   (settings.report_concurrency).
+    poll_min -- [optional] shortest poll interval in seconds
+                (settings.report_poll_min).
+    poll_max -- [optional] longest poll interval in seconds
+                (settings.report_poll_max).
+    fetchers -- [optional] worker threads fetching finished reports.
+    delete -- [optional] delete each report from QualysGuard once fetched.
+    """
+    def __init__(self, connector, concurrency=None, poll_min=None,
+                 poll_max=None, fetchers=2, delete=False):
+        if concurrency is None:
+            concurrency = qcs.report_concurrency
+        if poll_min is None:
+            poll_min = qcs.report_poll_min
+        if poll_max is None:
+            poll_max = qcs.report_poll_max
+        self._connector = connector
+        self._concurrency = concurrency
+        self._poll_min = poll_min
+        self._poll_max = poll_max
+        self._fetchers = fetchers
+        self._delete = delete
+
+        self._queue = []
+        self._running = {}      # report_id -> QGReportJob
+        self._fetching = []     # [(QGReportJob, QGFuture), ...]
+        self._failed_jobs = []
+        self._wakeup = threading.Event()
+
+        # counters exposed through stats()
+        self._started = None
+        self.launched = 0
+        self.finished = 0
+        self.failed = 0
+        self.polls = 0
+        self.generation_time = 0.0
+
+    def add(self, params, filename=None):
+        """ Queue a report launch and return its QGReportJob.
+
+        Keyword Arguments:
+        ==================
+        params -- report/?action=launch parameters (template_id,
+                  output_format, report_title, ...) as a query string.
+        filename -- [optional] file to fetch the finished report into.
+        """
+        job = QGReportJob(params, filename)
+        self._queue.append(job)
+        return job
+
+    def run(self):
+        """ Generator driving the pipeline.  Yields each QGReportJob once it
+        has been fetched (or has failed), until every queued job is done.
+        """
+        self._started = time.time()
+        workers = QGWorkerPool(self._fetchers)
+        interval = self._poll_min
+        try:
+            while self._queue or self._running or self._fetching:
+                changed = self._launch()
+                if self._running:
+                    changed = self._poll(workers) or changed
+                for job in self._collect():
+                    changed = True
+                    yield job
+
+                if changed:
+                    interval = self._poll_min
+                else:
+                    interval = min(interval * 1.5, self._poll_max)
+
+                if self._running:
+                    self._wait(interval)
+                elif self._fetching:
+                    self._wait(None)
+        finally:
+            workers.shutdown(wait=not self._fetching)
+
+    def stats(self):
+        """ Return a dictionary of queue depth and throughput metrics. """
+        elapsed = 0.0
+        if self._started is not None:
+            elapsed = time.time() - self._started
+        throughput = 0.0
+        if elapsed:
+            throughput = self.finished * 3600.0 / elapsed
+        mean_generation = 0.0
+        if self.finished:
+            mean_generation = self.generation_time / self.finished
+        return {'queued': len(self._queue),
+                'running': len(self._running),
+                'fetching': len(self._fetching),
+                'launched': self.launched,
+                'finished': self.finished,
+                'failed': self.failed,
+                'polls': self.polls,
+                'elapsed': elapsed,
+                'reports_per_hour': throughput,
+                'mean_generation_time': mean_generation}
+
+    def _launch(self):
+        """ Launch queued reports while there is capacity. """
+        launched = False
+        while self._queue and len(self._running) < self._concurrency:
+            job = self._queue.pop(0)
+            try:
+                ret = self._connector.request("report/",
+                                              "action=launch&%s"%(job.params,))
+                job.report_id = str(QGXP_lxml_objectify(ret).RESPONSE.ITEM_LIST.ITEM.VALUE)
+            except Exception, e:
+                self._fail(job, e)
+                continue
+            job.state = 'Running'
+            job.launched_at = time.time()
+            self._running[job.report_id] = job
+            self.launched += 1
+            launched = True
+            logger.info("Launched report %s (%d running, %d queued)"%
+                        (job.report_id, len(self._running), len(self._queue)))
+        return launched
+
+    def _poll(self, workers):
+        """ Check every running report with one list call and start fetching
+        those that finished.  Returns True if any report changed state.
+        """
+        self.polls += 1
+        ret = self._connector.request("report/", "action=list")
+        reports = QGXP_lxml_objectify(ret).RESPONSE
+        states = {}
+        if hasattr(reports, 'REPORT_LIST'):
+            for report in reports.REPORT_LIST.REPORT:
+                states[str(report.ID)] = str(report.STATUS.STATE)
+
+        changed = False
+        for report_id, job in self._running.items():
+            state = states.get(report_id)
+            if state == 'Finished':
+                del self._running[report_id]
+                job.state = 'Fetching'
+                self.generation_time += time.time() - job.launched_at
+                future = workers.submit(self._fetch, job)
+                future.add_done_callback(lambda f: self._wakeup.set())
+                self._fetching.append((job, future))
+                changed = True
+            elif state is None:
+                # a freshly launched report may not be listed yet.
+                job._missing += 1
+                if job._missing >= 3:
+                    del self._running[report_id]
+                    self._fail(job, Exception("Report %s is no longer listed"%
+                                              (report_id,)))
+                    changed = True
+            elif state in ('Errors', 'Canceled'):
+                del self._running[report_id]
+                self._fail(job, Exception("Report %s state is %s"%
+                                          (report_id, state)))
+                changed = True
+        return changed
+
+    def _fetch(self, job):
+        """ Worker side: fetch a finished report (and optionally delete it). """
+        if job.filename:
+            QGDownload(self._connector, "report/?action=fetch&id=%s"%
+                       (job.report_id,)).to_file(job.filename)
+        else:
+            job.result = self._connector.request("report/",
+                                                 "action=fetch&id=%s"%(job.report_id,))
+        if self._delete:
+            self._connector.request("report/",
+                                    "action=delete&id=%s"%(job.report_id,))
+
+    def _collect(self):
+        """ Return jobs whose fetch has completed. """
+        done = []
+        still = []
+        for (job, future) in self._fetching:
+            if not future.done():
+                still.append((job, future))
+                continue
+            if future.exception() is not None:
+                self._fail(job, future.exception())
+                continue
+            job.state = 'Finished'
+            job.finished_at = time.time()
+            self.finished += 1
+            done.append(job)
+        self._fetching = still
+        done.extend(self._failed_jobs)
+        self._failed_jobs = []
+        return done
+
+    def _fail(self, job, error):
+        logger.warning("Report job %s failed: %s"%(job.report_id or job.params,
+                                                    error))
+        job.state = 'Failed'
+        job.error = error
+        job.finished_at = time.time()
+        self.failed += 1
+        self._failed_jobs.append(job)
+
+    def _wait(self, timeout):
+        """ Sleep until timeout passes or a fetch completes. """
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
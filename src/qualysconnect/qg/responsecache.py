@@ -0,0 +1,297 @@
+""" Module providing QGResponseCache, a cache of QualysGuard API responses to
+read-only requests (template lists, scan lists, knowledge base lookups, ...)
+used by QGConnector.request.
+
+  cache = QGResponseCache(QGDiskCache("/home/me/.qcresponses-me@qualysapi"))
+  qgs = QGAPISession(user, password, host, pResponseCache=cache)
+
+Only requests with an idempotent action (see retry.IDEMPOTENT_ACTIONS) to an
+endpoint with a TTL (settings.response_cache_ttls) are cached.  When an entry
+expires and QualysGuard had sent an ETag or Last-Modified header, the next
+request revalidates it with a conditional request instead of downloading the
+response again.
+
+A cache holds responses for whichever account made the requests; do not
+share one between connectors logged in as different users.
+"""
+import os
+import time
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+
+from collections import OrderedDict
+
+import qualysconnect.settings as qcs
+
+from qualysconnect.qg.retry import request_action, IDEMPOTENT_ACTIONS
+from qualysconnect.qg.retry import IDEMPOTENT_V1_SCRIPTS
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+class QGCacheEntry:
+    """ A cached response body with its expiry time and validators. """
+    def __init__(self, body, expires, etag=None, last_modified=None):
+        self.body = body
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def fresh(self):
+        return time.time() < self.expires
+
+    def validators(self):
+        """ Return the conditional request headers for this entry. """
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+class QGMemoryCache:
+    """ In-process least recently used store, bounded to max_bytes of
+    response bodies (settings.response_cache_max_bytes).
+    """
+    def __init__(self, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = qcs.response_cache_max_bytes
+        self._max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry  # most recently used
+            return entry
+        finally:
+            self._lock.release()
+
+    def put(self, key, entry):
+        if len(entry.body) > self._max_bytes:
+            return
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old.body)
+            self._entries[key] = entry
+            self._size += len(entry.body)
+            while self._size > self._max_bytes:
+                (evicted_key, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted.body)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._size = 0
+        finally:
+            self._lock.release()
+
+    def size(self):
+        return self._size
+
+class QGDiskCache:
+    """ On-disk store, one file per response in directory, bounded to
+    max_bytes (settings.response_cache_max_bytes) by evicting the least
+    recently used files.  The directory is created user only (0700).
+    """
+    def __init__(self, directory, max_bytes=None):
+        if max_bytes is None:
+            max_bytes = qcs.response_cache_max_bytes
+        self._directory = directory
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.evictions = 0
+        try:
+            os.makedirs(directory, 0700)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _path(self, key):
+        return os.path.join(self._directory, hashlib.sha1(key).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            fp = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            header = fp.readline().rstrip('\n').split('\t')
+            body = fp.read()
+        finally:
+            fp.close()
+        if len(header) != 3:
+            return None     # damaged
+        os.utime(path, None)   # mark as recently used
+        return QGCacheEntry(body, float(header[0]),
+                            header[1] or None, header[2] or None)
+
+    def put(self, key, entry):
+        if len(entry.body) > self._max_bytes:
+            return
+        header = "\t".join((repr(entry.expires),
+                            entry.etag or '', entry.last_modified or ''))
+        (fd, tmp) = tempfile.mkstemp(dir=self._directory)
+        try:
+            fp = os.fdopen(fd, 'wb')
+            try:
+                fp.write(header + "\n")
+                fp.write(entry.body)
+            finally:
+                fp.close()
+            os.rename(tmp, self._path(key))
+        except:
+            os.unlink(tmp)
+            raise
+        self._evict()
+
+    def clear(self):
+        for name in os.listdir(self._directory):
+            os.unlink(os.path.join(self._directory, name))
+
+    def size(self):
+        return sum([f[1] for f in self._files()])
+
+    def _files(self):
+        files = []
+        for name in os.listdir(self._directory):
+            path = os.path.join(self._directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    def _evict(self):
+        """ Remove least recently used files until under max_bytes. """
+        self._lock.acquire()
+        try:
+            files = self._files()
+            size = sum([f[1] for f in files])
+            files.sort()
+            while size > self._max_bytes and files:
+                (used, fsize, path) = files.pop(0)
+                try:
+                    os.unlink(path)
+                except OSError:
+                    continue
+                size -= fsize
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+class QGResponseCache:
+    """ Caching policy and counters in front of a store (QGMemoryCache or
+    QGDiskCache).
+
+    Keyword Arguments:
+    ==================
+    store -- [optional] backend, defaults to a new QGMemoryCache.
+    ttls -- [optional] dictionary of endpoint (the request path, e.g.
+            'report_template_list.php' or 'knowledge_base/vuln/') -> seconds
+            its responses are cached (settings.response_cache_ttls).
+    """
+    def __init__(self, store=None, ttls=None):
+        if store is None:
+            store = QGMemoryCache()
+        if ttls is None:
+            ttls = qcs.response_cache_ttls
+        self._store = store
+        self._ttls = ttls
+        self._lock = threading.Lock()
+
+        # counters exposed through stats()
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.bytes_saved = 0
+
+    def ttl(self, apiReq, data=None):
+        """ Return the seconds the response to a request may be cached, 0 if
+        it must not be cached.
+        """
+        script = apiReq.partition('?')[0]
+        ttl = self._ttls.get(script, 0)
+        if not ttl:
+            return 0
+        action = request_action(apiReq, data)
+        if action is not None:
+            if action in IDEMPOTENT_ACTIONS and action != 'login':
+                return ttl
+            return 0
+        if script.endswith('.php'):
+            if IDEMPOTENT_V1_SCRIPTS.search(script):
+                return ttl
+            return 0
+        # v2 requests without an action default to listing.
+        return ttl
+
+    def key(self, apiURI, apiReq, data=None):
+        return "%s%s\0%s"%(apiURI, apiReq, data or '')
+
+    def get(self, key):
+        """ Return the stored QGCacheEntry for key (fresh or not) or None. """
+        return self._store.get(key)
+
+    def put(self, key, body, ttl, info=None, previous=None):
+        """ Store a response body for ttl seconds; info is the response's
+        headers, whose ETag/Last-Modified allow later revalidation.  When
+        refreshing a revalidated entry, previous supplies the validators
+        info does not repeat.
+        """
+        etag = last_modified = None
+        if previous is not None:
+            (etag, last_modified) = (previous.etag, previous.last_modified)
+        if info is not None:
+            etag = info.get('ETag') or etag
+            last_modified = info.get('Last-Modified') or last_modified
+        self._store.put(key, QGCacheEntry(body, time.time() + ttl,
+                                          etag, last_modified))
+
+    def count(self, hit, entry=None, revalidated=False):
+        self._lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += len(entry.body)
+                if revalidated:
+                    self.revalidated += 1
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._store.clear()
+
+    def stats(self):
+        """ Return a dictionary of hit/miss/bytes saved counters. """
+        self._lock.acquire()
+        try:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'revalidated': self.revalidated,
+                    'bytes_saved': self.bytes_saved,
+                    'evictions': self._store.evictions,
+                    'size': self._store.size()}
+        finally:
+            self._lock.release()
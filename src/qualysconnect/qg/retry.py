@@ -0,0 +1,166 @@
+""" Module providing QGRetryPolicy, which retries QualysGuard API calls that
+fail with a transient error (5xx, connection reset, timeout) using jittered
+exponential backoff.
+
+Only calls that are safe to repeat are retried.  Read-only API actions
+(list, fetch, ...) are idempotent; actions that change state on QualysGuard
+(launch, purge, delete, ...) are never retried since the first attempt may
+have taken effect before the error was seen.
+"""
+import re
+import sys
+import time
+import random
+import socket
+import httplib
+import logging
+import threading
+import urllib2
+
+import qualysconnect.settings as qcs
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+# v2 API 'action=' values that only read data (or, for login, only create a
+#  new session) and are safe to repeat.
+IDEMPOTENT_ACTIONS = ('list', 'fetch', 'search', 'login')
+
+# v1 API scripts that only read data.
+IDEMPOTENT_V1_SCRIPTS = re.compile(r'(_list|_history|_info|_download|_search)\.php$')
+
+# HTTP status codes that indicate a transient server side failure.
+TRANSIENT_HTTP_CODES = (500, 502, 503, 504)
+
+_ACTION = re.compile(r'(?:^|[?&])action=([^&]*)')
+
+def request_action(apiReq, data=None):
+    """ Return the 'action=' value of an API request (from the request
+    string or its POST data) or None if it has none.
+    """
+    for params in (apiReq.partition('?')[2], data or ''):
+        match = _ACTION.search(params)
+        if match:
+            return match.group(1)
+    return None
+
+class QGRetryPolicy:
+    """ Retry transient failures of idempotent QualysGuard API calls.
+
+    Keyword Arguments:
+    ==================
+    retries -- [optional] maximum retries per call (settings.retry_count).
+    backoff -- [optional] seconds before the first retry, doubled for each
+               further retry (settings.retry_backoff).
+    max_backoff -- [optional] upper bound of a single backoff
+                   (settings.retry_max_backoff).
+    deadline -- [optional] seconds after which a call is no longer retried,
+                measured from its first attempt (settings.retry_deadline).
+    """
+    def __init__(self, retries=None, backoff=None, max_backoff=None,
+                 deadline=None):
+        if retries is None:
+            retries = qcs.retry_count
+        if backoff is None:
+            backoff = qcs.retry_backoff
+        if max_backoff is None:
+            max_backoff = qcs.retry_max_backoff
+        if deadline is None:
+            deadline = qcs.retry_deadline
+        self._retries = retries
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._deadline = deadline
+        self._lock = threading.Lock()
+
+        # counters exposed through stats()
+        self.retries = 0
+        self.backoff_time = 0.0
+        self.recovered = 0
+        self.failed = 0
+
+    def is_idempotent(self, apiReq, data=None):
+        """ Return True if the API request may safely be sent again. """
+        action = request_action(apiReq, data)
+        if action is not None:
+            return action in IDEMPOTENT_ACTIONS
+        script = apiReq.partition('?')[0]
+        if script.endswith('.php'):
+            return IDEMPOTENT_V1_SCRIPTS.search(script) is not None
+        # v2 requests without an action default to listing.
+        return True
+
+    def is_transient(self, error):
+        """ Return True if error is likely to go away on its own. """
+        if isinstance(error, urllib2.HTTPError):
+            return error.code in TRANSIENT_HTTP_CODES
+        if isinstance(error, urllib2.URLError):
+            return isinstance(error.reason, (socket.error, socket.timeout,
+                                             httplib.HTTPException))
+        return isinstance(error, (socket.error, socket.timeout,
+                                  httplib.HTTPException))
+
+    def delay(self, attempt):
+        """ Return the jittered backoff (in seconds) before retry 'attempt'
+        (counting from 0).
+        """
+        delay = min(self._max_backoff, self._backoff * (2 ** attempt))
+        return random.uniform(delay / 2.0, delay)
+
+    def call(self, apiReq, data, fn, *args):
+        """ Return fn(*args), retrying transient failures when apiReq/data
+        describe an idempotent request.
+        """
+        start = time.time()
+        attempt = 0
+        while True:
+            try:
+                result = fn(*args)
+            except Exception, e:
+                exc_info = sys.exc_info()
+                if not (self.is_transient(e) and
+                        self.is_idempotent(apiReq, data)):
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                delay = self.delay(attempt)
+                if (attempt >= self._retries or
+                    (self._deadline and
+                     time.time() - start + delay > self._deadline)):
+                    self._count(failed=1)
+                    logger.warning("Giving up on %s after %d retries: %s"%
+                                   (apiReq, attempt, e))
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if isinstance(e, urllib2.HTTPError):
+                    e.close()
+                logger.info("Transient failure on %s (%s), retry %d in %.1fs"%
+                            (apiReq, e, attempt + 1, delay))
+                self._count(retries=1, backoff_time=delay)
+                time.sleep(delay)
+                attempt += 1
+                continue
+            if attempt:
+                self._count(recovered=1)
+            return result
+
+    def _count(self, retries=0, backoff_time=0.0, recovered=0, failed=0):
+        self._lock.acquire()
+        try:
+            self.retries += retries
+            self.backoff_time += backoff_time
+            self.recovered += recovered
+            self.failed += failed
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """ Return a dictionary of retry counters. """
+        self._lock.acquire()
+        try:
+            return {'retries': self.retries,
+                    'backoff_time': self.backoff_time,
+                    'recovered': self.recovered,
+                    'failed': self.failed}
+        finally:
+            self._lock.release()
@@ -0,0 +1,109 @@
+""" Module providing QGSessionCache, an on-disk store for the QualysGuard API
+v2 session cookie so that separate processes can reuse one login.
+
+The cookie grants API access just like a password, so the cache file is
+written with user only (0600) permissions and a cache file readable by others
+is ignored.
+"""
+import os
+import stat
+import time
+import logging
+import cookielib
+
+import qualysconnect.settings as qcs
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+SESSION_COOKIE = "QualysSession"
+
+class QGSessionCache:
+    """ Persist a QGAPISession's cookie jar between processes.
+
+    Keyword Arguments:
+    ==================
+    pHost -- QualysGuard API hostname the session belongs to.
+    pUser -- QualysGuard username the session belongs to.
+    filename -- [optional] cache file, defaults to
+                ~/<settings.session_cache_filename>-<user>@<host>.
+    max_age -- [optional] seconds a cached session is trusted without use
+               (settings.session_cache_max_age).
+    """
+    def __init__(self, pHost, pUser, filename=None, max_age=None):
+        if filename is None:
+            filename = os.path.join(os.getenv("HOME"), "%s-%s@%s"%
+                                    (qcs.session_cache_filename, pUser, pHost))
+        if max_age is None:
+            max_age = qcs.session_cache_max_age
+        self._filename = filename
+        self._max_age = max_age
+
+    def get_filename(self):
+        return self._filename
+
+    def load(self, jar):
+        """ Load a cached session into cookie jar.  Returns True if a session
+        cookie that is still believed to be valid was loaded.
+        """
+        try:
+            st = os.stat(self._filename)
+        except OSError:
+            return False
+
+        mode = stat.S_IMODE(st[stat.ST_MODE])
+        if (mode & ( stat.S_IRWXG | stat.S_IRWXO )) != 0:
+            logger.warning("%s permissions allows more than user access, "
+                           "ignoring cached session."%(self._filename,))
+            return False
+
+        if time.time() - st[stat.ST_MTIME] > self._max_age:
+            logger.debug("cached session in %s has expired."%(self._filename,))
+            return False
+
+        cached = cookielib.LWPCookieJar()
+        try:
+            cached.load(self._filename, ignore_discard=True)
+        except (IOError, cookielib.LoadError), e:
+            logger.warning("unable to read cached session %s: %s"%
+                           (self._filename, e))
+            return False
+
+        found = False
+        for cookie in cached:
+            if cookie.is_expired():
+                continue
+            jar.set_cookie(cookie)
+            if cookie.name == SESSION_COOKIE:
+                found = True
+        return found
+
+    def save(self, jar):
+        """ Write the cookies in jar to the cache file (mode 0600).  The file
+        is replaced atomically so concurrent processes never see a partial
+        cache.
+        """
+        cached = cookielib.LWPCookieJar()
+        for cookie in jar:
+            cached.set_cookie(cookie)
+
+        tmp = "%s.%d"%(self._filename, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        os.close(fd)
+        try:
+            os.chmod(tmp, 0600)
+            cached.save(tmp, ignore_discard=True)
+            os.rename(tmp, self._filename)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def clear(self):
+        """ Remove the cache file. """
+        try:
+            os.unlink(self._filename)
+        except OSError:
+            pass
@@ -0,0 +1,320 @@
+""" Module providing a compact binary snapshot of host detection data that
+is read back by memory-mapping the file rather than parsing XML again.
+
+  QGSnapshotWriter.from_responses(qgs.iter_pages(DETECTION_REQUEST)
+                                  ).write("detections.qcsnap")
+
+  snapshot = QGSnapshot("detections.qcsnap")
+  snapshot.host("10.0.0.1")                 # dict with 'detections' list
+  for detection in snapshot.qid(38173):     # every host with QID 38173
+      print detection['ip'], detection['status']
+
+File layout (little endian):
+
+  header       MAGIC, section counts and offsets (HEADER)
+  hosts        fixed width HOST_RECORDs sorted by address; each points at
+               its contiguous run of detections
+  detections   fixed width DETECTION_RECORDs grouped by host
+  qid index    uint32 detection numbers ordered by (QID, host)
+  strings      JSON string table for the dictionary encoded columns
+
+Opening a snapshot only reads the header and string table; records are
+unpacked from the mapped file on access and found by binary search.
+"""
+import os
+import sys
+import mmap
+import json
+import struct
+import logging
+import tempfile
+
+from array import array
+
+from qualysconnect.ipset import parse_address, format_address
+from qualysconnect.qg.columns import QGDetectionColumns
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+MAGIC = "QCSNAP01"
+
+# magic, host count, detection count, offsets of hosts, detections, qid
+#  index and string table, string table length.
+HEADER = struct.Struct('<8sQQQQQQQ')
+
+# address (16 bytes, big endian), ip version, os, tracking method, host id,
+#  last scan, first detection, detection count.
+HOST_RECORD = struct.Struct('<16sBxHHxxIqQI4x')
+
+# host, qid, times found, port, type, status, protocol, severity, first
+#  found, last found, last test.
+DETECTION_RECORD = struct.Struct('<IIIHHHHB3xqqq')
+
+QID_ENTRY = struct.Struct('<I')
+
+# array typecode of QID_ENTRY, written straight from memory.
+_UINT32 = [t for t in ('I', 'L') if array(t).itemsize == 4][0]
+
+_DETECTION_FIELDS = ('host', 'qid', 'times_found', 'port', 'type', 'status',
+                     'protocol', 'severity', 'first_found', 'last_found',
+                     'last_test')
+def _address_bytes(version, value):
+    return struct.pack('>QQ', value >> 64, value & 0xFFFFFFFFFFFFFFFF)
+
+def _address_value(packed):
+    (hi, lo) = struct.unpack('>QQ', packed)
+    return (hi << 64) | lo
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+class QGSnapshotWriter:
+    """ Write a QGDetectionColumns to a snapshot file.
+
+    Keyword Arguments:
+    ==================
+    columns -- filled qg.columns.QGDetectionColumns.
+    """
+    def __init__(self, columns):
+        self._columns = columns
+
+    @classmethod
+    def from_responses(cls, responses):
+        """ Return a writer for the hosts of detection responses (strings or
+        file-like objects), streamed through xmlproc.QGXP_iter_host_detections.
+        """
+        columns = QGDetectionColumns()
+        for response in responses:
+            columns.add_response(response)
+        return cls(columns)
+
+    def write(self, filename):
+        """ Write the snapshot to filename (atomically replacing it) and
+        return the number of bytes written.
+        """
+        hosts = self._columns.hosts
+        detections = self._columns.detections
+        nhosts = len(hosts['ip'])
+        ndetections = len(detections['qid'])
+
+        # each host's run of detections; they were added host by host.
+        first = array(_UINT32, [0]) * nhosts
+        count = array(_UINT32, [0]) * nhosts
+        for (n, host) in enumerate(detections['host']):
+            if not count[host]:
+                first[host] = n
+            count[host] += 1
+
+        order = sorted(range(nhosts), key=self._host_key)
+        position = array(_UINT32, [0]) * nhosts
+        for (n, host) in enumerate(order):
+            position[host] = n
+
+        host_offset = _align(HEADER.size)
+        detection_offset = _align(host_offset + nhosts * HOST_RECORD.size)
+        qid_offset = _align(detection_offset +
+                            ndetections * DETECTION_RECORD.size)
+        string_offset = _align(qid_offset + ndetections * QID_ENTRY.size)
+        strings = json.dumps(self._columns.dictionaries())
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        (fd, tmp) = tempfile.mkstemp(dir=directory)
+        try:
+            fp = os.fdopen(fd, 'wb')
+            try:
+                fp.write(HEADER.pack(MAGIC, nhosts, ndetections, host_offset,
+                                     detection_offset, qid_offset,
+                                     string_offset, len(strings)))
+                self._pad(fp, host_offset)
+
+                written = 0
+                for host in order:
+                    (version, value) = self._host_key(host)
+                    fp.write(HOST_RECORD.pack(_address_bytes(version, value),
+                                              version, hosts['os'][host],
+                                              hosts['tracking_method'][host],
+                                              hosts['id'][host],
+                                              int(hosts['last_scan'][host]),
+                                              written, count[host]))
+                    written += count[host]
+                self._pad(fp, detection_offset)
+
+                # QID of each detection, in file order.
+                qids = array(_UINT32)
+                written = 0
+                for host in order:
+                    for n in xrange(first[host], first[host] + count[host]):
+                        values = [detections[field][n]
+                                  for field in _DETECTION_FIELDS]
+                        values[0] = position[host]
+                        for i in (8, 9, 10):
+                            values[i] = int(values[i])
+                        fp.write(DETECTION_RECORD.pack(*values))
+                        qids.append(values[1])
+                        written += 1
+                self._pad(fp, qid_offset)
+
+                fp.write(self._qid_index(qids).tostring())
+                self._pad(fp, string_offset)
+                fp.write(strings)
+                size = fp.tell()
+            finally:
+                fp.close()
+            os.rename(tmp, filename)
+        except:
+            os.unlink(tmp)
+            raise
+        logger.info("Wrote %d host(s), %d detection(s) to %s"%
+                    (nhosts, ndetections, filename))
+        return size
+
+    def _qid_index(self, qids):
+        """ Return the detection numbers ordered by (QID, detection number)
+        as little endian QID_ENTRYs: a counting sort over the few distinct
+        QIDs, so no per-detection Python objects are kept.
+        """
+        counts = {}
+        for qid in qids:
+            counts[qid] = counts.get(qid, 0) + 1
+        start = {}
+        total = 0
+        for qid in sorted(counts):
+            start[qid] = total
+            total += counts[qid]
+        index = array(_UINT32, [0]) * len(qids)
+        for (n, qid) in enumerate(qids):
+            index[start[qid]] = n
+            start[qid] += 1
+        if sys.byteorder != 'little':
+            index.byteswap()
+        return index
+
+    def _host_key(self, host):
+        version = self._columns.hosts['ip_version'][host]
+        if version == 4:
+            return (4, self._columns.hosts['ip'][host])
+        return (6, self._columns.ip6[host])
+
+    def _pad(self, fp, offset):
+        fp.write('\0' * (offset - fp.tell()))
+
+class QGSnapshot:
+    """ Read-only, memory-mapped view of a snapshot file.  len() is the
+    number of detections.
+
+    Keyword Arguments:
+    ==================
+    filename -- snapshot written by QGSnapshotWriter.
+    """
+    def __init__(self, filename):
+        fp = open(filename, 'rb')
+        try:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fp.close()
+        (magic, self._nhosts, self._ndetections, self._host_offset,
+         self._detection_offset, self._qid_offset, string_offset,
+         string_length) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self._map.close()
+            raise ValueError("%s is not a QualysConnect snapshot"%(filename,))
+        self._strings = json.loads(self._map[string_offset:
+                                             string_offset + string_length])
+
+    def close(self):
+        self._map.close()
+
+    def __len__(self):
+        return self._ndetections
+
+    def host_count(self):
+        return self._nhosts
+
+    def host(self, ip):
+        """ Return the record of host ip (with its 'detections') or None. """
+        key = parse_address(ip)
+        (low, high) = (0, self._nhosts)
+        while low < high:
+            middle = (low + high) // 2
+            if self._host_key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self._nhosts and self._host_key(low) == key:
+            return self.host_at(low)
+        return None
+
+    def hosts(self):
+        """ Generator yielding every host record in address order. """
+        for n in xrange(self._nhosts):
+            yield self.host_at(n)
+
+    def host_at(self, n, detections=True):
+        """ Return host record number n (in address order). """
+        (address, version, os_code, tracking, host_id, last_scan, first,
+         count) = HOST_RECORD.unpack_from(self._map, self._host_offset +
+                                          n * HOST_RECORD.size)
+        record = {'ip': format_address(version, _address_value(address)),
+                  'ip_version': version,
+                  'id': host_id,
+                  'os': self._decode('os', os_code),
+                  'tracking_method': self._decode('tracking_method', tracking),
+                  'last_scan': last_scan or None}
+        if detections:
+            record['detections'] = [self.detection_at(d, record)
+                                    for d in xrange(first, first + count)]
+        return record
+
+    def qid(self, qid):
+        """ Return the detections of QID qid on every host, in address
+        order.  Each detection carries its host's 'ip'.
+        """
+        qid = int(qid)
+        (low, high) = (0, self._ndetections)
+        while low < high:
+            middle = (low + high) // 2
+            if self._qid_at(middle) < qid:
+                low = middle + 1
+            else:
+                high = middle
+        result = []
+        while low < self._ndetections and self._qid_at(low) == qid:
+            (n,) = QID_ENTRY.unpack_from(self._map, self._qid_offset +
+                                         low * QID_ENTRY.size)
+            result.append(self.detection_at(n))
+            low += 1
+        return result
+
+    def detection_at(self, n, host=None):
+        """ Return detection record number n.  host is its host's record if
+        the caller already has it.
+        """
+        values = DETECTION_RECORD.unpack_from(self._map, self._detection_offset +
+                                              n * DETECTION_RECORD.size)
+        record = dict(zip(_DETECTION_FIELDS, values))
+        for field in ('type', 'status', 'protocol'):
+            record[field] = self._decode(field, record[field])
+        for field in ('first_found', 'last_found', 'last_test'):
+            record[field] = record[field] or None
+        if host is None:
+            host = self.host_at(record['host'], detections=False)
+        record['ip'] = host['ip']
+        return record
+
+    def _host_key(self, n):
+        offset = self._host_offset + n * HOST_RECORD.size
+        (address, version) = struct.unpack_from('<16sB', self._map, offset)
+        return (version, _address_value(address))
+
+    def _qid_at(self, n):
+        (detection,) = QID_ENTRY.unpack_from(self._map, self._qid_offset +
+                                             n * QID_ENTRY.size)
+        return struct.unpack_from('<I', self._map, self._detection_offset +
+                                  detection * DETECTION_RECORD.size + 4)[0]
+
+    def _decode(self, column, code):
+        return self._strings[column][code]
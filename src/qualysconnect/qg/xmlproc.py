@@ -3,46 +3,258 @@ Most (if not all) names in this module are named with the QGXP prefix.
 
 QGXP_ -> QualysGuard XML Processor
 """
+import re
 import logging
-import xml.dom.minidom
 
-from datetime import datetime
+from xml.sax.saxutils import unescape
+
+from datetime import datetime, date, timedelta, tzinfo
+from cStringIO import StringIO
 
 from lxml import etree, objectify
 
+from qualysconnect.ipset import IPSet, parse_token
+
+try:
+    import numpy
+except ImportError:
+    # NumPy is only needed for QGXP_qgdt_to_epoch(as_numpy=True).
+    numpy = None
+
 __author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
 __copyright__ = "Copyright 2011-2013, University of Waterloo"
 __license__ = "BSD-new"
 
+def _is_stream(qgXML):
+    """ Return True if qgXML is a file-like object rather than a string. """
+    return hasattr(qgXML, 'read')
+
+def QGXP_iter_hostlist(qgXML):
+    """ Generator yielding the text of each IP element of a QualysGuard HOST
+    LIST XML block, in document order.  The response is parsed incrementally
+    and processed elements are discarded, so memory use does not grow with
+    the number of hosts.
+
+    Keyword Arguments:
+    qgXML -- A string representing an entire response from QualysGuard, or a
+             file-like object (e.g. from QGConnector.request_stream).
+    """
+    if not _is_stream(qgXML):
+        qgXML = StringIO(qgXML)
+
+    for (event, elem) in etree.iterparse(qgXML, events=('end',)):
+        if elem.tag == 'IP' and elem.text:
+            yield elem.text
+        _release(elem)
+
 def QGXP_hostlist_to_list(qgXML):
     """ Return a list of IPs pulled from a QualysGuard HOST LIST XML block.
     
+    Keyword Arguments:
+    qgXML -- A string representing an entire response from QualysGuard, or a
+             file-like object (e.g. from QGConnector.request_stream).
+    """
+    return list(QGXP_iter_hostlist(qgXML))
+
+def QGXP_hostlist_to_ipset(qgXML):
+    """ Return an ipset.IPSet of the IPs (and IP ranges) in a QualysGuard HOST
+    LIST XML block, without building a list of IP strings.  Consecutive
+    addresses are merged as they are read, so a sorted host list costs one
+    interval per contiguous block.
+
+    Keyword Arguments:
+    qgXML -- A string representing an entire response from QualysGuard, or a
+             file-like object (e.g. from QGConnector.request_stream).
+    """
+    intervals = []
+    for ip in QGXP_iter_hostlist(qgXML):
+        (version, start, end) = parse_token(ip)
+        if intervals:
+            (last_version, last_start, last_end) = intervals[-1]
+            if (version == last_version and
+                last_start <= start <= last_end + 1):
+                intervals[-1] = (version, last_start, max(end, last_end))
+                continue
+        intervals.append((version, start, end))
+    return IPSet(intervals)
+
+def _leaf_text(elem):
+    """ Return a dictionary of tag -> text for the leaf children of elem. """
+    record = {}
+    for child in elem.iterchildren():
+        if len(child) == 0 and isinstance(child.tag, basestring):
+            record[child.tag] = child.text
+    return record
+
+def _release(elem):
+    """ Clear a fully processed element and drop the references its parent
+    holds to already processed siblings, so iterparse memory stays bounded.
+    """
+    elem.clear()
+    parent = elem.getparent()
+    if parent is not None:
+        while elem.getprevious() is not None:
+            del parent[0]
+
+def QGXP_iter_host_detections(qgXML):
+    """ Generator that incrementally parses a QualysGuard host detection
+    (asset/host/vm/detection/) response and yields one record per HOST.
+
+    Each record is a dictionary of the HOST's simple fields (IP, DNS, OS,
+    LAST_SCAN_DATETIME, ...) with an additional 'DETECTIONS' key holding a
+    list of dictionaries, one per DETECTION (QID, TYPE, SEVERITY, ...).
+    Processed elements are discarded as parsing proceeds, so memory use does
+    not grow with the number of hosts.
+
+    Keyword Arguments:
+    qgXML -- A file-like object (e.g. from QGConnector.request_stream) or a
+             string representing an entire response from QualysGuard.
+    """
+    if not _is_stream(qgXML):
+        qgXML = StringIO(qgXML)
+
+    for (event, host) in etree.iterparse(qgXML, events=('end',), tag='HOST'):
+        record = _leaf_text(host)
+        record['DETECTIONS'] = [_leaf_text(detection) for detection
+                                in host.iterfind('DETECTION_LIST/DETECTION')]
+        _release(host)
+        yield record
+
+_QGXP_WARNING_URL = re.compile(r'<URL>\s*(?:<!\[CDATA\[)?(.*?)(?:\]\]>)?\s*</URL>',
+                               re.DOTALL)
+
+def QGXP_truncation_url(qgXML):
+    """ Return the URL QualysGuard provides in the WARNING block of a
+    truncated v2 list response for fetching the next batch of results, or
+    None if the response was not truncated.
+
     Keyword Arguments:
     qgXML -- A string representing an entire response from QualysGuard.
     """
-    hosts = []
-    parsed = xml.dom.minidom.parseString(qgXML)
-    host_list = parsed.getElementsByTagName("IP")
-    
-    for host in host_list:
-        hosts.append(host.childNodes[0].data)
-            
-    return hosts
+    # the WARNING block trails the data, search only from its last occurrence
+    start = qgXML.rfind('<WARNING>')
+    if start < 0:
+        return None
+    match = _QGXP_WARNING_URL.search(qgXML, start)
+    if not match:
+        return None
+    return unescape(match.group(1).strip())
+
+_QGXP_RESPONSE_DATETIME = re.compile(r'<DATETIME>\s*([^<\s]+)\s*</DATETIME>')
+
+def QGXP_response_datetime(qgXML):
+    """ Return the DATETIME (QualysGuard's clock when it answered) heading a
+    v2 response, or None if it has none.
+
+    Keyword Arguments:
+    qgXML -- A string representing an entire response from QualysGuard.
+    """
+    match = _QGXP_RESPONSE_DATETIME.search(qgXML)
+    if not match:
+        return None
+    return match.group(1)
 
 def QGXP_lxml_objectify(qgXML):
     """ Processes an XML response from QualysGuard and Returns an easy to
     access python object containing the information.
-    
+
+    qgXML may be a string or a file-like object (e.g. from
+    QGConnector.request_stream) which is parsed without first being read into
+    memory.
     """
-    tree = objectify.fromstring(qgXML)
-    logging.debug(objectify.dump(tree))
+    if _is_stream(qgXML):
+        tree = objectify.parse(qgXML).getroot()
+    else:
+        tree = objectify.fromstring(qgXML)
+    # dumping the tree is expensive, only do it when it will be displayed.
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(objectify.dump(tree))
 
     return tree
 
+class _QGXP_UTC(tzinfo):
+    """ UTC, the timezone of every QualysGuard datetime. """
+    def utcoffset(self, dt):
+        return timedelta(0)
+
+    def tzname(self, dt):
+        return "UTC"
+
+    def dst(self, dt):
+        return timedelta(0)
+
+    def __repr__(self):
+        return "QGXP_UTC"
+
+QGXP_UTC = _QGXP_UTC()
+
+_QGXP_QGDT = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)Z\Z')
+
+# Recently converted datetimes; scans share a handful of timestamps.
+_QGXP_QGDT_MEMO_SIZE = 65536
+_qgdt_memo = {}
+
+def _qgdt_fields(qgdt):
+    """ Return (year, month, day, hour, minute, second) of a QualysGuard
+    datetime string, raising ValueError if it is not one.
+    """
+    match = _QGXP_QGDT.match(qgdt)
+    if match is None:
+        raise ValueError("time data %r does not match format "
+                         "'yyyy-mm-ddThh:mm:ssZ'"%(qgdt,))
+    fields = [int(field) for field in match.groups()]
+    (hour, minute, second) = fields[3:]
+    if hour > 23 or minute > 59 or second > 59:
+        raise ValueError("time of %r is out of range"%(qgdt,))
+    return fields
+
 def QGXP_qgdt_to_datetime(qgdt):
     """ Takes a QualysGuard format datetime string (yyyy-mm-ddThh:mm:ssZ) and
-    Returns a python datetime object.
+    Returns a timezone aware (UTC) python datetime object.
     
     """
-    QGDT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
-    return datetime.strptime(str(qgdt),QGDT_FORMAT)
+    qgdt = str(qgdt)
+    dt = _qgdt_memo.get(qgdt)
+    if dt is None:
+        dt = datetime(*_qgdt_fields(qgdt), tzinfo=QGXP_UTC)
+        if len(_qgdt_memo) >= _QGXP_QGDT_MEMO_SIZE:
+            _qgdt_memo.clear()
+        _qgdt_memo[qgdt] = dt
+    return dt
+
+_EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+def QGXP_qgdt_to_epoch(qgdts, as_numpy=False):
+    """ Convert a sequence of QualysGuard format datetime strings (e.g. the
+    LAST_FOUND values of many detections) to seconds since the epoch.
+
+    Returns a list of integers, with None for missing (None or empty) values.
+    With as_numpy, returns a NumPy datetime64[s] array instead, with NaT for
+    missing values (requires NumPy).  Repeated values are converted once.
+
+    Keyword Arguments:
+    qgdts -- iterable of datetime strings.
+    as_numpy -- [optional] return a NumPy array.
+    """
+    if as_numpy and numpy is None:
+        raise ImportError("QGXP_qgdt_to_epoch(as_numpy=True) requires numpy")
+
+    memo = {None: None, '': None}
+    epochs = []
+    for qgdt in qgdts:
+        try:
+            epoch = memo[qgdt]
+        except KeyError:
+            (year, month, day, hour, minute, second) = _qgdt_fields(str(qgdt))
+            epoch = ((date(year, month, day).toordinal() - _EPOCH_ORDINAL) * 86400
+                     + hour * 3600 + minute * 60 + second)
+            memo[qgdt] = epoch
+        epochs.append(epoch)
+
+    if not as_numpy:
+        return epochs
+    missing = numpy.array([epoch is None for epoch in epochs], dtype=bool)
+    array = numpy.array([epoch or 0 for epoch in epochs],
+                        dtype='int64').astype('datetime64[s]')
+    array[missing] = numpy.datetime64('NaT')
+    return array
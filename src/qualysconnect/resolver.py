@@ -0,0 +1,223 @@
+""" Module providing HostResolver, a caching resolver that looks up many
+hostnames concurrently.
+
+  resolver = HostResolver()
+  (addresses, failures) = resolver.resolve_many(hostnames)
+  for name, error in failures.items():
+      print "%s: %s"%(name, error)
+  print resolver.stats()
+
+Lookups run on a pool of worker threads (socket.getaddrinfo blocks).  Answers
+are kept in a least recently used cache for 'ttl' seconds and failed lookups
+for 'negative_ttl' seconds, so repeated or overlapping inventories cost one
+lookup per distinct name.
+"""
+import time
+import socket
+import logging
+import threading
+
+from collections import OrderedDict
+
+import qualysconnect.settings as qcs
+
+from qualysconnect.workers import QGWorkerPool
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+def _getaddrinfo(hostname):
+    # simplify request.  ask for a simple TCP socket to http.  we only want IP
+    return socket.getaddrinfo(hostname, 'http')
+
+class HostResolver:
+    """ Resolve hostnames to IP addresses with caching and concurrency.
+
+    Keyword Arguments:
+    ==================
+    workers -- [optional] concurrent lookups (settings.resolver_workers).
+    ttl -- [optional] seconds an answer is cached (settings.resolver_ttl).
+    negative_ttl -- [optional] seconds a failed lookup is cached
+                    (settings.resolver_negative_ttl).
+    cache_size -- [optional] names kept in the cache
+                  (settings.resolver_cache_size).
+    getaddrinfo -- [optional] callable(hostname) returning a
+                   socket.getaddrinfo style list, or raising socket.error.
+                   Replaces the system resolver (e.g. with a stub).
+    """
+    def __init__(self, workers=None, ttl=None, negative_ttl=None,
+                 cache_size=None, getaddrinfo=None):
+        if workers is None:
+            workers = qcs.resolver_workers
+        if ttl is None:
+            ttl = qcs.resolver_ttl
+        if negative_ttl is None:
+            negative_ttl = qcs.resolver_negative_ttl
+        if cache_size is None:
+            cache_size = qcs.resolver_cache_size
+        self._workers = workers
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._cache_size = cache_size
+        self._getaddrinfo = getaddrinfo or _getaddrinfo
+        self._cache = OrderedDict()     # hostname -> (expires, addresses, error)
+        self._lock = threading.Lock()
+
+        # counters exposed through stats()
+        self.lookups = 0
+        self.failures = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.lookup_time = 0.0
+        self.max_lookup_time = 0.0
+
+    def resolve(self, hostname, all_addresses=False):
+        """ Return the first IP address of hostname, or the list of all its
+        IPv4/IPv6 addresses if all_addresses is set.  Raises the resolver's
+        socket.error (possibly a cached one) if the name cannot be resolved.
+        """
+        addresses = self._cached(hostname)
+        if addresses is None:
+            addresses = self._lookup(hostname)
+        if all_addresses:
+            return list(addresses)
+        return addresses[0]
+
+    def resolve_many(self, hostnames, all_addresses=False):
+        """ Resolve hostnames concurrently.  Returns (addresses, failures),
+        dictionaries mapping each resolved hostname to its address (or list
+        of addresses, as resolve()) and each unresolvable hostname to the
+        error its lookup raised.
+        """
+        resolved = {}
+        failures = {}
+        pending = []
+        for hostname in hostnames:
+            if hostname in resolved or hostname in failures:
+                continue
+            try:
+                addresses = self._cached(hostname)
+            except socket.error, e:
+                failures[hostname] = e
+                continue
+            if addresses is None:
+                pending.append(hostname)
+                resolved[hostname] = None
+            else:
+                resolved[hostname] = addresses
+
+        if pending:
+            workers = QGWorkerPool(min(self._workers, len(pending)))
+            finished = False
+            try:
+                futures = [(hostname, workers.submit(self._lookup, hostname))
+                           for hostname in pending]
+                for (hostname, future) in futures:
+                    error = future.exception()
+                    if error is None:
+                        resolved[hostname] = future.result()
+                    else:
+                        del resolved[hostname]
+                        failures[hostname] = error
+                finished = True
+            finally:
+                workers.shutdown(wait=finished)
+
+        for hostname, addresses in resolved.items():
+            if all_addresses:
+                resolved[hostname] = list(addresses)
+            else:
+                resolved[hostname] = addresses[0]
+        return (resolved, failures)
+
+    def clear(self):
+        """ Forget every cached answer. """
+        self._lock.acquire()
+        try:
+            self._cache.clear()
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        """ Return a dictionary of cache and lookup latency metrics. """
+        self._lock.acquire()
+        try:
+            mean = 0.0
+            if self.lookups:
+                mean = self.lookup_time / self.lookups
+            return {'lookups': self.lookups,
+                    'failures': self.failures,
+                    'hits': self.hits,
+                    'negative_hits': self.negative_hits,
+                    'cached': len(self._cache),
+                    'lookup_time': self.lookup_time,
+                    'mean_lookup_time': mean,
+                    'max_lookup_time': self.max_lookup_time}
+        finally:
+            self._lock.release()
+
+    def _cached(self, hostname):
+        """ Return the cached addresses of hostname, None if it is not cached
+        (or has expired).  Raises the cached error of a failed lookup.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._cache.pop(hostname, None)
+            if entry is None or entry[0] < time.time():
+                return None
+            self._cache[hostname] = entry    # most recently used
+            (expires, addresses, error) = entry
+            if error is not None:
+                self.negative_hits += 1
+                raise error
+            self.hits += 1
+            return addresses
+        finally:
+            self._lock.release()
+
+    def _lookup(self, hostname):
+        """ Resolve hostname, cache the outcome and return its addresses. """
+        start = time.time()
+        addresses = None
+        error = None
+        try:
+            addrinfo = self._getaddrinfo(hostname)
+            logger.debug('getaddrinfo returned %s'%(addrinfo,))
+            addresses = []
+            for (family, socktype, proto, canonname, sockaddr) in addrinfo:
+                # ipv4 sockaddr is a 2-tuple, ipv6 a 4-tuple; both start w/ IP
+                if (family in (socket.AF_INET, socket.AF_INET6) and
+                    sockaddr[0] not in addresses):
+                    addresses.append(sockaddr[0])
+            if not addresses:
+                error = socket.gaierror(socket.EAI_NONAME,
+                                        "Could not determine IP associated "
+                                        "w/ %s"%(hostname,))
+        except socket.error, e:
+            error = e
+        elapsed = time.time() - start
+
+        self._lock.acquire()
+        try:
+            self.lookups += 1
+            self.lookup_time += elapsed
+            self.max_lookup_time = max(self.max_lookup_time, elapsed)
+            if error is not None:
+                self.failures += 1
+                ttl = self._negative_ttl
+            else:
+                ttl = self._ttl
+            if ttl > 0 and self._cache_size > 0:
+                self._cache.pop(hostname, None)
+                self._cache[hostname] = (time.time() + ttl, addresses, error)
+                while len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+        finally:
+            self._lock.release()
+
+        if error is not None:
+            raise error
+        return addresses
@@ -10,3 +10,102 @@ global default_filename
 default_filename = ".qcrc"
 
 defaults = { 'hostname' : 'qualysapi.qualys.com' }
+
+# Persistent connection pool (qualysconnect.qg.pool) defaults.  Number of idle
+#  keep-alive connections kept per QualysGuard host and seconds before an idle
+#  connection is closed.
+pool_maxsize = 4
+pool_idle_timeout = 60
+
+# Size in bytes of the chunks read by QGConnector.iter_request().
+stream_chunk_size = 64 * 1024
+
+# Maximum number of API calls qualysconnect will run at the same time.  Keep
+#  this at or below the subscription's concurrency limit
+#  (X-Concurrency-Limit-Limit, 2 by default).
+concurrency_limit = 2
+
+# Host records each shard of a qualysconnect.qg.detection sharded fetch may
+#  buffer while waiting for earlier shards to be consumed.
+detection_shard_buffer = 1000
+
+# Rate limit scheduler (qualysconnect.qg.ratelimit) defaults.  Calls kept in
+#  reserve per window, seconds to back off when QualysGuard throttles (409)
+#  without saying how long to wait, and how many times a throttled call is
+#  retried.
+ratelimit_reserve = 0
+ratelimit_backoff = 5
+ratelimit_retries = 3
+
+# AsyncQGAPISession (qualysconnect.qg.asyncconnect) defaults.  Worker threads
+#  (qualysconnect.workers.QGWorkerPool) running blocking calls and chunks buffered per streamed response.
+async_workers = 16
+async_stream_buffer = 16
+
+# Session cache (qualysconnect.qg.sessioncache) defaults.  Cache files are
+#  named <session_cache_filename>-<user>@<host> in the user's home directory
+#  and a cached session unused for session_cache_max_age seconds is not
+#  trusted.
+session_cache_filename = ".qcsession"
+session_cache_max_age = 3600
+
+# Retry policy (qualysconnect.qg.retry) defaults.  Retries per call, initial
+#  and maximum backoff in seconds, and seconds after a call's first attempt
+#  past which it is no longer retried.
+retry_count = 5
+retry_backoff = 1
+retry_max_backoff = 60
+retry_deadline = 600
+
+# Socket timeout in seconds for a single read/connect on an API connection.
+request_timeout = 300
+
+# Report pipeline (qualysconnect.qg.reports) defaults.  Reports generating at
+#  the same time and the shortest/longest interval in seconds between polls
+#  of their progress.
+report_concurrency = 5
+report_poll_min = 10
+report_poll_max = 120
+
+# Request size limits.  GET requests whose URL would exceed max_url_length
+#  are sent as POST with the parameters in the body.  util.split_ip_string
+#  splits 'ips' lists into strings of at most ips_request_max_bytes covering
+#  at most ips_request_max_hosts addresses (None for no limit).
+max_url_length = 2048
+ips_request_max_bytes = 8192
+ips_request_max_hosts = None
+
+# Hostname resolver (qualysconnect.resolver) defaults.  Concurrent lookups,
+#  seconds an answer / a failed lookup stays cached and names kept cached.
+resolver_workers = 32
+resolver_ttl = 300
+resolver_negative_ttl = 60
+resolver_cache_size = 50000
+
+# Local detection cache (qualysconnect.qg.detectioncache) database file, kept
+#  in the user's home directory, and seconds each incremental sync reaches
+#  back before the previous one started (covers clock skew and processing
+#  still in flight).
+detection_cache_filename = ".qcdetections.db"
+detection_cache_sync_margin = 300
+
+# Response cache (qualysconnect.qg.responsecache) defaults.  Seconds the
+#  responses of read-only requests to each endpoint are cached (endpoints not
+#  listed are never cached), total size of cached bodies in bytes and the
+#  on-disk cache directory, kept in the user's home directory.
+response_cache_ttls = {
+    'report_template_list.php': 3600,
+    'scan_report_list.php': 300,
+    'asset_group_list.php': 3600,
+    'scan/': 300,
+    'knowledge_base/vuln/': 86400,
+}
+response_cache_max_bytes = 64 * 1024 * 1024
+response_cache_directory = ".qcresponses"
+
+# Report parsing pool (qualysconnect.qg.parsepool) defaults.  Worker
+#  processes (1 parses in the calling process, None starts one per CPU) and
+#  the approximate size in bytes of the piece of a report each worker parses
+#  at a time.
+parse_workers = 1
+parse_chunk_bytes = 16 * 1024 * 1024
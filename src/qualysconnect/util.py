@@ -1,9 +1,16 @@
 """ A set of utility functions for QualysConnect module. """
+import os
 import logging
 import socket
 
 import qualysconnect.config as qcconf
+import qualysconnect.settings as qcs
 import qualysconnect.qg.connect as qcconn
+import qualysconnect.qg.sessioncache as qcsc
+import qualysconnect.qg.responsecache as qcrc
+import qualysconnect.resolver as qcres
+
+from qualysconnect.ipset import IPSet, parse_token, format_address
 
 __author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
 __copyright__ = "Copyright 2011-2013, University of Waterloo"
@@ -26,6 +33,21 @@ logging.getLogger(__name__).addHandler(logger_console)
 # Set module level logger.
 logger = logging.getLogger(__name__)
 
+def build_response_cache(conf, kind=None):
+    """ Return the QGResponseCache the config file asks for (see
+    QualysConnectConfig.get_response_cache) or None.
+    """
+    if kind is None:
+        kind = conf.get_response_cache()
+    if kind == 'memory':
+        return qcrc.QGResponseCache(qcrc.QGMemoryCache())
+    if kind == 'disk':
+        directory = os.path.join(os.getenv("HOME"), "%s-%s@%s"%
+                                 (qcs.response_cache_directory,
+                                  conf.get_username(), conf.get_hostname()))
+        return qcrc.QGResponseCache(qcrc.QGDiskCache(directory))
+    return None
+
 def build_v1_connector():
     """ Return a QGAPIConnect object for v1 API pulling settings from config
     file.
@@ -33,7 +55,8 @@ def build_v1_connector():
     conf = qcconf.QualysConnectConfig()
     connect = qcconn.QGAPIConnect(conf.get_username(),
                                   conf.get_password(),
-                                  conf.get_hostname())
+                                  conf.get_hostname(),
+                                  pResponseCache=build_response_cache(conf))
     logger.info("Finished building v1 Connector.")
     return connect
 
@@ -44,37 +67,55 @@ def build_v2_connector():
     conf = qcconf.QualysConnectConfig()
     connect = qcconn.QGAPIConnect(conf.get_username(),
                                   conf.get_password(),
-                                  conf.get_hostname(),2)
+                                  conf.get_hostname(),2,
+                                  pResponseCache=build_response_cache(conf))
     logger.info("Finished building v2 BasicAuth Connector.")
     return connect
 
-def build_v2_session():
+def build_v2_session(cache=None):
     """ Return a QGAPISession object for v2 API pulling settings for config
     file.
+
+    If cache is True (or None and the config file sets 'session_cache = yes')
+    the session cookie is cached on disk and reused by later runs.
     """
     conf = qcconf.QualysConnectConfig()
+    if cache is None:
+        cache = conf.get_session_cache()
+    session_cache = None
+    if cache:
+        session_cache = qcsc.QGSessionCache(conf.get_hostname(),
+                                            conf.get_username())
     connect = qcconn.QGAPISession(conf.get_username(),
                                   conf.get_password(),
-                                  conf.get_hostname())
+                                  conf.get_hostname(),
+                                  pSessionCache=session_cache,
+                                  pResponseCache=build_response_cache(conf))
     logger.info("Finished building v2 Connector.")
     return connect
 
-def hostname_to_ip(hostname):
-    """ Takes a hostname and returns the corresponding IP address. """
-    
-    # simplify request.  ask for a simple TCP socket to http.  we only want IP
-    addrinfo = socket.getaddrinfo(hostname, 'http')
-    
-    logger.debug('getaddrinfo returned %s'%(addrinfo,))
-    
-    family, socktype, proto, canonname, sockaddr = addrinfo[0]
-    
-    if family == socket.AF_INET:  # ipv4 sockaddr return is a 2-tuple
-        return sockaddr[0]
-    elif family == socket.AF_INET6: # ipv6 sockaddr return is a 4-tuple
-        return sockaddr[0]
-    else:
-        raise Exception("Could not determine IP associated w/ %s"%(hostname,))
+# resolver shared by hostname_to_ip/hostnames_to_ips, created on first use.
+_resolver = None
+
+def get_resolver():
+    """ Return the HostResolver (and its cache) shared by this module. """
+    global _resolver
+    if _resolver is None:
+        _resolver = qcres.HostResolver()
+    return _resolver
+
+def hostname_to_ip(hostname, all_addresses=False):
+    """ Takes a hostname and returns the corresponding IP address (or the list
+    of all its IPv4/IPv6 addresses if all_addresses is set).
+    """
+    return get_resolver().resolve(hostname, all_addresses)
+
+def hostnames_to_ips(hostnames, all_addresses=False):
+    """ Resolve many hostnames concurrently.  Returns (addresses, failures),
+    dictionaries mapping resolved hostnames to their IP address (or list of
+    addresses) and unresolvable hostnames to the lookup error.
+    """
+    return get_resolver().resolve_many(hostnames, all_addresses)
 
 # ---
 # BEYOND HERE lie deprecated dragons.  :-S
@@ -126,138 +167,6 @@ try:
         """
         return is_valid_ip_address(address,6)
     
-    def is_valid_ip_range(iprange, version=None):
-        """ Check validity of iprange
-            Return True if 'iprange' is a range of ip addresses in a format that
-            Qualys's API will accept (i.e. "startip-endip" where
-            startip < endip).
-        """
-        # Validate version:
-        if version:
-            if not isinstance(version, int):
-                raise TypeError('Version is not of type "int"')
-                return False
-            if not (version == 4 or version == 6):
-                raise ValueError('IP version is set to an invalid number: %s' %
-                                 version)
-                return False
-        
-        try:
-            (start_ip,end_ip) = iprange.split('-')
-            if ipaddr.IPAddress(start_ip) == ipaddr.IPAddress(end_ip):
-                logger.debug('%s/%s-%s, Error: %s' %
-                              (package,module,version,
-                               'Start and End IP Address in an IP Range can' \
-                               'not be the same IP Address.'))
-                return False
-            # A valid range requires:
-            # 1) The start_ip must be a valid ipv4 address.
-            # 2) The end_ip must be a valid ipv4 address.
-            # 3) The start_ip must be less than the end_ip.
-            # Although socket operations are nice (as shown in the ipaddr free
-            #  code in qualysconnect.util), it's not feasible to determine that the
-            #  start_ip is less than the end_ip without considerable effort.
-            # We'll use the ipaddr.summarize_address_range function to test all
-            #  three at one time.
-            ipaddr.summarize_address_range(ipaddr.IPAddress(start_ip,version),
-                                           ipaddr.IPAddress(end_ip,version))
-        except ipaddr.AddressValueError, e:
-            logger.debug('%s/%s-%s, Error: %s' % (package,module,version,e))
-            return False
-        except ValueError, e:
-            logger.debug('%s/%s-%s, Error: %s' % (package,module,version,e))
-            return False
-        return True
-    
-    def is_valid_ipv4_range(iprange):
-        """ Check validity of iprange
-            Return True if 'iprange' is a range of ipv4 addresses in a format
-            that Qualys's API will accept (i.e. "startip-endip" where
-            startip < endip).
-        """
-        return is_valid_ip_range(iprange,4)
-    
-    def is_valid_ipv6_range(iprange):
-        """ Check validity of iprange
-            Return True if 'iprange' is a range of ipv4 addresses in a format
-            that Qualys's API will accept (i.e. "startip-endip" where
-            startip < endip).
-        """
-        return is_valid_ip_range(iprange,6)
-    
-    def cidr_to_ip(cidr,version=None):
-        """ Convert an ip address or ip range provided in cidr notation (either
-        bitmask or netmask notation) to the ip address or ip range format that
-        is accepted by Qualys's API. (e.g. cidr_to_ip('10.0.0.0/24') returns the
-        string '10.0.0.0-10.0.0.255'.
-            Returns a String containing an ip address or ip range that can be
-            provided to the Qualys API. 
-        """
-        # Validate version:
-        if version:
-            if not isinstance(version, int):
-                raise TypeError, 'Version is not of type "int"'
-                return False
-            if not (version == 4 or version == 6):
-                raise ValueError, 'IP version is set to an invalid number: %s' % version
-                return False
-        try:
-            cidr_net = ipaddr.IPNetwork(cidr,version)
-        except ValueError, e:
-            logger.debug('%s/%s-%s, Error: %s' % (package,module,version,e))
-            raise ValueError, e
-        if cidr_net[0] == cidr_net[-1]:
-            return str(cidr_net[0])
-        iprange = '%s-%s' % (cidr_net[0],cidr_net[-1])
-        return iprange
-    
-    def cidr_to_ipv4(cidr):
-        """ Convert an ipv4 address or ipv4 range provided in cidr notation
-        (either bitmask or netmask notation) to the ip address or ip range
-        format that is accepted by Qualys's API.
-        (e.g. cidr_to_ip('192.0.2.0/24') returns the string
-        '192.0.2.0-192.0.2.255'.
-            Returns a String containing an ip address or ip range that can be
-            provided to the Qualys API. 
-        """
-        return cidr_to_ip(cidr,4)
-    
-    def cidr_to_ipv6(cidr):
-        """ Convert an ipv6 address or ipv6 range provided in cidr notation
-        (either bitmask or netmask notation) to the ip address or ip range
-        format that is accepted by Qualys's API. (e.g.
-        cidr_to_ip('2001:db8::fff/120') returns the string
-        '2001:db8::f00-2001:db8::fff'.
-            Returns a String containing an ipv6 address or ipv6 range that can
-            be provided to the Qualys API. 
-        """
-        return cidr_to_ip(cidr,4)
-    
-    def decode_ip_string(ipstring):
-        """ Validates ipstring is in a format that can be provided to the Qualys
-        API, if it is not in a format that can be accepted by the Qualys API, it
-        attempts to put it in a format that is acceptable (e.g. converting cidr
-        notation to the ip range notation that Qualys expects)
-            Returns a string that is valid to hand to the 'ips' key in the
-            Qualys API.
-        """
-        cml=[]
-        ip_list = ipstring.split(',')
-        # Should probably check for any repeated or overlapping IP addresses here,
-        # but skipping for now.
-        for i in ip_list:
-            # This is a kludge, but I couldn't come up with a good way to make the
-            # error report the string that generated the error, rather than the
-            # potentially modified version of the string that caused the error.
-            new_i=i 
-            if '/' in i:
-                new_i = cidr_to_ip(i)
-            if (is_valid_ip_address(new_i) or is_valid_ip_range(new_i)):
-                cml.append(new_i)
-            else:
-                raise ValueError("IP argument cannot be parsed, \'%s\' is not" \
-                                 "a valid IP Range or IP Address" % i)
-        return ",".join(cml)
 except ImportError:
     # BEGIN deprecated - Rudimentary "non-ipaddr" IP utilities. 
     logger.warn("DEPRECATED: using simple IP utilities." \
@@ -297,3 +206,162 @@ except ImportError:
             return True
         else:
             return False
+
+# ---
+# IP set utilities.  These are built on qualysconnect.ipset and work with or
+#  without ipaddr installed.
+# ---
+def _check_version(version):
+    """ Raise TypeError/ValueError unless version is None, 4 or 6. """
+    if version:
+        if not isinstance(version, int):
+            raise TypeError('Version is not of type "int"')
+        if not (version == 4 or version == 6):
+            raise ValueError('IP version is set to an invalid number: %s' %
+                             version)
+
+def is_valid_ip_range(iprange, version=None):
+    """ Check validity of iprange
+        Return True if 'iprange' is a range of ip addresses in a format that
+        Qualys's API will accept (i.e. "startip-endip" where
+        startip < endip).
+    """
+    _check_version(version)
+    if '-' not in iprange or '/' in iprange:
+        return False
+    try:
+        (range_version, start, end) = parse_token(iprange)
+    except ValueError, e:
+        logger.debug('%s/%s-%s, Error: %s' % (package,module,version,e))
+        return False
+    return not version or range_version == version
+
+def is_valid_ipv4_range(iprange):
+    """ Check validity of iprange
+        Return True if 'iprange' is a range of ipv4 addresses in a format
+        that Qualys's API will accept (i.e. "startip-endip" where
+        startip < endip).
+    """
+    return is_valid_ip_range(iprange,4)
+
+def is_valid_ipv6_range(iprange):
+    """ Check validity of iprange
+        Return True if 'iprange' is a range of ipv6 addresses in a format
+        that Qualys's API will accept (i.e. "startip-endip" where
+        startip < endip).
+    """
+    return is_valid_ip_range(iprange,6)
+
+def cidr_to_ip(cidr,version=None):
+    """ Convert an ip address or ip range provided in cidr notation (either
+    bitmask or netmask notation) to the ip address or ip range format that
+    is accepted by Qualys's API. (e.g. cidr_to_ip('10.0.0.0/24') returns the
+    string '10.0.0.0-10.0.0.255'.
+        Returns a String containing an ip address or ip range that can be
+        provided to the Qualys API.  Raises ValueError if cidr is invalid.
+    """
+    _check_version(version)
+    try:
+        if '-' in cidr:
+            raise ValueError("'%s' is not in cidr notation" % cidr)
+        (cidr_version, start, end) = parse_token(cidr)
+        if version and cidr_version != version:
+            raise ValueError("'%s' is not an IPv%d network" % (cidr, version))
+    except ValueError, e:
+        logger.debug('%s/%s-%s, Error: %s' % (package,module,version,e))
+        raise
+    if start == end:
+        return format_address(cidr_version, start)
+    return '%s-%s' % (format_address(cidr_version, start),
+                      format_address(cidr_version, end))
+
+def cidr_to_ipv4(cidr):
+    """ Convert an ipv4 address or ipv4 range provided in cidr notation
+    (either bitmask or netmask notation) to the ip address or ip range
+    format that is accepted by Qualys's API.
+    (e.g. cidr_to_ip('192.0.2.0/24') returns the string
+    '192.0.2.0-192.0.2.255'.
+        Returns a String containing an ip address or ip range that can be
+        provided to the Qualys API. 
+    """
+    return cidr_to_ip(cidr,4)
+
+def cidr_to_ipv6(cidr):
+    """ Convert an ipv6 address or ipv6 range provided in cidr notation
+    (either bitmask or netmask notation) to the ip address or ip range
+    format that is accepted by Qualys's API. (e.g.
+    cidr_to_ip('2001:db8::fff/120') returns the string
+    '2001:db8::f00-2001:db8::fff'.
+        Returns a String containing an ipv6 address or ipv6 range that can
+        be provided to the Qualys API. 
+    """
+    return cidr_to_ip(cidr,6)
+
+def decode_ip_string(ipstring):
+    """ Validates ipstring is in a format that can be provided to the Qualys
+    API, if it is not in a format that can be accepted by the Qualys API, it
+    attempts to put it in a format that is acceptable (e.g. converting cidr
+    notation to the ip range notation that Qualys expects).  Repeated,
+    overlapping and adjacent addresses and ranges are merged.
+        Returns a string that is valid to hand to the 'ips' key in the
+        Qualys API.
+    """
+    return IPSet.parse(ipstring).to_ip_string()
+
+def split_ip_string(ipstring, max_bytes=None, max_hosts=None):
+    """ Coalesce ipstring into the fewest ranges and split it into strings
+    that each fit a single API request: at most max_bytes long
+    (settings.ips_request_max_bytes) and covering at most max_hosts
+    addresses (settings.ips_request_max_hosts, None for no limit).
+        Returns a list of strings that are valid to hand to the 'ips' key
+        in the Qualys API.
+    """
+    if max_bytes is None:
+        max_bytes = qcs.ips_request_max_bytes
+    if max_hosts is None:
+        max_hosts = qcs.ips_request_max_hosts
+    return IPSet.parse(ipstring).split(max_bytes, max_hosts)
+
+def ip_string_intervals(ipstring):
+    """ Convert ipstring (as returned by decode_ip_string) into a sorted
+    list of (version, start, end) tuples where start and end are integer
+    addresses.  Overlapping and adjacent entries are merged.
+    """
+    return list(IPSet.parse(ipstring).intervals())
+
+def intervals_to_ip_string(intervals):
+    """ Convert a list of (version, start, end) tuples into a string that
+    is valid to hand to the 'ips' key in the Qualys API.
+    """
+    return IPSet(intervals).to_ip_string()
+
+def shard_ip_string(ipstring, shards):
+    """ Split ipstring (as returned by decode_ip_string) into at most
+    'shards' ips strings, in address order, each covering a balanced
+    number of addresses.  Ranges are split across shards as required.
+        Returns a list of strings that are valid to hand to the 'ips' key
+        in the Qualys API.
+    """
+    intervals = ip_string_intervals(ipstring)
+    total = sum([end - start + 1 for (version, start, end) in intervals])
+    if not total:
+        return []
+    # ceiling division so that no more than 'shards' shards are created.
+    per_shard = max(1, (total + shards - 1) // shards)
+
+    result = []
+    current = []
+    room = per_shard
+    for (version, start, end) in intervals:
+        while start <= end:
+            take = min(end - start + 1, room)
+            current.append((version, start, start + take - 1))
+            start += take
+            room -= take
+            if room == 0:
+                result.append(intervals_to_ip_string(current))
+                current = []
+                room = per_shard
+    if current:
+        result.append(intervals_to_ip_string(current))
+    return result
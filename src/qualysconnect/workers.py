@@ -0,0 +1,130 @@
+""" Module providing QGWorkerPool, a fixed size pool of threads running
+blocking calls, and QGFuture, the placeholder for each call's outcome.
+
+  workers = QGWorkerPool(8)
+  futures = [workers.submit(socket.getaddrinfo, name, None)
+             for name in hostnames]
+  addresses = [future.result() for future in futures]
+  workers.shutdown()
+
+Python 2.x has no concurrent.futures; this is the small part of it that the
+asynchronous session, the host resolver and the report pipeline share.
+"""
+import Queue
+import logging
+import threading
+
+import qualysconnect.settings as qcs
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+logger = logging.getLogger(__name__)
+
+class QGFuture:
+    """ Placeholder for the outcome of an asynchronous QualysConnect call. """
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+    def done(self):
+        """ Return True once the call has finished (or failed). """
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """ Wait up to timeout seconds for the call and return its result,
+        re-raising the exception it failed with.
+        """
+        if not self._done.wait(timeout):
+            raise Exception("QGFuture result not ready after %ss"%(timeout,))
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Wait for the call and return the exception it raised (or None). """
+        if not self._done.wait(timeout):
+            raise Exception("QGFuture result not ready after %ss"%(timeout,))
+        return self._error
+
+    def add_done_callback(self, fn):
+        """ Call fn(future) when the call finishes.  If it already has, fn is
+        called immediately on the calling thread.
+        """
+        self._lock.acquire()
+        try:
+            if not self._done.is_set():
+                self._callbacks.append(fn)
+                return
+        finally:
+            self._lock.release()
+        fn(self)
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, error):
+        self._finish(None, error)
+
+    def _finish(self, result, error):
+        self._lock.acquire()
+        try:
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception:
+                logger.exception("QGFuture callback failed")
+
+class QGWorkerPool:
+    """ Fixed size pool of daemon threads running submitted calls.
+
+    Keyword Arguments:
+    ==================
+    workers -- number of threads (settings.async_workers by default).
+    """
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = qcs.async_workers
+        self._tasks = Queue.Queue()
+        self._threads = []
+        for n in range(workers):
+            t = threading.Thread(target=self._run,
+                                 name="QGWorkerPool-%d"%(n,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, fn, *args, **kwargs):
+        """ Schedule fn(*args, **kwargs) and return a QGFuture for it. """
+        future = QGFuture()
+        self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait=True):
+        """ Stop the workers once already submitted calls have run. """
+        for t in self._threads:
+            self._tasks.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            if task is None:
+                return
+            (future, fn, args, kwargs) = task
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception, e:
+                future.set_exception(e)
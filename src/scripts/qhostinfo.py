@@ -2,8 +2,13 @@
 """ qhostinfo
 A script that takes a hostname or ip address and queries QualysGuard for 
 vulnerabilities related to said host.
+
+With -f, hosts are read from a file (or '-' for stdin), resolved together and
+queried with as few detection requests as the request size limits allow.
 """
 import sys
+import csv
+import json
 import logging
 
 from datetime import datetime
@@ -11,13 +16,23 @@ from optparse import OptionParser
 
 from qualysconnect.util import build_v2_session
 from qualysconnect.util import is_valid_ip_address, hostname_to_ip
+from qualysconnect.util import hostnames_to_ips, split_ip_string
+
+from qualysconnect.ipset import IPSet, parse_address, parse_token
 
-from qualysconnect.qg.xmlproc import QGXP_lxml_objectify, QGXP_qgdt_to_datetime
+from qualysconnect.qg.xmlproc import QGXP_iter_host_detections, QGXP_qgdt_to_datetime
+from qualysconnect.qg.detection import DETECTION_REQUEST
+from qualysconnect.qg.detectioncache import QGDetectionCache
 
 __author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
 __copyright__ = "Copyright 2011-2013, University of Waterloo"
 __license__ = "BSD-new"
 
+OUTPUT_FORMATS = ("text", "json", "csv")
+
+CSV_FIELDS = ("IP", "DNS", "NETBIOS", "OS", "LAST_SCAN_DATETIME",
+              "QID", "TYPE", "SEVERITY", "STATUS")
+
 def process_cli_arguments():
     """ Process arguments from sysv and return an option list representing the
     flags set on the command line.
@@ -31,23 +46,44 @@ def process_cli_arguments():
     parser.add_option("-H", "--hostname", dest="hostname",
                       help="Display QualysGuard results for HOSTNAME.",
                       metavar="HOSTNAME")
+    parser.add_option("-f", "--file", dest="hostfile",
+                      help="Display QualysGuard results for every IP, IP range "
+                           "or hostname listed in FILE, one per line ('-' "
+                           "reads stdin).", metavar="FILE")
+    parser.add_option("-o", "--output", dest="output", default="text",
+                      choices=OUTPUT_FORMATS,
+                      help="Output format: %s (default text)."%(
+                          ", ".join(OUTPUT_FORMATS),), metavar="FORMAT")
+    parser.add_option("-c", "--cached", action="store_true", dest="cached",
+                      help="Answer from the local detection cache without "
+                           "querying QualysGuard.", default=False)
+    parser.add_option("-s", "--sync", action="store_true", dest="sync",
+                      help="With -c, first refresh the cache with hosts "
+                           "processed since its last refresh (the first "
+                           "refresh pulls every host).", default=False)
     parser.add_option("-P", "--purge", action="store_true", dest="purge",
                       help="Purge QualysGuard for host.", default=False)
     
     (options, args) = parser.parse_args()
     
     # we did not get any values that might represent a host or ip. 
-    if len(args) == 0 and not (options.hostip or options.hostname):
+    if len(args) == 0 and not (options.hostip or options.hostname
+                               or options.hostfile):
         parser.print_help()
-        parser.error("an ip or hostname must be provided.")
+        parser.error("an ip, hostname or host file must be provided.")
     
-    # either an address OR a hostname are provided.  NOT both.
-    if options.hostip and options.hostname:
-        parser.error("-a and -H options are mutually exclusive.")
+    # either an address OR a hostname OR a host file are provided.  ONE only.
+    if len([o for o in (options.hostip, options.hostname, options.hostfile)
+            if o]) > 1:
+        parser.error("-a, -H and -f options are mutually exclusive.")
+    if options.hostfile and args:
+        parser.error("unprocessed arguments-> [%s]"%(str(args),))
+    if options.sync and not options.cached:
+        parser.error("-s requires -c.")
     
     # maybe the user can't read and they didn't use a flag but provided a
     # reasonable value that we can attempt to convert to an IP or HOSTNAME?
-    if not (options.hostip or options.hostname):
+    if not (options.hostip or options.hostname or options.hostfile):
         if is_valid_ip_address(args[0]):
             options.hostip = args.pop()
         else:
@@ -59,6 +95,149 @@ def process_cli_arguments():
   
     return options
 
+def display_host_detections(record, qghost):
+    """ Displays a host record produced by QGXP_iter_host_detections.
+    
+    """
+    SEP = '========================'
+
+    if not record.get('LAST_SCAN_DATETIME'):
+        print "No host results returned for %s."%(record['IP'],)
+        return
+
+    # printed without the (UTC) offset, as it always was.
+    scandt = QGXP_qgdt_to_datetime(record['LAST_SCAN_DATETIME'])
+    print "SCAN:\t%s"%(scandt.replace(tzinfo=None),)
+
+    if record.get('DNS'):
+        print "NAME:\t%s"%(record['DNS'],)
+
+    print "IP:\t%s"%(record['IP'],)
+
+    if record.get('OS'):
+        print "OS:\t%s"%(record['OS'],)
+
+    print
+    print 'DISCOVERED QIDs'
+    print SEP
+
+    for detect in record['DETECTIONS']:
+        qid = detect['QID']
+        print '%s - https://%s/fo/common/vuln_info.php?id=%s'%(qid,qghost,qid)
+        print
+
+def read_hosts(hostfile):
+    """ Return the entries of a host file (one IP, IP range or hostname per
+    line; blank lines and '#' comments are skipped).
+    """
+    if hostfile == '-':
+        fp = sys.stdin
+    else:
+        fp = open(hostfile)
+    try:
+        hosts = []
+        for line in fp:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                hosts.append(line)
+        return hosts
+    finally:
+        if fp is not sys.stdin:
+            fp.close()
+
+def resolve_hosts(hosts):
+    """ Return (ipset, names) for a list of IPs, IP ranges and hostnames.
+    Hostnames are resolved together; names maps each resolved address to the
+    hostnames it was given as.  Unresolvable hostnames are reported on stderr.
+    """
+    intervals = []
+    hostnames = []
+    for host in hosts:
+        try:
+            intervals.append(parse_token(host))
+        except ValueError:
+            hostnames.append(host)
+
+    names = {}
+    if hostnames:
+        (resolved, failures) = hostnames_to_ips(hostnames)
+        for hostname in hostnames:
+            if hostname in failures:
+                print >> sys.stderr, "Could not resolve %s: %s"%(
+                    hostname, failures[hostname])
+                continue
+            address = parse_address(resolved[hostname])
+            intervals.append((address[0], address[1], address[1]))
+            names.setdefault(address, []).append(hostname)
+    return (IPSet(intervals), names)
+
+def host_records(qgs, hosts, requests, cached=False, sync=False):
+    """ Generator yielding the detection records of hosts, either from the
+    API (one request per ips string in requests) or from the local detection
+    cache, refreshed first if sync is set.
+    """
+    if cached:
+        cache = QGDetectionCache()
+        try:
+            if sync:
+                cache.sync(qgs)
+            elif cache.last_sync() is None:
+                print >> sys.stderr, ("The detection cache %s was never "
+                                      "refreshed, use -s."%(
+                                          cache.get_filename(),))
+            for record in cache.hosts(hosts):
+                yield record
+        finally:
+            cache.close()
+        return
+
+    for ips in requests:
+        # request VM detection records from QualysGuard using APIv2, parsed
+        #  straight off the socket.
+        for stream in qgs.iter_page_streams(DETECTION_REQUEST, "ips=%s"%(ips,)):
+            for record in QGXP_iter_host_detections(stream):
+                yield record
+
+def csv_value(value):
+    """ Return value encoded for the csv module. """
+    if value is None:
+        return ''
+    return unicode(value).encode('utf-8')
+
+class HostOutput:
+    """ Writes host records to stdout as they arrive, in one of
+    OUTPUT_FORMATS.
+    """
+    def __init__(self, format, qghost, names=None):
+        self.format = format
+        self.qghost = qghost
+        self.names = names or {}
+        self.writer = None
+        if format == 'csv':
+            self.writer = csv.DictWriter(sys.stdout, CSV_FIELDS,
+                                         extrasaction='ignore')
+            self.writer.writeheader()
+
+    def write(self, record):
+        if self.format == 'text':
+            display_host_detections(record, self.qghost)
+        elif self.format == 'json':
+            hostnames = self.names.get(parse_address(record['IP']))
+            if hostnames:
+                record['HOSTNAMES'] = hostnames
+            print json.dumps(record)
+        else:
+            host = dict([(k, csv_value(v))
+                         for (k, v) in record.items() if k != 'DETECTIONS'])
+            if not record['DETECTIONS']:
+                self.writer.writerow(host)
+            for detect in record['DETECTIONS']:
+                row = dict(host)
+                row.update([(k, csv_value(v))
+                            for (k, v) in detect.items()])
+                self.writer.writerow(row)
+        sys.stdout.flush()
+
 # BEGIN
 #  main() function.  This is where the real 'meat' is.
 if __name__ == '__main__':
@@ -71,66 +250,67 @@ if __name__ == '__main__':
     else:
         logging.basicConfig(level=logging.CRITICAL)
     
-    host = None
+    names = None
     
-    if options.hostip:
-        host = options.hostip
+    if options.hostfile:
+        (hosts, names) = resolve_hosts(read_hosts(options.hostfile))
+    elif options.hostip:
+        hosts = IPSet.parse(options.hostip)
     elif options.hostname:
-        host = hostname_to_ip(options.hostname)
+        hosts = IPSet.parse(hostname_to_ip(options.hostname))
     else:
         raise Exception('Critical Error. No IP computed to query.')
 
-    # begin session with QualysGuard and process return.
+    if not hosts:
+        print >> sys.stderr, "No hosts to query."
+        sys.exit(1)
+
+    # begin session with QualysGuard and process return.  Answers from the
+    #  cache need no login.
     qgs=build_v2_session()
-    qgs.connect()
+    connected = not options.cached or options.sync or options.purge
+    if connected:
+        qgs.connect()
     
+    # as few requests as the size limits allow; long lists are POSTed.
+    requests = split_ip_string(hosts.to_ip_string())
+
     if not options.purge:
-        # request VM detection records from QualysGuard using APIv2
-        ret = qgs.request("asset/host/vm/detection/?action=list&ips=%s&"%(host,))
-        
         SEP = '========================'
 
-        info = QGXP_lxml_objectify(ret)
-        print SEP
-        print 'QualysGuard Scan Results'
-        print SEP
-
-        try:
-            scandt = QGXP_qgdt_to_datetime(info.RESPONSE.HOST_LIST.HOST.LAST_SCAN_DATETIME)
-        except AttributeError:
-            print "No host results returned for %s."%(host,)
-            sys.exit(1)
-
-        print "SCAN:\t%s"%(scandt)
-
-        try:
-            print "NAME:\t%s"%(info.RESPONSE.HOST_LIST.HOST.DNS,)
-        except AttributeError:
-            pass
+        if options.output == 'text':
+            print SEP
+            print 'QualysGuard Scan Results'
+            print SEP
 
-        print "IP:\t%s"%(info.RESPONSE.HOST_LIST.HOST.IP,)
+        output = HostOutput(options.output, qgs.apiHOST(), names)
+        found = []
+        scanned = False
+        for record in host_records(qgs, hosts, requests, options.cached,
+                                   options.sync):
+            address = parse_address(record['IP'])
+            found.append((address[0], address[1], address[1]))
+            scanned = scanned or bool(record.get('LAST_SCAN_DATETIME'))
+            output.write(record)
 
-        try:
-            print "OS:\t%s"%(info.RESPONSE.HOST_LIST.HOST.OS,)
-        except AttributeError:
-            pass
-
-        try:
-            print
-            print 'DISCOVERED QIDs'
-            print SEP
-            
-            for detect in info.RESPONSE.HOST_LIST.HOST.DETECTION_LIST.DETECTION:
-                qid = str(detect.QID)
-                print '%s - https://%s/fo/common/vuln_info.php?id=%s'%(qid,qgs.apiHOST(),qid)
-                print
-        except AttributeError:
-            pass
+        missing = hosts - IPSet(found)
+        if missing:
+            if options.output == 'text':
+                print "No host results returned for %s."%(missing,)
+            else:
+                print >> sys.stderr, "No host results returned for %s."%(missing,)
+        if not scanned:
+            if connected:
+                qgs.disconnect()
+            sys.exit(1)
         
-        print SEP
+        if options.output == 'text':
+            print SEP
 
     elif options.purge:
-        ret = qgs.request("asset/host/?action=purge", "ips=%s"%(host,))
-        print ret
+        for ips in requests:
+            ret = qgs.request("asset/host/?action=purge", "ips=%s"%(ips,))
+            print ret
 
-    qgs.disconnect()
+    if connected:
+        qgs.disconnect()
@@ -14,6 +14,7 @@ from qualysconnect.util import build_v1_connector, build_v2_session
 from qualysconnect.util import is_valid_ip_address, hostname_to_ip
 
 from qualysconnect.qg.xmlproc import QGXP_lxml_objectify, QGXP_qgdt_to_datetime
+from qualysconnect.qg.download import QGDownload
 
 __author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
 __copyright__ = "Copyright 2011-2013, University of Waterloo"
@@ -57,6 +58,12 @@ def process_cli_arguments():
     # Options pertaining to downloading a report.
     parser.add_option("-D", "--download", dest="dl_n",
                       help="Download the results from a report.")
+    parser.add_option("-f", "--file", dest="dl_f",
+                      help="Save the downloaded report to FILE, resuming an "
+                           "interrupted download.", metavar="FILE")
+    parser.add_option("-V", "--verify", action="store_true", dest="dl_V",
+                      help="Verify the size of the downloaded FILE.",
+                      default=False)
     # Options pertaining to deleting a report.
     parser.add_option("-X", "--delete", dest="dl_X",
 		      help="Delete a given report number from Qualys.")
@@ -81,6 +88,12 @@ def process_cli_arguments():
                                   and options.rpt_o and options.rpt_t):
         parser.error("you must provide all RPT_* fields to launch a report.")
     
+    if (options.dl_f or options.dl_V) and not options.dl_n:
+        parser.error("-f and -V can only be used with -D.")
+
+    if options.dl_V and not options.dl_f:
+        parser.error("-V requires -f.")
+
     # verify that there are no unprocessed arguments.
     if args:
             parser.error("unprocessed arguments-> [%s]"%(str(args),))
@@ -92,7 +105,7 @@ def display_QG_scanlist(scanlist):
     
     """
     for scan in scanlist.RESPONSE.SCAN_LIST.SCAN:
-        scandt = QGXP_qgdt_to_datetime(scan.LAUNCH_DATETIME)
+        scandt = QGXP_qgdt_to_datetime(scan.LAUNCH_DATETIME).replace(tzinfo=None)
         print "[%s]\t{( %s | %s )}"%(scan.REF, scandt, scan.TITLE)
 
 def display_QG_reportlist(reportlist):
@@ -100,7 +113,7 @@ def display_QG_reportlist(reportlist):
     
     """
     for (n,report) in enumerate(reportlist.RESPONSE.REPORT_LIST.REPORT):
-        reportdt = QGXP_qgdt_to_datetime(report.LAUNCH_DATETIME)
+        reportdt = QGXP_qgdt_to_datetime(report.LAUNCH_DATETIME).replace(tzinfo=None)
         print "[%s]\t{( %s | %s | %s)}"%(report.ID, reportdt, report.TITLE, report.STATUS.STATE)
 
 def display_QG_report_template_list(list):
@@ -132,12 +145,13 @@ if __name__ == '__main__':
     # if requested, fetch and display scan result sets known to QualysGuard
     if options.listscans:
         if options.scantype:
-            ret = qgs.request("scan/?action=list&state=Finished&type=%s"
-                              %(options.scantype,))
+            req = "scan/?action=list&state=Finished&type=%s"%(options.scantype,)
         else:
-            ret = qgs.request("scan/?action=list&state=Finished")
+            req = "scan/?action=list&state=Finished"
         
-        display_QG_scanlist(QGXP_lxml_objectify(ret))
+        # long scan lists are truncated by QualysGuard, follow every page.
+        for ret in qgs.iter_pages(req):
+            display_QG_scanlist(QGXP_lxml_objectify(ret))
     
     # if requested, fetch and display report types 
     if options.listreports:
@@ -172,9 +186,15 @@ if __name__ == '__main__':
 	r = QGXP_lxml_objectify(ret)
 	display_QG_reportlist(r)
 
+    elif options.dl_n and options.dl_f:
+        QGDownload(qgs, "report/?action=fetch&id=%s"%(options.dl_n,),
+                   verify_size=options.dl_V).to_file(options.dl_f)
+
     elif options.dl_n:
-        ret = qgs.request("report/","action=fetch&id=%s&"%(options.dl_n))
-        print ret
+        # stream the report to stdout, reports can be far larger than memory.
+        for chunk in qgs.iter_request("report/","action=fetch&id=%s&"%(options.dl_n)):
+            sys.stdout.write(chunk)
+        print
     
     elif options.dl_X:
         ret = qgs.request("report/","action=delete&id=%s&"%(options.dl_X))
@@ -0,0 +1,143 @@
+""" A local HTTP/1.1 keep-alive stand-in for QualysGuard, used by the tests.
+
+  server = LocalServer(respond)      # respond(handler) answers each request
+  qgs = local_session(server)        # QGAPISession talking to it
+  ...
+  server.stop()
+
+Every request is recorded in server.requests as a dictionary of its method,
+path, headers and the number of body bytes the response sent;
+server.accepted counts the connections accepted.
+"""
+import os
+import sys
+import socket
+import threading
+import SocketServer
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir, 'src'))
+
+from qualysconnect.qg.connect import QGAPISession
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+class LocalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.body = ''
+        self.server.record(self)
+        self.server.respond(self)
+
+    def do_POST(self):
+        self.body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.record(self)
+        self.server.respond(self)
+
+    def reply(self, body, code=200, headers=None, send=None):
+        """ Send a response of body (announcing all of it).  With send, only
+        the first send bytes are written and the connection is dropped.
+        """
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if send is not None:
+            body = body[:send]
+        self.wfile.write(body)
+        self.wfile.flush()
+        self.server.sent(len(body))
+        if send is not None:
+            self.close_connection = 1
+            self.connection.shutdown(socket.SHUT_RDWR)
+
+    def log_message(self, *args):
+        pass
+
+class LocalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Threaded HTTP/1.1 server on an ephemeral port of 127.0.0.1.
+
+    Keyword Arguments:
+    ==================
+    respond -- function called with the LocalHandler of each request.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, respond):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           LocalHandler)
+        self.respond = respond
+        self.requests = []
+        self.connections = []
+        self.accepted = 0
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def url(self, path=''):
+        return "http://127.0.0.1:%d/%s"%(self.server_address[1], path)
+
+    def get_request(self):
+        (conn, address) = BaseHTTPServer.HTTPServer.get_request(self)
+        self._lock.acquire()
+        try:
+            self.connections.append(conn)
+            self.accepted += 1
+        finally:
+            self._lock.release()
+        return (conn, address)
+
+    def record(self, handler):
+        self._lock.acquire()
+        try:
+            self.requests.append({'method': handler.command,
+                                  'path': handler.path,
+                                  'headers': handler.headers,
+                                  'body': handler.body,
+                                  'sent': 0})
+        finally:
+            self._lock.release()
+
+    def sent(self, nbytes):
+        self._lock.acquire()
+        try:
+            self.requests[-1]['sent'] += nbytes
+        finally:
+            self._lock.release()
+
+    def drop_connections(self):
+        """ Close every connection from the server side, as a server does
+        with idle keep-alive connections.
+        """
+        self._lock.acquire()
+        try:
+            connections, self.connections = self.connections, []
+        finally:
+            self._lock.release()
+        for conn in connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def handle_error(self, request, client_address):
+        # connections the tests drop on purpose.
+        pass
+
+    def stop(self):
+        self.shutdown()
+        self.drop_connections()
+        self.server_close()
+
+def local_session(server, **kwargs):
+    """ Return a QGAPISession that sends its requests to server. """
+    qgs = QGAPISession('user', 'password', 'localhost', **kwargs)
+    qgs._APIURI = server.url('api/2.0/fo/')
+    return qgs
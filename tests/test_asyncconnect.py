@@ -0,0 +1,60 @@
+""" Tests of qualysconnect.qg.asyncconnect against a local server. """
+import unittest
+
+from localserver import LocalServer, local_session
+
+from qualysconnect.qg.asyncconnect import AsyncQGAPISession
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+BODY = ''.join([chr(n % 251) for n in xrange(1024 * 1024)])
+
+def respond(handler):
+    handler.reply(BODY)
+
+class QGAsyncStreamTest(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer(respond)
+        self.session = AsyncQGAPISession('user', 'password', 'localhost',
+                                         pWorkers=2)
+        self.session.session()._APIURI = self.server.url('api/2.0/fo/')
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+
+    def test_read_whole_stream(self):
+        stream = self.session.request_stream("asset/host/?action=list",
+                                             chunk_size=8192)
+        chunks = []
+        while True:
+            chunk = stream.read().result(10)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        self.assertEqual(''.join(chunks), BODY)
+
+    def test_idle_streams_leave_workers_free(self):
+        # more open streams than workers, none of them being read.
+        streams = [self.session.request_stream("asset/host/?action=list",
+                                               chunk_size=8192)
+                   for n in range(4)]
+        for stream in streams:
+            self.assertEqual(stream.read().result(10), BODY[:8192])
+        future = self.session.request("asset/host/?action=list")
+        self.assertEqual(future.result(10), BODY)
+        for stream in streams:
+            stream.close()
+
+    def test_close_resolves_readers_and_closes_response(self):
+        stream = self.session.request_stream("asset/host/?action=list",
+                                             chunk_size=8192)
+        self.assertEqual(stream.read().result(10), BODY[:8192])
+        stream.close()
+        self.assertEqual(stream.read().result(10), '')
+        self.assertTrue(stream._response.fp is None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+""" Tests of qualysconnect.qg.connect scheduling against a local server. """
+import threading
+import unittest
+
+from localserver import LocalServer, local_session
+
+import qualysconnect.settings as qcs
+
+from qualysconnect.qg.ratelimit import QGRateLimiter
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+BODY = "<RESPONSE>%s</RESPONSE>"%('x' * 200000,)
+
+def respond(handler):
+    handler.reply(BODY, headers={'X-RateLimit-Limit': '300',
+                                 'X-RateLimit-Remaining': '299',
+                                 'X-RateLimit-Window-Sec': '3600'})
+
+class ConcurrencyTest(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer(respond)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_open_streams_do_not_block_requests(self):
+        qgs = local_session(self.server)
+        streams = [qgs.request_stream("asset/host/?action=list")
+                   for n in range(qcs.concurrency_limit + 1)]
+        for stream in streams:
+            self.assertEqual(stream.read(10), BODY[:10])
+
+        result = []
+        worker = threading.Thread(target=lambda: result.append(
+            qgs.request("asset/host/?action=list")))
+        worker.daemon = True
+        worker.start()
+        worker.join(10)
+        self.assertEqual(result, [BODY])
+        self.assertEqual(qgs.rate_limit_stats()['running'], 0)
+        for stream in streams:
+            stream.close()
+        qgs.close()
+
+    def test_reserve_above_limit_raises(self):
+        qgs = local_session(self.server, pLimiter=QGRateLimiter(reserve=300))
+        self.assertEqual(qgs.request("asset/host/?action=list"), BODY)
+        self.assertRaises(Exception, qgs.request, "asset/host/?action=list")
+        qgs.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+""" Tests of qualysconnect.qg.download against a local server. """
+import os
+import shutil
+import tempfile
+import unittest
+
+from localserver import LocalServer, local_session
+
+import qualysconnect.settings as qcs
+
+from qualysconnect.qg.download import QGDownload
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+REPORT = ''.join([chr(n % 251) for n in xrange(300000)])
+CHANGED = REPORT[::-1]
+DROPPED_AT = 70000
+
+class ReportServer:
+    """ Serves a report with Range support; the first response is cut off
+    after DROPPED_AT bytes.  After the cut the report becomes changed if
+    asked to (a new ETag).
+    """
+    def __init__(self, change=False):
+        self.change = change
+        self.served = 0
+
+    def __call__(self, handler):
+        if handler.command != 'GET':
+            handler.reply('', 405)
+            return
+        self.served += 1
+        body = REPORT
+        etag = '"1"'
+        if self.served > 1 and self.change:
+            (body, etag) = (CHANGED, '"2"')
+        headers = {'ETag': etag}
+        requested = handler.headers.get('Range')
+        if (requested and requested.startswith('bytes=')
+            and handler.headers.get('If-Range', etag) == etag):
+            start = int(requested[6:].rstrip('-'))
+            headers['Content-Range'] = "bytes %d-%d/%d"%(start, len(body) - 1,
+                                                        len(body))
+            handler.reply(body[start:], 206, headers)
+        elif self.served == 1:
+            handler.reply(body, 200, headers, send=DROPPED_AT)
+        else:
+            handler.reply(body, 200, headers)
+
+class QGDownloadTest(unittest.TestCase):
+    def setUp(self):
+        self._backoff = qcs.retry_backoff
+        qcs.retry_backoff = 0.01
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "report")
+
+    def tearDown(self):
+        qcs.retry_backoff = self._backoff
+        shutil.rmtree(self.directory)
+
+    def download(self, respond):
+        server = LocalServer(respond)
+        try:
+            qgs = local_session(server)
+            size = QGDownload(qgs, "report/", "action=fetch&id=1",
+                              chunk_size=8192,
+                              verify_size=True).to_file(self.filename)
+            qgs.close()
+        finally:
+            server.stop()
+        return (size, server.requests)
+
+    def test_resume_sends_remaining_bytes(self):
+        (size, requests) = self.download(ReportServer())
+        self.assertEqual(size, len(REPORT))
+        self.assertEqual(open(self.filename, 'rb').read(), REPORT)
+        self.assertEqual([request['method'] for request in requests],
+                         ['GET', 'GET'])
+        self.assertEqual(requests[0]['path'],
+                         "/api/2.0/fo/report/?action=fetch&id=1")
+        self.assertEqual(requests[1]['headers'].get('Range'),
+                         "bytes=%d-"%(DROPPED_AT,))
+        self.assertEqual(requests[1]['headers'].get('If-Range'), '"1"')
+        self.assertEqual(requests[1]['sent'], len(REPORT) - DROPPED_AT)
+        self.assertFalse(os.path.exists(self.filename + ".part"))
+        self.assertFalse(os.path.exists(self.filename + ".qcchk"))
+
+    def test_changed_report_restarts(self):
+        (size, requests) = self.download(ReportServer(change=True))
+        self.assertEqual(size, len(CHANGED))
+        self.assertEqual(open(self.filename, 'rb').read(), CHANGED)
+        self.assertEqual(requests[1]['sent'], len(CHANGED))
+
+if __name__ == '__main__':
+    unittest.main()
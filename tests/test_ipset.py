@@ -0,0 +1,47 @@
+""" Tests of qualysconnect.ipset and the util IP validators built on it. """
+import unittest
+
+import localserver   # puts src on sys.path
+
+from qualysconnect.ipset import IPSet
+from qualysconnect.util import is_valid_ip_range, cidr_to_ip, cidr_to_ipv6
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+class ValidatorTest(unittest.TestCase):
+    def test_is_valid_ip_range(self):
+        self.assertTrue(is_valid_ip_range('10.0.0.1-10.0.0.5'))
+        self.assertTrue(is_valid_ip_range('2001:db8::1-2001:db8::ff', 6))
+        self.assertFalse(is_valid_ip_range('10.0.0.1-10.0.0.5', 6))
+        self.assertFalse(is_valid_ip_range('10.0.0.5-10.0.0.1'))
+        self.assertFalse(is_valid_ip_range('10.0.0.1-10.0.0.1'))
+        self.assertFalse(is_valid_ip_range('10.0.0.0/24'))
+        self.assertRaises(ValueError, is_valid_ip_range, '10.0.0.1-10.0.0.5', 5)
+
+    def test_cidr_to_ip(self):
+        self.assertEqual(cidr_to_ip('10.0.0.0/24'), '10.0.0.0-10.0.0.255')
+        self.assertEqual(cidr_to_ip('10.0.0.0/255.255.255.0', 4),
+                         '10.0.0.0-10.0.0.255')
+        self.assertEqual(cidr_to_ip('10.0.0.1/32'), '10.0.0.1')
+        self.assertEqual(cidr_to_ipv6('2001:db8::fff/120'),
+                         '2001:db8::f00-2001:db8::fff')
+        self.assertRaises(ValueError, cidr_to_ip, '10.0.0.0/24', 6)
+        self.assertRaises(ValueError, cidr_to_ip, '10.0.0.1-10.0.0.5')
+
+class SplitTest(unittest.TestCase):
+    def test_oversized_range_is_split(self):
+        ips = IPSet.parse('10.0.0.1-10.0.255.254,10.1.0.1')
+        chunks = ips.split(max_bytes=20)
+        self.assertTrue(len(chunks) > 2)
+        for chunk in chunks:
+            self.assertTrue(len(chunk) <= 20)
+        self.assertEqual(IPSet.parse(','.join(chunks)).to_ip_string(),
+                         ips.to_ip_string())
+
+    def test_address_longer_than_budget_raises(self):
+        self.assertRaises(ValueError, IPSet.parse('10.0.0.1').split, 5)
+
+if __name__ == '__main__':
+    unittest.main()
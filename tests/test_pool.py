@@ -0,0 +1,73 @@
+""" Tests of qualysconnect.qg.pool against a local keep-alive server. """
+import time
+import socket
+import urllib2
+import unittest
+
+from localserver import LocalServer
+
+from qualysconnect.qg.pool import QGConnectionPool, QGKeepAliveHandler
+
+__author__ = "Colin Bell <colin.bell@uwaterloo.ca>"
+__copyright__ = "Copyright 2011-2014, University of Waterloo"
+__license__ = "BSD-new"
+
+def respond(handler):
+    if handler.path == '/slow':
+        time.sleep(2)
+    handler.reply("ok %s"%(handler.path,))
+
+class QGKeepAliveHandlerTest(unittest.TestCase):
+    def setUp(self):
+        self.server = LocalServer(respond)
+        self.pool = QGConnectionPool()
+        self.opener = urllib2.build_opener(QGKeepAliveHandler(self.pool))
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def get(self, path, **kwargs):
+        response = self.opener.open(self.server.url(path), **kwargs)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+    def test_reuses_connection(self):
+        for n in range(3):
+            self.assertEqual(self.get("a"), "ok /a")
+        stats = self.pool.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['idle']),
+                         (2, 1, 1))
+        self.assertEqual(self.server.accepted, 1)
+
+    def test_reconnects_after_server_drops_idle_connection(self):
+        self.assertEqual(self.get("a"), "ok /a")
+        self.server.drop_connections()
+        time.sleep(0.1)
+        self.assertEqual(self.get("b"), "ok /b")
+        stats = self.pool.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['discards']),
+                         (1, 1, 1))
+        self.assertEqual(self.server.accepted, 2)
+        self.assertEqual([request['path'] for request in self.server.requests],
+                         ['/a', '/b'])
+
+    def test_reused_connection_gets_request_timeout(self):
+        # opened without a timeout, then reused by a request with one.
+        self.assertEqual(self.get("a"), "ok /a")
+        start = time.time()
+        try:
+            self.get("slow", timeout=0.5)
+        except (urllib2.URLError, socket.timeout):
+            pass
+        else:
+            self.fail("slow response did not time out")
+        self.assertTrue(time.time() - start < 1.5)
+        # a timeout is not a stale connection, the request is not resent.
+        self.assertEqual([request['path'] for request in self.server.requests],
+                         ['/a', '/slow'])
+
+if __name__ == '__main__':
+    unittest.main()